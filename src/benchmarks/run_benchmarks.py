@@ -0,0 +1,304 @@
+import os
+import os.path as op
+import sys
+import copy
+import json
+import time
+import platform
+import tracemalloc
+import traceback
+import contextlib
+import numpy as np
+
+from src.utils import utils
+from src.benchmarks import synthetic_subjects as ss
+
+# The benchmarks suite: times the preproc hot paths on synthetic subjects at several sizes (icosphere orders),
+# records the wall time, peak (python) memory and throughput of every benchmark to a json file, and compares them
+# against a stored baseline.
+# python -m src.benchmarks.run_benchmarks --orders 3,4,5 --save_baseline 1
+# python -m src.benchmarks.run_benchmarks --orders 3,4,5
+
+LINKS_DIR = utils.get_links_dir()
+MMVT_DIR = op.join(LINKS_DIR, 'mmvt')
+BENCHMARKS_DIR = op.join(MMVT_DIR, 'benchmarks')
+BASELINE_NAME = 'baseline.json'
+# The modules which read their dirs from module level globals
+PATCHED_MODULES = ['src.preproc.anatomy', 'src.preproc.connectivity', 'src.preproc.fMRI',
+                   'src.preproc.parcelate_cortex', 'src.utils.labels_utils']
+
+
+@contextlib.contextmanager
+def benchmark_dirs(root_fol):
+    # Points the modules SUBJECTS_DIR and MMVT_DIR to the synthetic subjects
+    import importlib
+    dirs = dict(SUBJECTS_DIR=op.join(root_fol, 'subjects'), MMVT_DIR=op.join(root_fol, 'mmvt'))
+    backup = []
+    for module_name in PATCHED_MODULES:
+        try:
+            module = importlib.import_module(module_name)
+        except:
+            continue
+        for var_name, val in dirs.items():
+            if hasattr(module, var_name):
+                backup.append((module, var_name, getattr(module, var_name)))
+                setattr(module, var_name, val)
+    try:
+        yield dirs
+    finally:
+        for module, var_name, val in backup:
+            setattr(module, var_name, val)
+
+
+@contextlib.contextmanager
+def quiet(on=True):
+    if not on:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def time_func(func, repeats=3, warmup=1, measure_memory=True, silent=True):
+    with quiet(silent):
+        for _ in range(warmup):
+            func()
+        times = []
+        for _ in range(repeats):
+            now = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - now)
+        peak_mb = None
+        if measure_memory:
+            # A separate run, tracemalloc slows down the allocations
+            tracemalloc.start()
+            try:
+                func()
+                peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            finally:
+                tracemalloc.stop()
+    return times, peak_mb
+
+
+# Every benchmark gets the synthetic subject's data and dirs, and returns the function to time and its items num
+
+def bench_read_ply_file(sd, dirs, args):
+    ply_fname = op.join(dirs['MMVT_DIR'], sd['subject'], 'surf', 'rh.pial.ply')
+    return lambda: utils.read_ply_file(ply_fname), len(sd['verts']['rh'])
+
+
+def bench_read_ply_file_npz(sd, dirs, args):
+    ply_fname = op.join(dirs['MMVT_DIR'], sd['subject'], 'surf_npz', 'rh.pial.ply')
+    return lambda: utils.read_ply_file(ply_fname), len(sd['verts']['rh'])
+
+
+def bench_calc_labeles_contours(sd, dirs, args):
+    from src.preproc import anatomy
+    func = lambda: anatomy.calc_labeles_contours(
+        sd['subject'], sd['atlas'], labels_dict=sd['labels'], verts_dict=sd['verts'],
+        verts_neighbors_dict=sd['neighbors'], check_unknown=False, save_lookup=False, calc_centers=False,
+        verbose=False)
+    return func, sum(len(sd['verts'][hemi]) for hemi in utils.HEMIS)
+
+
+def bench_calc_lables_connectivity(sd, dirs, args):
+    from src.preproc import connectivity
+    conn_args = connectivity.read_cmd_args(dict(
+        subject=sd['subject'], atlas=sd['atlas'], function='calc_lables_connectivity', connectivity_modality='fmri',
+        connectivity_method='corr', labels_data_name=ss.get_labels_data_name(sd['atlas']),
+        windows_length=args.windows_length, windows_shift=args.windows_shift, labels_exclude='unknown',
+        save_mmvt_connectivity=0, recalc_connectivity=1))
+    windows_num = len(connectivity.calc_windows(args.T, args.windows_length, args.windows_shift))
+    labels_num = 2 * (len(sd['labels_names']) - 1)
+    # calc_lables_connectivity changes its args
+    func = lambda: connectivity.calc_lables_connectivity(sd['subject'], 'mean', utils.Bag(copy.deepcopy(dict(conn_args))))
+    return func, labels_num ** 2 * windows_num
+
+
+def bench_calc_vox_avg(sd, dirs, args):
+    import nibabel as nib
+    from src.preproc import fMRI
+    volume = np.asarray(nib.load(sd['volume_fname']).dataobj)
+    voxels = ss.verts_to_voxels(np.concatenate([sd['verts'][hemi] for hemi in utils.HEMIS]), volume.shape[:3])
+    func = lambda: [fMRI.calc_vox_avg(volume[..., t], voxels) for t in range(volume.shape[3])]
+    return func, len(voxels) * volume.shape[3]
+
+
+def bench_calc_vox_avg_r2(sd, dirs, args):
+    import nibabel as nib
+    from src.preproc import fMRI
+    volume = np.asarray(nib.load(sd['volume_fname']).dataobj)
+    # The voxels are at least r voxels away from the volume's borders
+    voxels = ss.verts_to_voxels(
+        np.concatenate([sd['verts'][hemi] for hemi in utils.HEMIS]), volume.shape[:3], margin=2)
+    return lambda: fMRI.calc_vox_avg(volume[..., 0], voxels, r=2), len(voxels)
+
+
+def bench_parcelate(sd, dirs, args):
+    from src.preproc import parcelate_cortex
+    from src.utils import labels_utils as lu
+    with quiet(not args.verbose):
+        labels = lu.read_labels(sd['subject'], dirs['SUBJECTS_DIR'], sd['atlas'], hemi='rh')
+    lookup = np.zeros(len(sd['verts']['rh']), dtype=int)
+    for label_ind, label in enumerate(labels):
+        lookup[label.vertices] = label_ind
+    func = lambda: parcelate_cortex.parcelate(sd['subject'], sd['atlas'], 'rh', 'pial', lookup)
+    return func, len(sd['faces']['rh'])
+
+
+BENCHMARKS = dict(
+    read_ply_file=bench_read_ply_file, read_ply_file_npz=bench_read_ply_file_npz,
+    calc_labeles_contours=bench_calc_labeles_contours, calc_lables_connectivity=bench_calc_lables_connectivity,
+    calc_vox_avg=bench_calc_vox_avg, calc_vox_avg_r2=bench_calc_vox_avg_r2, parcelate=bench_parcelate)
+
+
+def get_machine_info():
+    import multiprocessing
+    info = dict(platform=platform.platform(), processor=platform.processor(), python=platform.python_version(),
+                numpy=np.__version__, cpu_count=multiprocessing.cpu_count())
+    try:
+        import subprocess
+        info['git_hash'] = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=utils.get_parent_fol(__file__, 2),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except:
+        info['git_hash'] = ''
+    return info
+
+
+def run(args):
+    from src.utils import memo_utils as memo
+    root_fol = utils.make_dir(op.join(args.root_fol, 'data'))
+    # The benchmarks should time the calculations, not the memoization
+    memo.set_enabled(False)
+    benchmarks = list(BENCHMARKS.keys()) if 'all' in args.benchmarks else args.benchmarks
+    results, failures = {}, {}
+    with benchmark_dirs(root_fol) as dirs:
+        for order in args.orders:
+            subject = 'synthetic_ico{}'.format(order)
+            print('Creating {}'.format(subject))
+            with quiet(not args.verbose):
+                sd = ss.create_subject(root_fol, subject, order, args.labels_num, args.atlas, args.T,
+                                       tuple(args.volume_shape), args.volume_T, args.seed)
+            for bench_name in benchmarks:
+                if bench_name not in BENCHMARKS:
+                    print('No such benchmark {}!'.format(bench_name))
+                    continue
+                key = '{}:ico{}'.format(bench_name, order)
+                try:
+                    func, items_num = BENCHMARKS[bench_name](sd, dirs, args)
+                    times, peak_mb = time_func(func, args.repeats, args.warmup, args.measure_memory,
+                                               not args.verbose)
+                except:
+                    print('{} failed!'.format(key))
+                    utils.print_last_error_line()
+                    failures[key] = traceback.format_exc().strip().split('\n')[-1]
+                    continue
+                wall_time = min(times)
+                results[key] = dict(
+                    benchmark=bench_name, order=order, verts_num=len(sd['verts']['rh']), items_num=items_num,
+                    wall_time=wall_time, wall_time_median=float(np.median(times)), times=times, peak_mb=peak_mb,
+                    throughput=items_num / wall_time if wall_time > 0 else None)
+                print('{}: {:.4f}s (median {:.4f}s), {} peak MB, {:.3g} items/s'.format(
+                    key, wall_time, results[key]['wall_time_median'],
+                    '{:.1f}'.format(peak_mb) if peak_mb is not None else '-', results[key]['throughput'] or 0))
+    return dict(created=time.strftime('%Y-%m-%d %H:%M:%S'), machine=get_machine_info(),
+                params=dict(labels_num=args.labels_num, T=args.T, volume_shape=args.volume_shape,
+                            volume_T=args.volume_T, repeats=args.repeats, seed=args.seed),
+                results=results, failures=failures)
+
+
+def save_results(results, fname):
+    utils.make_dir(utils.get_parent_fol(fname))
+    with open(fname, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results were saved in {}'.format(fname))
+
+
+def load_results(fname):
+    if not op.isfile(fname):
+        return None
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def compare(results, baseline, time_threshold=0.2, memory_threshold=0.2):
+    # Returns the benchmarks which are slower (or take more memory) than the baseline by more than the thresholds
+    regressions = []
+    print('Comparing with the baseline from {} ({})'.format(
+        baseline.get('created', ''), baseline.get('machine', {}).get('git_hash', '')))
+    if baseline.get('machine', {}).get('platform') != results['machine']['platform']:
+        print('Warning: the baseline was calculated on a different machine!')
+    for key, res in results['results'].items():
+        base = baseline['results'].get(key)
+        if base is None:
+            print('{}: no baseline'.format(key))
+            continue
+        time_ratio = res['wall_time'] / base['wall_time'] if base['wall_time'] > 0 else 1
+        mem_ratio = res['peak_mb'] / base['peak_mb'] if res['peak_mb'] is not None and \
+            base.get('peak_mb') else 1
+        regression = time_ratio > 1 + time_threshold or mem_ratio > 1 + memory_threshold
+        print('{}: time x{:.2f}, memory x{:.2f}{}'.format(key, time_ratio, mem_ratio, ' REGRESSION' if regression else ''))
+        if regression:
+            regressions.append(dict(key=key, time_ratio=time_ratio, memory_ratio=mem_ratio))
+    if len(regressions) > 0:
+        print('{} regressions!'.format(len(regressions)))
+    return regressions
+
+
+def main(args):
+    # Returns the failed benchmarks and the regressions
+    results = run(args)
+    output_fname = args.output_fname if args.output_fname != '' else op.join(
+        args.root_fol, 'results', 'benchmarks_{}.json'.format(time.strftime('%Y%m%d_%H%M%S')))
+    save_results(results, output_fname)
+    failures = results['failures']
+    if len(failures) > 0:
+        print('{} benchmarks failed: {}'.format(len(failures), ', '.join(failures.keys())))
+    baseline_fname = args.baseline_fname if args.baseline_fname != '' else op.join(args.root_fol, BASELINE_NAME)
+    if args.save_baseline:
+        if len(failures) > 0:
+            print("The baseline wasn't saved, some of the benchmarks failed")
+        else:
+            save_results(results, baseline_fname)
+        return failures, []
+    baseline = load_results(baseline_fname)
+    if baseline is None:
+        print('No baseline in {}, run with --save_baseline 1 to create it'.format(baseline_fname))
+        return failures, []
+    return failures, compare(results, baseline, args.time_threshold, args.memory_threshold)
+
+
+def read_cmd_args(argv=None):
+    import argparse
+    from src.utils import args_utils as au
+    parser = argparse.ArgumentParser(description='MMVT benchmarks')
+    parser.add_argument('-b', '--benchmarks', required=False, default='all', type=au.str_arr_type)
+    parser.add_argument('--orders', help='icosphere orders', required=False, default='3,4,5', type=au.int_arr_type)
+    parser.add_argument('--root_fol', required=False, default=BENCHMARKS_DIR)
+    parser.add_argument('--output_fname', required=False, default='')
+    parser.add_argument('--baseline_fname', required=False, default='')
+    parser.add_argument('--save_baseline', required=False, default=0, type=au.is_true)
+    parser.add_argument('--time_threshold', required=False, default=0.2, type=float)
+    parser.add_argument('--memory_threshold', required=False, default=0.2, type=float)
+    parser.add_argument('--fail_on_regression', required=False, default=0, type=au.is_true)
+    parser.add_argument('--repeats', required=False, default=3, type=int)
+    parser.add_argument('--warmup', required=False, default=1, type=int)
+    parser.add_argument('--measure_memory', required=False, default=1, type=au.is_true)
+    parser.add_argument('--atlas', required=False, default='synthetic')
+    parser.add_argument('--labels_num', required=False, default=35, type=int)
+    parser.add_argument('--T', help='stc time points', required=False, default=500, type=int)
+    parser.add_argument('--windows_length', required=False, default=100, type=int)
+    parser.add_argument('--windows_shift', required=False, default=50, type=int)
+    parser.add_argument('--volume_shape', required=False, default='64,64,48', type=au.int_arr_type)
+    parser.add_argument('--volume_T', required=False, default=50, type=int)
+    parser.add_argument('--seed', required=False, default=0, type=int)
+    parser.add_argument('--verbose', required=False, default=0, type=au.is_true)
+    return utils.Bag(au.parse_parser(parser, argv))
+
+
+if __name__ == '__main__':
+    args = read_cmd_args()
+    failures, regressions = main(args)
+    if len(failures) > 0 or args.fail_on_regression and len(regressions) > 0:
+        sys.exit(1)
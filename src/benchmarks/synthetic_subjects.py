@@ -0,0 +1,154 @@
+import os.path as op
+import numpy as np
+
+from src.utils import utils
+
+# Synthetic subjects for the benchmarks, generated offline (no FreeSurfer recon is needed):
+# icosphere surfaces (order n has 10 * 4 ** n + 2 vertices), random Voronoi annotations,
+# synthetic source time courses (STC) with their labels data, and random 4D volumes.
+
+HEMIS_OFFSETS = dict(rh=40, lh=-40)
+SURF_RADIUS = 70
+
+
+def icosphere(order=3, radius=1.0):
+    t = (1 + np.sqrt(5)) / 2
+    verts = np.array([
+        [-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0], [0, -1, t], [0, 1, t],
+        [0, -1, -t], [0, 1, -t], [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], dtype=np.float64)
+    faces = np.array([
+        [0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11], [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6],
+        [7, 1, 8], [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9], [4, 9, 5], [2, 4, 11], [6, 2, 10],
+        [8, 6, 7], [9, 8, 1]], dtype=np.int64)
+    verts /= np.linalg.norm(verts, axis=1)[:, np.newaxis]
+    for _ in range(order):
+        # Splits every face into 4, where the new vertices are the (projected) edges midpoints
+        edges = np.sort(np.vstack((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]])), axis=1)
+        uniq_edges, edges_inds = np.unique(edges, axis=0, return_inverse=True)
+        mids = verts[uniq_edges].mean(axis=1)
+        mids /= np.linalg.norm(mids, axis=1)[:, np.newaxis]
+        a, b, c = len(verts) + edges_inds.reshape((3, -1))
+        v0, v1, v2 = faces.T
+        verts = np.vstack((verts, mids))
+        faces = np.vstack((np.column_stack((v0, a, c)), np.column_stack((v1, b, a)),
+                           np.column_stack((v2, c, b)), np.column_stack((a, b, c))))
+    return verts * radius, faces
+
+
+def calc_verts_neighbors(faces, verts_num):
+    # A list of the neighbors array of every vertex
+    edges = np.vstack((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]))
+    edges = np.unique(np.vstack((edges, edges[:, ::-1])), axis=0)
+    splits = np.searchsorted(edges[:, 0], np.arange(1, verts_num))
+    return np.split(edges[:, 1], splits)
+
+
+def random_labels_ids(verts, labels_num, seed=0):
+    # Voronoi parcellation of the sphere around labels_num random seed vertices. Label 0 is the unknown label
+    rs = np.random.RandomState(seed)
+    units = verts / np.linalg.norm(verts, axis=1)[:, np.newaxis]
+    seeds = units[rs.choice(len(verts), labels_num, replace=False)]
+    labels_ids = np.zeros(len(verts), dtype=np.int32)
+    for from_ind in range(0, len(verts), 100000):
+        labels_ids[from_ind:from_ind + 100000] = np.argmax(units[from_ind:from_ind + 100000].dot(seeds.T), axis=1)
+    return labels_ids
+
+
+def get_labels_names(labels_num):
+    return ['unknown'] + ['label{:03d}'.format(ind) for ind in range(1, labels_num)]
+
+
+def write_annot(annot_fname, labels_ids, labels_names, seed=0):
+    import nibabel as nib
+    rs = np.random.RandomState(seed)
+    ctab = np.zeros((len(labels_names), 5), dtype=np.int32)
+    ctab[:, :3] = rs.randint(0, 256, (len(labels_names), 3))
+    nib.freesurfer.write_annot(annot_fname, labels_ids, ctab, labels_names, fill_ctab=True)
+
+
+def create_labels(verts, labels_ids, labels_names, hemi):
+    from src.utils import labels_utils as lu
+    labels = []
+    for label_id, label_name in enumerate(labels_names):
+        vertices = np.where(labels_ids == label_id)[0]
+        if len(vertices) == 0:
+            continue
+        labels.append(lu.Label(vertices, verts[vertices], np.ones(len(vertices)), hemi,
+                               name='{}-{}'.format(label_name, hemi)))
+    return labels
+
+
+def calc_stc_data(verts_num, T, sfreq=100, seed=0):
+    # Sources time courses: a few random oscillators mixed into every vertex, with white noise
+    rs = np.random.RandomState(seed)
+    times = np.arange(T) / sfreq
+    sources = np.sin(2 * np.pi * rs.uniform(1, 30, (8, 1)) * times + rs.uniform(0, 2 * np.pi, (8, 1)))
+    mixing = rs.randn(verts_num, len(sources)).astype(np.float32)
+    return mixing.dot(sources.astype(np.float32)) + rs.randn(verts_num, T).astype(np.float32)
+
+
+def calc_labels_data(stc_data, labels_ids, labels_names, hemi):
+    labels_num = len(labels_names)
+    counts = np.bincount(labels_ids, minlength=labels_num)
+    sums = np.zeros((labels_num, stc_data.shape[1]), dtype=np.float64)
+    np.add.at(sums, labels_ids, stc_data)
+    non_empty = counts > 0
+    data = sums[non_empty] / counts[non_empty, np.newaxis]
+    names = np.array(['{}-{}'.format(name, hemi) for name, ok in zip(labels_names, non_empty) if ok])
+    return data, names
+
+
+def calc_4d_volume(shape=(64, 64, 48), T=100, seed=0):
+    rs = np.random.RandomState(seed)
+    return rs.randn(*shape, T).astype(np.float32)
+
+
+def verts_to_voxels(verts, shape, margin=0):
+    # Maps the surface vertices into the volume's voxels, [margin, shape - 1 - margin] in every dim (the volume is
+    # centered on the surfaces)
+    verts = verts - verts.min(axis=0)
+    scale = (np.array(shape) - 1 - 2 * margin) / np.maximum(verts.max(axis=0), 1e-6)
+    return np.rint(verts * scale).astype(np.int64) + margin
+
+
+def get_labels_data_name(atlas):
+    return 'labels_data_{}_mean_{}.npz'.format(atlas, '{hemi}')
+
+
+def create_subject(root_fol, subject, order=3, labels_num=35, atlas='synthetic', T=500, volume_shape=(64, 64, 48),
+                   volume_T=50, seed=0):
+    # Writes the synthetic subject into root_fol/subjects and root_fol/mmvt, and returns its in-memory data
+    import nibabel as nib
+    subjects_dir, mmvt_dir = op.join(root_fol, 'subjects'), op.join(root_fol, 'mmvt')
+    surf_fol = utils.make_dir(op.join(subjects_dir, subject, 'surf'))
+    label_fol = utils.make_dir(op.join(subjects_dir, subject, 'label'))
+    mmvt_surf_fol = utils.make_dir(op.join(mmvt_dir, subject, 'surf'))
+    npz_surf_fol = utils.make_dir(op.join(mmvt_dir, subject, 'surf_npz'))
+    fmri_fol = utils.make_dir(op.join(mmvt_dir, subject, 'fmri'))
+    labels_names = get_labels_names(labels_num)
+    sphere_verts, faces = icosphere(order, SURF_RADIUS)
+    subject_data = dict(subject=subject, order=order, atlas=atlas, labels_names=labels_names, verts={}, faces={},
+                        labels_ids={}, labels={}, neighbors={}, stc={})
+    for hemi_ind, hemi in enumerate(utils.HEMIS):
+        verts = sphere_verts + [HEMIS_OFFSETS[hemi], 0, 0]
+        labels_ids = random_labels_ids(verts, labels_num, seed + hemi_ind)
+        nib.freesurfer.write_geometry(op.join(surf_fol, '{}.pial'.format(hemi)), verts, faces)
+        write_annot(op.join(label_fol, '{}.{}.annot'.format(hemi, atlas)), labels_ids, labels_names, seed)
+        # The text ply is read by the ply reader, the npz one by the npz reader
+        utils.write_ply_file(verts, faces, op.join(mmvt_surf_fol, '{}.pial.ply'.format(hemi)))
+        utils.write_ply_file(verts, faces, op.join(npz_surf_fol, '{}.pial.ply'.format(hemi)), True)
+        stc_data = calc_stc_data(len(verts), T, seed=seed + hemi_ind)
+        np.save(op.join(fmri_fol, 'stc_{}.npy'.format(hemi)), stc_data)
+        labels_data, names = calc_labels_data(stc_data, labels_ids, labels_names, hemi)
+        np.savez(op.join(fmri_fol, get_labels_data_name(atlas).format(hemi=hemi)), data=labels_data, names=names,
+                 conditions=['rest'])
+        subject_data['verts'][hemi], subject_data['faces'][hemi] = verts, faces
+        subject_data['labels_ids'][hemi] = labels_ids
+        subject_data['labels'][hemi] = create_labels(verts, labels_ids, labels_names, hemi)
+        subject_data['neighbors'][hemi] = calc_verts_neighbors(faces, len(verts))
+        subject_data['stc'][hemi] = stc_data
+    volume = calc_4d_volume(volume_shape, volume_T, seed)
+    volume_fname = op.join(fmri_fol, '{}_4d.nii.gz'.format(subject))
+    nib.save(nib.Nifti1Image(volume, np.eye(4)), volume_fname)
+    subject_data['volume_fname'] = volume_fname
+    return subject_data
@@ -31,7 +31,7 @@ def calc_meg_source_psd(args):
         if subject in bad_subjects:
             continue
         fol = op.join(MMVT_DIR, subject, 'meg')
-        file_name = '{cond}_dSPM_mean_flip_vertices_power_spectrum.pkl'
+        file_name = '{cond}_dSPM_mean_flip_vertices_power_spectrum.npy'
         if all([op.isfile(op.join(fol, file_name.format(cond=cond.lower())))
                 for cond in MSIT_CONDS]) and not args.overwrite:
             print('{}: already has MSIT power stcs'.format(subject))
@@ -83,7 +83,7 @@ def calc_meg_source_psd(args):
             epochs = subject_epochs[indices[cond]]
             meg.calc_source_power_spectrum(
                 subject, cond.lower(), epochs=epochs, max_epochs_num=50, inv_fname=inv_fname,
-                overwrite=args.overwrite, n_jobs=args.n_jobs)
+                save_vertices_data=True, overwrite=args.overwrite, n_jobs=args.n_jobs)
 
 
 def calc_source_ttest(args):
@@ -98,55 +98,41 @@ def calc_source_ttest(args):
 
 
 @utils.timeit
-def _calc_source_ttest(subject):
+def _calc_source_ttest(subject, vertices_chunk_size=1000):
     fol = op.join(MMVT_DIR, subject, 'meg')
     output_fname = op.join(fol, 'dSPM_mean_flip_vertices_power_spectrum_stat')
     if utils.both_hemi_files_exist('{}-{}.stc'.format(output_fname, '{hemi}')) and not args.overwrite:
         print('{} already exist'.format(output_fname))
         return True
-    file_name = '{cond}_dSPM_mean_flip_vertices_power_spectrum.pkl'
-    if not all([op.isfile(op.join(fol, file_name.format(cond=cond.lower())))
-            for cond in MSIT_CONDS]):
-        print('No stc files for both conditions!')
-        return False
-    vertices_data = {}
-    try:
-        for cond in MSIT_CONDS:
-            vertices_data[cond], freqs = utils.load(op.join(fol, file_name.format(cond=cond.lower())))
-    except:
-        print('Can\'t read {}'.format(file_name.format(cond=cond.lower())))
-        return False
-    pvals, vertno = {}, {}
-    for hemi in utils.HEMIS:
-        vertices_inds = {}
-        pvals[hemi] = np.zeros((len(vertices_data[MSIT_CONDS[0]][hemi].keys()), len(freqs)))
-        for cond in MSIT_CONDS:
-            vertices_inds[cond] = np.array(sorted(list(vertices_data[cond][hemi].keys())))
-        if not np.all(vertices_inds[MSIT_CONDS[0]] == vertices_inds[MSIT_CONDS[1]]):
-            raise Exception('Not the same vertices!')
-        vertno[hemi] = vertices_inds[MSIT_CONDS[0]]
-        params = [(vert_ind, vertices_data[MSIT_CONDS[0]][hemi][vert], vertices_data[MSIT_CONDS[1]][hemi][vert], len(freqs)) \
-            for vert_ind, vert in enumerate(vertices_data[MSIT_CONDS[0]][hemi].keys())]
-        results = utils.run_parallel(calc_vert_pvals, params, args.n_jobs)
-        for vert_pvals, vert_ind in results:
-            pvals[hemi][vert_ind, :] = vert_pvals
-
-    data = np.concatenate([pvals['lh'], pvals['rh']])
-    vertices = [vertno['lh'], vertno['rh']]
-    stc_pvals = mne.SourceEstimate(data, vertices, freqs[0], freqs[1] - freqs[0], subject=subject)
+    file_name = '{cond}_dSPM_mean_flip_vertices_power_spectrum.npy'
+    vertices_data, meta = {}, {}
+    for cond in MSIT_CONDS:
+        # epochs x vertices x freqs memmap
+        vertices_data[cond], meta[cond] = meg.load_vertices_power_spectrum(
+            op.join(fol, file_name.format(cond=cond.lower())))
+        if vertices_data[cond] is None:
+            print('Can\'t find {}!'.format(file_name.format(cond=cond.lower())))
+            return False
+    cond1, cond2 = MSIT_CONDS
+    if not all([np.array_equal(meta[cond1][vertno], meta[cond2][vertno]) for vertno in ['lh_vertno', 'rh_vertno']]):
+        raise Exception('Not the same vertices!')
+    freqs = meta[cond1].frequencies
+    vertices_num = vertices_data[cond1].shape[1]
+    pvals = np.zeros((vertices_num, len(freqs)))
+    # The t-tests of all the frequencies of a chunk of vertices at once, reading only that chunk from the disk
+    for from_ind in range(0, vertices_num, vertices_chunk_size):
+        to_ind = min(from_ind + vertices_chunk_size, vertices_num)
+        _, chunk_pvals = scipy.stats.ttest_ind(
+            vertices_data[cond1][:, from_ind:to_ind], vertices_data[cond2][:, from_ind:to_ind], axis=0,
+            equal_var=False)
+        pvals[from_ind:to_ind] = -np.log10(chunk_pvals)
+
+    vertices = [meta[cond1].lh_vertno, meta[cond1].rh_vertno]
+    stc_pvals = mne.SourceEstimate(pvals, vertices, freqs[0], freqs[1] - freqs[0], subject=subject)
     print('Writing to {}'.format(output_fname))
     stc_pvals.save(output_fname)
 
 
-def calc_vert_pvals(p):
-    vert_ind, vert_data1, vert_data2, freqs_len = p
-    pvals = np.zeros((freqs_len))
-    for freq_ind in range(freqs_len):
-        t, pval = scipy.stats.ttest_ind(vert_data1[:, freq_ind], vert_data2[:, freq_ind], equal_var=False)
-        pvals[freq_ind] = -np.log10(pval)
-    return pvals, vert_ind
-
-
 
 # def morph_stcs_pvals(args):
 #     utils.run_parallel(_morph_stcs_pvals, args.subject, args.n_jobs)
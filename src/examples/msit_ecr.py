@@ -387,9 +387,10 @@ def meg_preproc_power(args):
         input_fol = utils.make_dir(op.join(MEG_DIR, subject, 'labels_induced_power'))
         for task in args.tasks:
             vertices_data_fname = op.join(
-                fol, '{}_{}_{}_vertices_power_spectrum.pkl'.format(task.lower(), inv_method, em))
-            if op.isfile(vertices_data_fname):
-                os.remove(vertices_data_fname)
+                fol, '{}_{}_{}_vertices_power_spectrum.npy'.format(task.lower(), inv_method, em))
+            for fname in [vertices_data_fname, vertices_data_fname.replace('.npy', '_meta.npz')]:
+                if op.isfile(fname):
+                    os.remove(fname)
             # output_fname = op.join(MMVT_DIR, subject, 'meg', '{}_{}_{}_power_spectrum.npz'.format(
             #     task.lower(), inv_method, em))
             # if op.isfile(output_fname) and args.check_file_modification_time:
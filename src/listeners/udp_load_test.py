@@ -0,0 +1,268 @@
+import socket
+import struct
+import pickle
+import time
+import threading
+import multiprocessing
+import numpy as np
+from queue import Queue, Empty
+
+from src.utils import args_utils as au
+
+PORT = 45454
+MULTICAST_GROUP = '239.255.43.21'
+# Every frame starts with its sequence number and its sending time (time.time()), both as float64 like the samples,
+# followed by the channels x samples matrix (channels first)
+FRAME_HEADER_LEN = 2
+
+
+class Bag(dict):
+    # A dict with d.key short for d['key'] (like utils.Bag, without importing all of utils and its dependencies)
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.__dict__ = self
+
+
+def create_frame(seq, samples):
+    return np.concatenate(([seq, time.time()], np.ravel(samples))).astype(np.float64).tobytes()
+
+
+def parse_frame(frame, channels_num):
+    values = np.frombuffer(frame, dtype=np.float64)
+    samples = values[FRAME_HEADER_LEN:]
+    if channels_num > 0 and len(samples) % channels_num == 0:
+        samples = samples.reshape((channels_num, -1))
+    return int(values[0]), values[1], samples
+
+
+def calc_samples_per_packet(channels_num, packet_size):
+    # How many samples per channel fit in a packet of packet_size bytes
+    return max(1, (packet_size // 8 - FRAME_HEADER_LEN) // channels_num)
+
+
+def generate_data(channels_num, sfreq, samples_num, t_start=0):
+    # Synthetic sines (each channel with a different frequency) with noise
+    t = (t_start + np.arange(samples_num)) / sfreq
+    freqs = np.linspace(1, 40, channels_num)[:, np.newaxis]
+    return np.sin(2 * np.pi * freqs * t) + 0.1 * np.random.randn(channels_num, samples_num)
+
+
+def bind_sender(multicast=True, ttl=1):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    if multicast:
+        # Keep the frames on the loopback interface
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton('127.0.0.1'))
+    return sock
+
+
+def bind_receiver(port=PORT, multicast_group=MULTICAST_GROUP, multicast=True, rcvbuf_size=0):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if rcvbuf_size > 0:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf_size)
+    if multicast:
+        sock.bind(('', port))
+        mreq = struct.pack('4s4s', socket.inet_aton(multicast_group), socket.inet_aton('127.0.0.1'))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    else:
+        sock.bind(('localhost', port))
+    return sock
+
+
+def send_frames(channels_num=64, sfreq=1000, packet_size=1400, duration=10, port=PORT,
+                multicast_group=MULTICAST_GROUP, multicast=True, sent_num=None):
+    # Sends the frames on a fixed schedule (not a fixed sleep), so the rate doesn't drift with the sending time
+    sock = bind_sender(multicast)
+    address = (multicast_group if multicast else 'localhost', port)
+    samples_per_packet = calc_samples_per_packet(channels_num, packet_size)
+    packets_num = int(duration * sfreq / samples_per_packet)
+    packet_interval = samples_per_packet / sfreq
+    data = generate_data(channels_num, sfreq, int(max(sfreq, 2 * samples_per_packet)))
+    t_start = time.time()
+    for seq in range(packets_num):
+        wait = t_start + seq * packet_interval - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        ind = (seq * samples_per_packet) % max(1, data.shape[1] - samples_per_packet)
+        sock.sendto(create_frame(seq, data[:, ind:ind + samples_per_packet]), address)
+        if sent_num is not None:
+            sent_num.value = seq + 1
+    sock.close()
+    return packets_num
+
+
+class ReaderStandIn(object):
+    # Stands in for streaming_panel.udp_reader: decodes the frames, stacks them into buffers of buffer_size
+    # samples and puts the buffers in the queue. The frames' headers are kept aside for the statistics.
+    def __init__(self, sock, udp_queue, channels_num, buffer_size=1, recv_size=2 ** 16, timeout=0.1):
+        self.sock, self.udp_queue = sock, udp_queue
+        self.channels_num, self.buffer_size = channels_num, buffer_size
+        self.recv_size, self.timeout = recv_size, timeout
+        self.received_num, self.truncated_num, self.bytes_num = 0, 0, 0
+        self.seqs = []
+        self.running = True
+
+    def run(self):
+        self.sock.settimeout(self.timeout)
+        buffer, buffer_headers = [], []
+        while self.running:
+            try:
+                frame = self.sock.recv(self.recv_size)
+            except socket.timeout:
+                continue
+            self.received_num += 1
+            self.bytes_num += len(frame)
+            seq, send_time, samples = parse_frame(frame, self.channels_num)
+            if samples.ndim != 2:
+                self.truncated_num += 1
+                continue
+            self.seqs.append(seq)
+            buffer.append(samples)
+            buffer_headers.append((seq, send_time))
+            if sum(b.shape[1] for b in buffer) >= self.buffer_size:
+                self.udp_queue.put((np.hstack(buffer), buffer_headers))
+                buffer, buffer_headers = [], []
+
+
+class DisplayStandIn(object):
+    # Stands in for streaming_panel.change_graph_all_vals: pulls the buffers from the queue and writes them sample
+    # by sample into a cyclic (channels x max_steps) array, like the fcurves keyframes, optionally with an extra
+    # per channel-sample cost. The latency is measured when a frame's buffer is displayed.
+    def __init__(self, udp_queue, channels_num, max_steps=2000, sample_cost=0):
+        self.udp_queue = udp_queue
+        self.display = np.zeros((channels_num, max_steps))
+        self.sample_cost = sample_cost
+        self.curr_t = 0
+        self.latencies, self.queue_depths = [], []
+        self.displayed_samples = 0
+        self.running = True
+
+    def run(self):
+        while self.running or not self.udp_queue.empty():
+            try:
+                mat, headers = self.udp_queue.get(timeout=0.1)
+            except Empty:
+                continue
+            self.queue_depths.append(self.udp_queue.qsize())
+            T, max_steps = mat.shape[1], self.display.shape[1]
+            for ch_ind in range(mat.shape[0]):
+                for ind in range(T):
+                    self.display[ch_ind, (self.curr_t + ind) % max_steps] = mat[ch_ind, ind]
+            if self.sample_cost > 0:
+                time.sleep(self.sample_cost * mat.size)
+            self.curr_t = (self.curr_t + T) % max_steps
+            self.displayed_samples += T
+            now = time.time()
+            self.latencies.extend([now - send_time for _, send_time in headers])
+
+
+def calc_seqs_stats(seqs, sent_num):
+    seqs = np.array(seqs, dtype=np.int64)
+    unique_seqs = np.unique(seqs)
+    return Bag(dict(
+        lost=sent_num - len(unique_seqs), duplicated=len(seqs) - len(unique_seqs),
+        out_of_order=int(np.sum(np.diff(seqs) < 0)) if len(seqs) > 1 else 0))
+
+
+def run_load_test(channels_num=64, sfreq=1000, packet_size=1400, duration=10, buffer_size=10, multicast=True,
+                  port=PORT, multicast_group=MULTICAST_GROUP, recv_size=2 ** 16, sample_cost=0, max_steps=2000,
+                  rcvbuf_size=0, drain_time=1):
+    # The sender runs in its own process, the reader and the display in two threads, like in the streaming panel
+    sock = bind_receiver(port, multicast_group, multicast, rcvbuf_size)
+    udp_queue = Queue()
+    reader = ReaderStandIn(sock, udp_queue, channels_num, buffer_size, recv_size)
+    display = DisplayStandIn(udp_queue, channels_num, max_steps, sample_cost)
+    threads = [threading.Thread(target=reader.run), threading.Thread(target=display.run)]
+    for thread in threads:
+        thread.start()
+    sent_num = multiprocessing.Value('l', 0)
+    sender = multiprocessing.Process(target=send_frames, args=(
+        channels_num, sfreq, packet_size, duration, port, multicast_group, multicast, sent_num))
+    now = time.time()
+    sender.start()
+    sender.join()
+    send_time = time.time() - now
+    time.sleep(drain_time)
+    reader.running = False
+    threads[0].join()
+    display.running = False
+    threads[1].join()
+    sock.close()
+
+    samples_per_packet = calc_samples_per_packet(channels_num, packet_size)
+    latencies = np.array(display.latencies) * 1000
+    queue_depths = np.array(display.queue_depths) if len(display.queue_depths) > 0 else np.zeros(1)
+    stats = calc_seqs_stats(reader.seqs, sent_num.value)
+    stats.update(dict(
+        channels_num=channels_num, sfreq=sfreq, packet_size=(samples_per_packet * channels_num + 2) * 8,
+        samples_per_packet=samples_per_packet, sent=sent_num.value, received=reader.received_num,
+        truncated=reader.truncated_num, loss=1 - len(np.unique(reader.seqs)) / max(sent_num.value, 1),
+        packets_per_sec=reader.received_num / send_time, mb_per_sec=reader.bytes_num / send_time / 2 ** 20,
+        displayed_sfreq=display.displayed_samples / send_time,
+        queue_depth_mean=np.mean(queue_depths), queue_depth_max=np.max(queue_depths),
+        latency_ms={p: np.percentile(latencies, p) if len(latencies) > 0 else np.nan for p in [50, 90, 99, 100]}))
+    return stats
+
+
+def print_report(stats):
+    print('{channels_num} channels, {sfreq} Hz, {samples_per_packet} samples per packet ({packet_size} bytes)'.format(
+        **stats))
+    print('  sent {sent}, received {received}, lost {lost} ({loss:.2%}), truncated {truncated}, duplicated '
+          '{duplicated}, out of order {out_of_order}'.format(**stats))
+    print('  throughput: {packets_per_sec:.1f} packets/s, {mb_per_sec:.2f} MB/s, displayed {displayed_sfreq:.1f} '
+          'samples/s'.format(**stats))
+    print('  queue depth: mean {queue_depth_mean:.1f}, max {queue_depth_max}'.format(**stats))
+    print('  latency (ms): ' + ', '.join(['p{}: {:.2f}'.format(p if p < 100 else 'max', l)
+                                         for p, l in stats['latency_ms'].items()]))
+
+
+def sustainable(stats, max_loss=0.01, max_latency=100):
+    return stats['loss'] <= max_loss and stats['latency_ms'][99] <= max_latency
+
+
+def main(args):
+    results = []
+    for channels_num in args.channels:
+        for sfreq in args.sfreqs:
+            stats = run_load_test(
+                channels_num, sfreq, args.packet_size, args.duration, args.buffer_size, args.multicast, args.port,
+                args.multicast_group, args.recv_size, args.sample_cost, args.max_steps, args.rcvbuf_size)
+            print_report(stats)
+            results.append(stats)
+    if args.output_fname != '':
+        with open(args.output_fname, 'wb') as fp:
+            pickle.dump([dict(stats) for stats in results], fp)
+    ok = [s for s in results if sustainable(s, args.max_loss, args.max_latency)]
+    if len(ok) > 0:
+        best = max(ok, key=lambda s: s['channels_num'] * s['sfreq'])
+        print('Max sustainable load: {} channels at {} Hz'.format(best['channels_num'], best['sfreq']))
+    else:
+        print('None of the loads is sustainable!')
+    return results
+
+
+def read_cmd_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='UDP streaming load test')
+    parser.add_argument('-c', '--channels', required=False, default='64', type=au.int_arr_type)
+    parser.add_argument('-r', '--sfreqs', required=False, default='1000', type=au.int_arr_type)
+    parser.add_argument('--packet_size', required=False, default=1400, type=int)
+    parser.add_argument('-d', '--duration', required=False, default=10, type=float)
+    parser.add_argument('-b', '--buffer_size', required=False, default=10, type=int)
+    parser.add_argument('--multicast', required=False, default=1, type=au.is_true)
+    parser.add_argument('--port', required=False, default=PORT, type=int)
+    parser.add_argument('--multicast_group', required=False, default=MULTICAST_GROUP)
+    parser.add_argument('--recv_size', required=False, default=2 ** 16, type=int)
+    parser.add_argument('--rcvbuf_size', required=False, default=0, type=int)
+    parser.add_argument('--sample_cost', required=False, default=0, type=float)
+    parser.add_argument('--max_steps', required=False, default=2000, type=int)
+    parser.add_argument('--max_loss', required=False, default=0.01, type=float)
+    parser.add_argument('--max_latency', required=False, default=100, type=float)
+    parser.add_argument('-o', '--output_fname', required=False, default='')
+    return Bag(au.parse_parser(parser, argv))
+
+
+if __name__ == '__main__':
+    main(read_cmd_args())
@@ -113,9 +113,11 @@ def lock_colorbar_values(val=True):
 
 
 def load_colormap():
-    colormap_fname = op.join(mu.file_fol(), 'color_maps', '{}.npy'.format(
-        bpy.context.scene.colorbar_files)) # .replace('-', '_')
-    colormap = np.load(colormap_fname)
+    # The colorbar was changed, so the cached lookup table is reloaded from the disk
+    mu.invalidate_colormap_lut(bpy.context.scene.colorbar_files)
+    colormap = mu.get_colormap_lut(bpy.context.scene.colorbar_files)
+    if colormap is None:
+        return
     ColorbarPanel.cm = colormap
     for ind in range(colormap.shape[0]):
         cb_obj_name = 'cb.{0:0>3}'.format(ind)
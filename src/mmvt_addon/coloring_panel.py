@@ -454,9 +454,9 @@ def color_objects_homogeneously(data, names, conditions, data_min, colors_ratio,
         return
     if names is None:
         data, names, conditions = data['data'], data['names'], data['conditions']
-    default_color = (1, 1, 1)
     if cur_frame is None:
         cur_frame = bpy.context.scene.frame_current
+    objs, objs_values = [], []
     for obj_name, values in zip(names, data):
         if not isinstance(obj_name, str):
             obj_name = obj_name.astype(str)
@@ -471,8 +471,6 @@ def color_objects_homogeneously(data, names, conditions, data_min, colors_ratio,
             value = np.diff(values[t_ind])[0] if values.shape[1] > 1 else np.squeeze(values[t_ind])
         # todo: there is a difference between value and real_value, what should we do?
         # real_value = mu.get_fcurve_current_frame_val('Deep_electrodes', obj_name, cur_frame)
-        new_color = calc_colors([value], data_min, colors_ratio)[0] if abs(value) >= threshold else default_color
-        # new_color = calc_colors([value], data_min, colors_ratio)[0]
         # todo: check if the stat should be avg or diff
         obj = bpy.data.objects.get(obj_name.replace(' ', '') + postfix_str)
         if obj is None:
@@ -480,13 +478,17 @@ def color_objects_homogeneously(data, names, conditions, data_min, colors_ratio,
             continue
         if obj.hide:
             print('you are coloring {}, but it is hiding!'.format(obj.name))
+        objs.append(obj)
+        objs_values.append(value)
+    if len(objs) == 0:
+        return
+    # All the objects are colored with one lookup in the colormap
+    new_colors = calc_colors(objs_values, data_min, colors_ratio, threshold=threshold, bigger_or_equall=True)
+    for obj, new_color in zip(objs, new_colors):
         # print('{}: {}'.format(obj.name, new_color))
         ret = object_coloring(obj, new_color)
         # if not ret:
         #     print('color_objects_homogeneously: Error in coloring the object {}!'.format(obj_name))
-            # print(obj_name, value, new_color)
-        # else:
-        #     print('color_objects_homogeneously: {} was not loaded!'.format(obj_name))
 
     # print('Finished coloring!!')
 
@@ -672,7 +674,8 @@ def static_conn_files_update(self, context):
     else:
         fname = fnames[0]
     if fname.endswith('.npy'):
-        ColoringMakerPanel.static_conn = np.load(fname)
+        # Decodes the reduced precision (quantized) connectivity files
+        ColoringMakerPanel.static_conn = mu.upcast(mu.load_storage_npy(fname))
     elif fname.endswith('.npz'):
         d = np.load(fname)
         if 'con' in d:
@@ -967,8 +970,11 @@ def plot_activity(map_type, faces_verts, threshold, meg_sub_activity=None,
                 colors_ratio = ColoringMakerPanel.fmri_activity_colors_ratio
                 data_min, data_max = ColoringMakerPanel.fmri_activity_data_minmax
                 cb_title = 'fMRI'
-            if op.isfile(fname):
+            store_fol = mu.get_activity_store_fol(mu.get_fname_folder(fname))
+            f = mu.read_activity_frame(store_fol, t) if mu.activity_store_exists(store_fol, 'frames') else None
+            if f is None and op.isfile(fname):
                 f = np.load(fname)
+            if f is not None:
                 if _addon().colorbar_values_are_locked():
                     data_max, data_min = _addon().get_colorbar_max_min()
                     colors_ratio = 256 / (data_max - data_min)
@@ -1123,21 +1129,23 @@ def get_obj_color_data(obj, color, val=1):
 
 
 def calc_color(value, min_data=None, colors_ratio=None, cm=None):
-    return calc_colors([value], min_data=None, colors_ratio=None, cm=None)[0]
+    return calc_colors([value], min_data, colors_ratio, cm)[0]
 
 
-def calc_colors(vert_values, min_data=None, colors_ratio=None, cm=None):
+def calc_colors(vert_values, min_data=None, colors_ratio=None, cm=None, threshold=None, bigger_or_equall=False,
+                default_color=(1, 1, 1)):
     if cm is None:
         cm = _addon().get_cm()
     if isinstance(cm, str):
-        colormap_fname = op.join(mu.file_fol(), 'color_maps', '{}.npy'.format(cm))
-        cm = np.load(colormap_fname) if op.isfile(colormap_fname) else None
+        cm = mu.get_colormap_lut(cm)
     if cm is None:
         return np.zeros((len(vert_values), 3))
     if min_data is None:
         max_data, min_data = _addon().colorbar.get_colorbar_max_min()
         colors_ratio = 256 / (max_data - min_data)
-    return mu.calc_colors_from_cm(vert_values, min_data, colors_ratio, cm)
+    return mu.values_to_colors(
+        vert_values, min_data, colors_ratio, cm, threshold=threshold, bigger_or_equall=bigger_or_equall,
+        default_color=default_color)
 
 
 def sym_gauss_2D(x0,y0,sigma):
@@ -2445,8 +2453,8 @@ def draw(self, context):
         layout.prop(context.scene, 'remove_unknown_from_plotting', text='Remove unknown labels')
 
     if faces_verts_exist:
-        meg_current_activity_data_exist = mu.hemi_files_exists(
-            op.join(user_fol, 'activity_map_{hemi}', 't{}.npy'.format(bpy.context.scene.frame_current)))
+        meg_current_activity_data_exist = all([mu.activity_frame_exists(
+            op.join(user_fol, 'activity_map_{}'.format(hemi)), bpy.context.scene.frame_current) for hemi in mu.HEMIS])
         if ColoringMakerPanel.meg_activity_data_exist and meg_current_activity_data_exist or \
                 ColoringMakerPanel.stc_file_exist:
             col = layout.box().column()
@@ -2745,8 +2753,8 @@ def init_meg_activity_map():
     for activity_type in activity_types:
         if activity_type != '':
             activity_type = activity_type[:-1]
-        meg_files_exist = len(glob.glob(op.join(user_fol, 'activity_map_{}rh'.format(activity_type), 't*.npy'))) > 0 and \
-                          len(glob.glob(op.join(user_fol, 'activity_map_{}lh'.format(activity_type), 't*.npy'))) > 0
+        meg_files_exist = all([mu.activity_files_exist(op.join(user_fol, 'activity_map_{}{}'.format(
+            activity_type, hemi))) for hemi in mu.HEMIS])
         meg_data_maxmin_fname = op.join(mu.get_user_fol(), 'meg_activity_map_{}minmax.pkl'.format(activity_type))
         if meg_files_exist and op.isfile(meg_data_maxmin_fname):
             data_min, data_max = mu.load(meg_data_maxmin_fname)
@@ -2796,7 +2804,8 @@ def create_stc_files_list(list_items=[]):
 
 def init_fmri_activity_map():
     user_fol = mu.get_user_fol()
-    fmri_files_exist = mu.hemi_files_exists(op.join(user_fol, 'fmri', 'activity_map_{hemi}', 't0.npy'))
+    fmri_files_exist = all([mu.activity_frame_exists(op.join(user_fol, 'fmri', 'activity_map_{}'.format(hemi)), 0)
+                            for hemi in mu.HEMIS])
     fmri_data_maxmin_fname = op.join(user_fol, 'fmri', 'activity_map_minmax.npy')
     if fmri_files_exist and op.isfile(fmri_data_maxmin_fname):
         ColoringMakerPanel.fmri_activity_map_exist = True
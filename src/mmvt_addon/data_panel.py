@@ -319,7 +319,7 @@ def create_empty_if_doesnt_exists(name, brain_layer=None, layers_array=None, par
 
 
 @mu.tryit()
-def import_rois(base_path, selected_inputs=None):
+def import_rois(base_path, selected_inputs=None, batch_size=50, progress_callback=None):
     if selected_inputs is None:
         anatomy_inputs = {
             'Cortex-rh': op.join(base_path, 'labels', '{}.pial.rh'.format(bpy.context.scene.atlas)),
@@ -339,53 +339,70 @@ def import_rois(base_path, selected_inputs=None):
         create_empty_if_doesnt_exists(name, brain_layer, layers_array)
     bpy.context.scene.layers = [ind == DataMakerPanel.addon.ROIS_LAYER for ind in range(len(bpy.context.scene.layers))]
 
-    # todo: check each hemi
-    inflated_imported = False
+    plys = []
     for anatomy_name, anatomy_input_base_path in anatomy_inputs.items():
         if not op.isdir(anatomy_input_base_path):
             mu.log_err('import_rois: The anatomy folder {} does not exist'.format(anatomy_input_base_path), logging)
             continue
-        current_mat = bpy.data.materials['unselected_label_Mat_cortex']
-        if anatomy_name in ['Subcortical_structures', 'Cerebellum']:
-            current_mat = bpy.data.materials['unselected_label_Mat_subcortical']
-        print('importing from {}'.format(anatomy_input_base_path))
-        for ply_fname in glob.glob(op.join(anatomy_input_base_path, '*.ply')):
+        plys.extend([(anatomy_name, anatomy_input_base_path, ply_fname) for ply_fname in
+                     glob.glob(op.join(anatomy_input_base_path, '*.ply'))])
+    if progress_callback is None:
+        progress_callback = _import_rois_progress
+    wm = bpy.context.window_manager
+    wm.progress_begin(0, max(len(plys), 1))
+    # The objects are created in batches, and the progress is reported after each batch
+    parents_to_fix = set()
+    for batch_ind in range(0, len(plys), batch_size):
+        for anatomy_name, anatomy_input_base_path, ply_fname in plys[batch_ind:batch_ind + batch_size]:
             try:
-                new_obj_name = mu.namebase(ply_fname)
-                fol_name = anatomy_input_base_path.split(op.sep)[-1]
-                surf_name = 'pial' if fol_name == 'subcortical' or len(fol_name.split('.')) == 1 else fol_name.split('.')[-2]
-                if surf_name == 'inflated':
-                    new_obj_name = '{}_{}'.format(surf_name, new_obj_name)
-                    mu.change_layer(_addon().INFLATED_ROIS_LAYER)
-                elif surf_name == 'pial':
-                    mu.change_layer(_addon().ROIS_LAYER)
-                if not bpy.data.objects.get(new_obj_name) is None:
-                    # print('{} was already imported'.format(new_obj_name))
-                    continue
-                if 'inflated' in new_obj_name:
-                    inflated_imported = True
-                bpy.ops.object.select_all(action='DESELECT')
-                # print(ply_fname)
-                bpy.ops.import_mesh.ply(filepath=op.join(anatomy_input_base_path, ply_fname))
-                cur_obj = bpy.context.selected_objects[0]
-                cur_obj.select = True
-                bpy.ops.object.shade_smooth()
-                cur_obj.parent = bpy.data.objects[anatomy_name]
-                cur_obj.scale = [0.1] * 3
-                cur_obj.active_material = current_mat
-                cur_obj.hide = False
-                cur_obj.name = new_obj_name
-                mu.fix_children_normals(anatomy_name)
+                if import_roi(anatomy_name, anatomy_input_base_path, ply_fname):
+                    parents_to_fix.add(anatomy_name)
             except:
                 mu.log_err('import_rois: Error in importing {}'.format(ply_fname), logging)
-            # cur_obj.location[0] += 5.5 if 'rh' in anatomy_name else -5.5
-            # time.sleep(0.3)
-    # if inflated_imported:
-    #     bpy.data.objects['Cortex-inflated-rh'].location[0] += 5.5
-    #     bpy.data.objects['Cortex-inflated-lh'].location[0] -= 5.5
+        progress_callback(min(batch_ind + batch_size, len(plys)), len(plys))
+    wm.progress_end()
+    for anatomy_name in parents_to_fix:
+        mu.fix_children_normals(anatomy_name)
     bpy.ops.object.select_all(action='DESELECT')
 
 
+def import_roi(anatomy_name, anatomy_input_base_path, ply_fname):
+    current_mat = bpy.data.materials['unselected_label_Mat_cortex']
+    if anatomy_name in ['Subcortical_structures', 'Cerebellum']:
+        current_mat = bpy.data.materials['unselected_label_Mat_subcortical']
+    new_obj_name = mu.namebase(ply_fname)
+    fol_name = anatomy_input_base_path.split(op.sep)[-1]
+    surf_name = 'pial' if fol_name == 'subcortical' or len(fol_name.split('.')) == 1 else fol_name.split('.')[-2]
+    layer = _addon().ROIS_LAYER
+    if surf_name == 'inflated':
+        new_obj_name = '{}_{}'.format(surf_name, new_obj_name)
+        layer = _addon().INFLATED_ROIS_LAYER
+    if not bpy.data.objects.get(new_obj_name) is None:
+        # print('{} was already imported'.format(new_obj_name))
+        return False
+    verts, faces = mu.read_mesh_file(ply_fname)
+    if verts is None:
+        # Not an ascii ply, use Blender's importer
+        mu.change_layer(layer)
+        bpy.ops.object.select_all(action='DESELECT')
+        bpy.ops.import_mesh.ply(filepath=ply_fname)
+        cur_obj = bpy.context.selected_objects[0]
+        bpy.ops.object.shade_smooth()
+        cur_obj.parent = bpy.data.objects[anatomy_name]
+        cur_obj.scale = [0.1] * 3
+        cur_obj.active_material = current_mat
+        cur_obj.hide = False
+        cur_obj.name = new_obj_name
+    else:
+        mu.create_mesh_obj(new_obj_name, verts, faces, bpy.data.objects[anatomy_name], current_mat, layer)
+    return True
+
+
+def _import_rois_progress(done_num, all_num):
+    bpy.context.window_manager.progress_update(done_num)
+    print('import_rois: {}/{}'.format(done_num, all_num))
+
+
 def create_eeg_mesh():
     eeg_mesh_fname = op.join(mu.get_user_fol(), 'eeg', 'eeg_helmet.ply')
     if not op.isfile(eeg_mesh_fname):
@@ -3,6 +3,7 @@ import numpy as np
 import os.path as op
 import time
 import mmvt_utils as mu
+import tracts_store as ts
 import os
 import glob
 from pprint import pprint
@@ -40,8 +41,17 @@ def set_dti_pathways(self=None, value=None):
         bpy.types.Scene.dti_pathways = bpy.props.EnumProperty(items=get_tracula_pathways(), description="pathways")
 
 
+def get_tracula_pathways_fnames():
+    # The tracts store files, or the legacy pickles if the pathway wasn't converted
+    fnames = {}
+    for ext in ['.pkl', ts.STORE_POSTFIX]:
+        for fname in glob.glob(op.join(SUBJECT_DTI_FOL, TRACULA, '*{}{}'.format(TRACULA_POSTFIX, ext))):
+            fnames[get_group_name(fname)] = fname
+    return fnames
+
+
 def get_tracula_pathways():
-    pathways = [get_group_name(pkl_fname) for pkl_fname in glob.glob(op.join(SUBJECT_DTI_FOL, TRACULA, '*.pkl'))]
+    pathways = list(get_tracula_pathways_fnames().keys())
     items = [(pathway, TRACULA_PATHWAYS_DIC[pathway], '', ind) for ind, pathway in enumerate(pathways)]
     items = sorted(items, key=lambda x:x[1])
     return items
@@ -53,22 +63,67 @@ def get_group_name(pkl_fname):
     return pathway
 
 
+def load_pathway_tracts(fname, lod):
+    if not fname.endswith(ts.STORE_POSTFIX):
+        # A legacy pickle of tracks, converted once into the tracts store next to it
+        fname = ts.convert_tracks_file(fname)
+    return ts.load(fname, lod)
+
+
+def create_tracts_curve(store, name, bevel_depth=0.01, resolution_u=2):
+    # One curve object with a poly spline per streamline
+    curvedata = bpy.data.curves.new(name=name, type='CURVE')
+    curvedata.dimensions = '3D'
+    curvedata.fill_mode = 'FULL'
+    curvedata.bevel_depth = bevel_depth
+    curvedata.resolution_u = resolution_u
+    coords = np.ones((store.points_num, 4), dtype=np.float32)
+    coords[:, :3] = store.points
+    for ind, length in enumerate(store.lengths):
+        if length < 2:
+            continue
+        spline = curvedata.splines.new('POLY')
+        spline.points.add(length - 1)
+        spline.points.foreach_set('co', coords[store.offsets[ind]:store.offsets[ind + 1]].ravel())
+    return bpy.data.objects.new(name, curvedata)
+
+
+def create_tracts_mesh(store, name):
+    # One mesh object with the streamlines as edges, which is much lighter than curves for big tractograms
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(store.points_num)
+    mesh.vertices.foreach_set('co', store.points.ravel())
+    edges = store.edges()
+    mesh.edges.add(len(edges))
+    mesh.edges.foreach_set('vertices', edges.ravel().astype(np.int32))
+    mesh.update()
+    return bpy.data.objects.new(name, mesh)
+
+
 def plot_pathway(self, context, layers_dti, pathway_name, pathway_type):
     if pathway_type == TRACULA:
-        pkl_fname = op.join(SUBJECT_DTI_FOL, TRACULA, '{}{}.pkl'.format(pathway_name, TRACULA_POSTFIX))
+        fname = get_tracula_pathways_fnames().get(pathway_name, '')
+        if fname == '':
+            print("Can't find the {} pathway file!".format(pathway_name))
+            return
         mu.create_empty_if_doesnt_exists(pathway_name, DTIPanel.addon.CONNECTIONS_LAYER, None, PARENT_OBJ)
         parent_obj = bpy.data.objects[pathway_name]
-        tracks = mu.load(pkl_fname)
-        N = len(tracks)
+        lod = bpy.context.scene.dti_lod
         now = time.time()
-        for ind, track in enumerate(tracks[:1000]):
-            mu.time_to_go(now, ind, N, 100)
-            track = track * 0.1
-            # pprint(track)
-            cur_obj = mu.create_spline(track, layers_dti, bevel_depth=0.01)
-            # cur_obj.scale = [0.1] * 3
-            cur_obj.name = '{}_{}'.format(pathway_name, ind)
-            cur_obj.parent = parent_obj
+        store = load_pathway_tracts(fname, lod)
+        store.points *= 0.1
+        obj_name = '{}_tracts'.format(pathway_name)
+        if bpy.data.objects.get(obj_name) is not None:
+            mu.delete_object(obj_name)
+        if bpy.context.scene.dti_draw_type == 'curve':
+            cur_obj = create_tracts_curve(store, obj_name, bpy.context.scene.dti_bevel_depth)
+        else:
+            cur_obj = create_tracts_mesh(store, obj_name)
+        bpy.context.scene.objects.link(cur_obj)
+        cur_obj.layers = layers_dti
+        cur_obj.parent = parent_obj
+        print('{}: {} tracts ({} lod) were plotted in {:.2f}s'.format(
+            pathway_name, store.tracts_num, lod, time.time() - now))
 
 
 class PlotPathway(bpy.types.Operator):
@@ -94,12 +149,23 @@ def dti_draw(self, context):
     layout = self.layout
     layout.prop(context.scene, "dti_type", text="")
     layout.prop(context.scene, "dti_pathways", text="")
+    row = layout.row(align=0)
+    row.prop(context.scene, "dti_lod", text="")
+    row.prop(context.scene, "dti_draw_type", text="")
+    if context.scene.dti_draw_type == 'curve':
+        layout.prop(context.scene, "dti_bevel_depth", text="bevel depth")
     layout.operator(PlotPathway.bl_idname, text="plot pathway", icon='POTATO')
 
 
 bpy.types.Scene.dti_type = bpy.props.EnumProperty(items=[(TRACULA, TRACULA, "", 1)], description="DTI source",
                                                   set=set_dti_pathways)
 bpy.types.Scene.dti_pathways = bpy.props.EnumProperty(items=get_tracula_pathways(), description="pathways")
+bpy.types.Scene.dti_lod = bpy.props.EnumProperty(
+    items=[(lod, lod, '', ind) for ind, lod in enumerate(ts.LODS)], default='medium',
+    description="Level of detail: high - all the tracts, medium - decimated tracts, low - the tracts clusters")
+bpy.types.Scene.dti_draw_type = bpy.props.EnumProperty(
+    items=[('curve', 'curve', '', 1), ('mesh', 'mesh', '', 2)], description="Plot the tracts as a curve or mesh edges")
+bpy.types.Scene.dti_bevel_depth = bpy.props.FloatProperty(default=0.01, min=0, max=0.2)
 
 
 class DTIPanel(bpy.types.Panel):
@@ -121,7 +187,7 @@ def check_for_dti_files():
     pathway_types = [TRACULA]
     for pathway_type in pathway_types:
         if pathway_type == TRACULA:
-            pathways = [get_group_name(pkl_fname) for pkl_fname in glob.glob(op.join(SUBJECT_DTI_FOL, TRACULA, '*.pkl'))]
+            pathways = list(get_tracula_pathways_fnames().keys())
     return len(pathways) > 0
 
 
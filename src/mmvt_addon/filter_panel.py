@@ -7,6 +7,7 @@ import glob
 import numbers
 import importlib
 from collections import defaultdict
+from traces_filters import filters_engine
 
 try:
     import connections_panel
@@ -268,6 +269,15 @@ def get_func(module_name):
     return getattr(lib, 'filter_traces')
 
 
+def get_range_func(func_name):
+    # The registered filters work on the cached traces prefix sums. Modules that define only filter_traces
+    # are still supported, and get the raw data
+    if func_name not in filters_engine.get_filters_names():
+        # Importing the filter's module registers its range function, if it has one
+        module_has_func(func_name)
+    return filters_engine.get_filter(func_name)
+
+
 def module_has_func(module_name):
     try:
         f = get_func(module_name)
@@ -283,11 +293,27 @@ def get_filter_functions():
         file_name = op.splitext(op.basename(fname))[0]
         if module_has_func(file_name):
             functions_names.append(file_name)
+    # Filters that were registered as plugins from outside the traces_filters folder
+    functions_names += [name for name in filters_engine.get_filters_names() if name not in functions_names]
     bpy.types.Scene.filter_curves_func = bpy.props.EnumProperty(
         items=[(module_name, module_name, '', k + 1) for k, module_name in enumerate(functions_names)],
         description='List of functions.\n\nCurrent function')
 
 
+def get_traces_data(cache_key, files, load_func):
+    # The traces data and its prefix sums are calculated once per data files, so changing the filter's range
+    # doesn't reload and re-sum the whole data
+    files_key = tuple((fname, op.getmtime(fname)) for fname in files if op.isfile(fname))
+    cache = FilteringMakerPanel.traces_cache.get(cache_key, None)
+    if cache is None or len(files_key) == 0 or cache[0] != files_key:
+        data, names = load_func()
+        if data is None:
+            return None, None
+        cache = (files_key, filters_engine.TracesData(data), names)
+        FilteringMakerPanel.traces_cache[cache_key] = cache
+    return cache[1], cache[2]
+
+
 def subselect_update(self=None, context=None):
     mu.filter_graph_editor(context.scene.filter_fcurves)
 
@@ -399,40 +425,42 @@ class Filtering(bpy.types.Operator):
     filter_values = []
     objs_colors = []
 
-    def get_object_to_filter(self, source_files, data=None, names=None):
-        if data is None:
-            data, names = [], []
-            for input_file in source_files:
-                try:
-                    f = np.load(input_file)
-                    data.append(f['data'])
-                    names.extend([name.astype(str) for name in f['names']])
-                except:
-                    mu.message(self, "Can't load {}!".format(input_file))
-                    return None, None, None
-
+    def load_rois_data(self, source_files):
+        data, names = [], []
+        for input_file in source_files:
+            try:
+                f = np.load(input_file)
+                data.append(f['data'])
+                names.extend([name.astype(str) for name in f['names']])
+            except:
+                mu.message(self, "Can't load {}!".format(input_file))
+                return None, None
+        return np.vstack(data), names
+
+    def get_object_to_filter(self, traces, names):
+        if traces is None:
+            return None, None, None
         # print('filtering {}-{}'.format(self.filter_from, self.filter_to))
 
         # t_range = range(self.filter_from, self.filter_to + 1)
         if self.topK > 0:
             self.topK = min(self.topK, len(names))
         # print(self.type_of_func)
-        filter_func = get_func(self.type_of_func)
-        if isinstance(data, list):
-            d = np.vstack((d for d in data))
+        t_from, t_to = max(self.filter_from, 1), min(self.filter_to, traces.T) - 1
+        filter_func = get_range_func(self.type_of_func)
+        if filter_func is not None:
+            objects_to_filtter_in, dd = filter_func(
+                traces, t_from, t_to, self.topK, bpy.context.scene.coloring_lower_threshold)
         else:
-            d = data
-        # print('%%%%%%%%%%%%%%%%%%%' + str(len(d[0, :, 0])))
-        if d.ndim == 2:
-            d = d[:, :, np.newaxis]
-        t_range = range(max(self.filter_from, 1), min(self.filter_to, len(d[0, :, 0])) - 1)
-        objects_to_filtter_in, dd = filter_func(d, t_range, self.topK, bpy.context.scene.coloring_lower_threshold)
+            filter_func = get_func(self.type_of_func)
+            objects_to_filtter_in, dd = filter_func(
+                traces.data, range(t_from, t_to), self.topK, bpy.context.scene.coloring_lower_threshold)
         # print(dd[objects_to_filtter_in])
         return objects_to_filtter_in, names, dd
 
-    def filter_electrodes_or_sensors(self, parent_name, data, meta):
+    def filter_electrodes_or_sensors(self, parent_name, traces, meta):
         # source_files = [op.join(self.current_activity_path, current_file_to_upload)]
-        objects_indices, names, Filtering.filter_values = self.get_object_to_filter([], data, meta['names'])
+        objects_indices, names, Filtering.filter_values = self.get_object_to_filter(traces, meta['names'])
         names = [mu.to_str(e) for e in meta['names']]
         Filtering.objects_indices, Filtering.filter_objects = objects_indices, names
         if objects_indices is None:
@@ -464,8 +492,11 @@ class Filtering(bpy.types.Operator):
         print('filter_ROIs')
         source_files = [op.join(self.current_activity_path, current_file_to_upload.format(hemi=hemi)) for hemi
                         in mu.HEMIS]
-        objects_indices, names, Filtering.filter_values = self.get_object_to_filter(source_files)
+        traces, names = get_traces_data('MEG', source_files, lambda: self.load_rois_data(source_files))
+        objects_indices, names, Filtering.filter_values = self.get_object_to_filter(traces, names)
         Filtering.objects_indices, Filtering.filter_objects = objects_indices, names
+        if objects_indices is None:
+            return
         deselect_all_objects()
 
         filter_obj_names = [names[ind] for ind in objects_indices]
@@ -507,16 +538,18 @@ class Filtering(bpy.types.Operator):
         current_file_to_upload = files_names[self.type_of_filter]
 
         if self.type_of_filter == 'Electrodes':
-            data, meta = get_deep_electrodes_data()
-            self.filter_electrodes_or_sensors('Deep_electrodes', data, meta)
+            traces, meta = get_traces_data('Electrodes', get_deep_electrodes_files(), get_deep_electrodes_data)
+            self.filter_electrodes_or_sensors('Deep_electrodes', traces, meta)
         elif self.type_of_filter == 'EEG':
-            data, meta = _addon().get_eeg_sensors_data()
-            self.filter_electrodes_or_sensors('EEG_sensors', data, meta)
+            traces, meta = get_traces_data(
+                'EEG', _addon().meg.get_eeg_sensors_files_names()[:2], _addon().get_eeg_sensors_data)
+            self.filter_electrodes_or_sensors('EEG_sensors', traces, meta)
         elif self.type_of_filter == 'MEG':
             self.filter_rois(current_file_to_upload)
         elif self.type_of_filter == 'MEG_sensors':
-            data, meta = _addon().get_meg_sensors_data()
-            self.filter_electrodes_or_sensors('MEG_sensors', data, meta)
+            traces, meta = get_traces_data(
+                'MEG_sensors', _addon().meg.get_meg_sensors_files_names()[:2], _addon().get_meg_sensors_data)
+            self.filter_electrodes_or_sensors('MEG_sensors', traces, meta)
 
         if bpy.context.scene.filter_items_one_by_one:
             update_filter_items(self.topK, self.objects_indices, self.filter_objects)
@@ -526,8 +559,18 @@ class Filtering(bpy.types.Operator):
         return {"FINISHED"}
 
 
+def get_deep_electrodes_files():
+    fol = op.join(mu.get_user_fol(), 'electrodes')
+    bip = 'bipolar_' if bpy.context.scene.bipolar else ''
+    meta_files = glob.glob(op.join(fol, 'electrodes_{}meta*.npz'.format(bip)))
+    if len(meta_files) > 0:
+        data_files = glob.glob(op.join(fol, 'electrodes_{}data*.npy'.format(bip)))
+        return data_files[:1] + meta_files[:1]
+    else:
+        return glob.glob(op.join(fol, 'electrodes_{}data*.npz'.format(bip)))[:1]
+
+
 def get_deep_electrodes_data():
-    # todo: should be called once (maybe those files are already loaded?
     fol = op.join(mu.get_user_fol(), 'electrodes')
     bip = 'bipolar_' if bpy.context.scene.bipolar else ''
     meta_files = glob.glob(op.join(fol, 'electrodes_{}meta*.npz'.format(bip)))
@@ -591,6 +634,7 @@ class FilteringMakerPanel(bpy.types.Panel):
     init = False
     electrodes_colors = {}
     filter_items = []
+    traces_cache = {}
 
     def draw(self, context):
         filter_draw(self, context)
@@ -1501,6 +1501,65 @@ def read_ply_file(ply_file):
     return verts, faces
 
 
+def read_mesh_file(ply_fname):
+    # Reads the mesh from the npz file next to the ply file (if it's up to date), or parses the ascii ply file in
+    # one vectorized pass. Returns None, None if the ply file isn't an ascii ply with one face type.
+    npz_fname = '{}.npz'.format(op.splitext(ply_fname)[0])
+    if op.isfile(npz_fname) and op.getmtime(npz_fname) >= op.getmtime(ply_fname):
+        d = np.load(npz_fname)
+        return d['verts'], d['faces']
+    with open(ply_fname, 'r') as f:
+        header, verts_num, faces_num = [], 0, 0
+        for line in f:
+            header.append(line.strip())
+            if line.startswith('element vertex'):
+                verts_num = int(line.split(' ')[-1])
+            elif line.startswith('element face'):
+                faces_num = int(line.split(' ')[-1])
+            elif line.startswith('end_header'):
+                break
+        if 'format ascii 1.0' not in header:
+            return None, None
+        values = np.fromstring(f.read(), sep=' ')
+    verts = values[:verts_num * 3].reshape((verts_num, 3))
+    faces_values = values[verts_num * 3:]
+    if faces_num == 0:
+        return verts, np.zeros((0, 3), dtype=np.int32)
+    face_size = int(faces_values[0])
+    if len(faces_values) != faces_num * (face_size + 1):
+        return None, None
+    faces = faces_values.reshape((faces_num, face_size + 1))[:, 1:].astype(np.int32)
+    return verts, faces
+
+
+def create_mesh_obj(obj_name, verts, faces, parent_obj=None, material=None, layer=None, scale=0.1):
+    # Creates the mesh directly from the arrays (foreach_set), without the ply importer operator
+    faces = np.asarray(faces, dtype=np.int32)
+    faces_num, face_size = faces.shape
+    mesh = bpy.data.meshes.new(obj_name)
+    mesh.vertices.add(len(verts))
+    mesh.vertices.foreach_set('co', np.asarray(verts, dtype=np.float32).ravel())
+    mesh.loops.add(faces_num * face_size)
+    mesh.loops.foreach_set('vertex_index', faces.ravel())
+    mesh.polygons.add(faces_num)
+    mesh.polygons.foreach_set('loop_start', np.arange(0, faces_num * face_size, face_size, dtype=np.int32))
+    mesh.polygons.foreach_set('loop_total', np.ones(faces_num, dtype=np.int32) * face_size)
+    mesh.polygons.foreach_set('use_smooth', [True] * faces_num)
+    mesh.update(calc_edges=True)
+    if material is not None:
+        # The material is shared between all the objects, not copied
+        mesh.materials.append(material)
+    obj = bpy.data.objects.new(obj_name, mesh)
+    bpy.context.scene.objects.link(obj)
+    if layer is not None:
+        obj.layers = [ind == layer for ind in range(len(obj.layers))]
+    if parent_obj is not None:
+        obj.parent = parent_obj
+    obj.scale = [scale] * 3
+    obj.hide = False
+    return obj
+
+
 def change_selected_fcurves_colors(selected_objects_types, color_also_objects=True, exclude=()):
     import colorsys
     # print('change_selected_fcurves_colors')
@@ -2910,8 +2969,54 @@ def get_distinct_colors(colors_num=1):
 
 
 def calc_colors_from_cm(vert_values, data_min, colors_ratio, cm):
-    colors_indices = calc_colors_indices(vert_values, data_min, colors_ratio)
-    return calc_colors_from_indices_cm(colors_indices, cm)
+    return values_to_colors(vert_values, data_min, colors_ratio, cm)
+
+
+_colormaps_luts = {}
+
+
+def get_colormap_lut(cm_name, reload=False):
+    # Every colormap is read from the disk only once, and kept as a float32 lookup table
+    if not reload and cm_name in _colormaps_luts:
+        return _colormaps_luts[cm_name]
+    colormap_fname = op.join(file_fol(), 'color_maps', '{}.npy'.format(cm_name))
+    if not op.isfile(colormap_fname):
+        print("get_colormap_lut: Can't find {}!".format(colormap_fname))
+        return None
+    _colormaps_luts[cm_name] = np.ascontiguousarray(np.load(colormap_fname), dtype=np.float32)
+    return _colormaps_luts[cm_name]
+
+
+def invalidate_colormap_lut(cm_name=None):
+    if cm_name is None:
+        _colormaps_luts.clear()
+    else:
+        _colormaps_luts.pop(cm_name, None)
+
+
+def values_to_colors(values, data_min, colors_ratio, cm, clip=True, threshold=None, bigger_or_equall=False,
+                     default_color=(1, 1, 1), rgba=False, return_mask=False):
+    # clip: values outside the colorbar get its edges colors, otherwise they get the default color, like the
+    # values under the threshold (and nans)
+    if isinstance(cm, str):
+        cm = get_colormap_lut(cm)
+    values = np.asarray(values, dtype=np.float64)
+    colors_indices = np.asarray(np.rint((values - data_min) * colors_ratio))
+    mask = np.isfinite(colors_indices)
+    if not clip:
+        mask &= (colors_indices >= 0) & (colors_indices <= len(cm) - 1)
+    if threshold is not None:
+        mask &= np.abs(values) >= threshold if bigger_or_equall else np.abs(values) > threshold
+    colors_indices[~mask] = 0
+    colors = np.take(cm, np.clip(colors_indices, 0, len(cm) - 1).astype(int), axis=0)
+    if rgba and colors.shape[-1] == 3:
+        colors = np.concatenate((colors, np.ones(colors.shape[:-1] + (1,), dtype=colors.dtype)), axis=-1)
+    if not np.all(mask):
+        default_color = np.asarray(default_color, dtype=colors.dtype)
+        if default_color.shape[-1] < colors.shape[-1]:
+            default_color = np.concatenate((default_color, [0]))
+        colors[~mask] = default_color[:colors.shape[-1]]
+    return (colors, mask) if return_mask else colors
 
 
 def calc_colors_indices(vert_values, data_min, colors_ratio):
@@ -3289,6 +3394,354 @@ def is_point_inside_mesh(p, obj, mult_by_mat_world=False):
     return not(v < 0.0)
 
 
+ACTIVITY_STORE_CHUNK_SIZE = 4096
+
+
+def get_activity_store_fol(activity_fol):
+    # activity_map_rh -> activity_map_rh_store
+    return '{}_store'.format(activity_fol[:-1] if activity_fol.endswith(op.sep) else activity_fol)
+
+
+def activity_store_exists(store_fol, layout='vertices'):
+    return op.isfile(op.join(store_fol, '{}.npy'.format(layout)))
+
+
+def save_activity_store(store_fol, data, chunk_size=ACTIVITY_STORE_CHUNK_SIZE, frames_major=True,
+                        vertices_major=True, dtype=None):
+    # data: vertices x time (can be a memmap). Both layouts are written in one pass over vertices chunks:
+    # frames.npy (T x V) for "one frame, all vertices" and vertices.npy (V x T) for "one vertex, all frames".
+    # Both are plain npy files, so they can be read lazily with np.load(mmap_mode='r').
+    # dtype: the storage dtype (see get_storage_dtype), the data's dtype if None. For int16 the data is quantized
+    # with a scale and offset, which are saved with the max errors in the store's precision.json
+    make_dir(store_fol)
+    V, T = data.shape
+    dtype = str(data.dtype) if dtype is None else dtype
+    quant = None
+    if dtype in QUANTIZED_DTYPES:
+        data_min, data_max = np.inf, -np.inf
+        for from_ind in range(0, V, chunk_size):
+            chunk = np.asarray(data[from_ind:min(from_ind + chunk_size, V)], dtype=np.float64)
+            if np.any(np.isfinite(chunk)):
+                data_min = min(data_min, np.nanmin(chunk))
+                data_max = max(data_max, np.nanmax(chunk))
+        quant = calc_quantization(data_min, data_max)
+    frames, vertices = None, None
+    if frames_major:
+        frames = np.lib.format.open_memmap(
+            op.join(store_fol, 'frames.npy'), mode='w+', dtype=dtype, shape=(T, V))
+    if vertices_major:
+        vertices = np.lib.format.open_memmap(
+            op.join(store_fol, 'vertices.npy'), mode='w+', dtype=dtype, shape=(V, T))
+    errors = PrecisionErrors()
+    for from_ind in range(0, V, chunk_size):
+        to_ind = min(from_ind + chunk_size, V)
+        chunk = np.asarray(data[from_ind:to_ind])
+        encoded = encode_storage_data(chunk, dtype, quant)
+        errors.update(chunk, encoded, quant)
+        if frames is not None:
+            frames[:, from_ind:to_ind] = encoded.T
+        if vertices is not None:
+            vertices[from_ind:to_ind] = encoded
+    for store in [frames, vertices]:
+        if store is not None:
+            store.flush()
+    del frames, vertices
+    save_precision_info(op.join(store_fol, PRECISION_INFO_NAME), dtype, quant, errors, str(data.dtype))
+    return activity_store_exists(store_fol, 'frames' if frames_major else 'vertices')
+
+
+def load_activity_store(store_fol, layout='vertices'):
+    # layout: 'frames' (T x V) or 'vertices' (V x T). Nothing is read from the disk until it's indexed.
+    # A quantized store is returned as is (int16), use read_activity_frame/read_vertices_time_courses to decode it
+    fname = op.join(store_fol, '{}.npy'.format(layout))
+    return np.load(fname, mmap_mode='r') if op.isfile(fname) else None
+
+
+def read_activity_frame(store_fol, t):
+    frames = load_activity_store(store_fol, 'frames')
+    if frames is None or t >= frames.shape[0]:
+        return None
+    return decode_storage_data(frames[t], get_store_quantization(store_fol))
+
+
+def read_vertices_time_courses(store_fol, vertices_indices):
+    vertices = load_activity_store(store_fol, 'vertices')
+    if vertices is None:
+        return None
+    return decode_storage_data(vertices[vertices_indices], get_store_quantization(store_fol))
+
+
+def read_vertex_time_course(store_fol, vertex_ind):
+    return read_vertices_time_courses(store_fol, vertex_ind)
+
+
+def activity_frame_exists(activity_fol, t):
+    # The frame is in the activity store, or in activity_fol/t{t}.npy
+    frames = load_activity_store(get_activity_store_fol(activity_fol), 'frames')
+    return frames is not None and t < frames.shape[0] or op.isfile(op.join(activity_fol, 't{}.npy'.format(t)))
+
+
+def activity_files_exist(activity_fol):
+    return activity_store_exists(get_activity_store_fol(activity_fol), 'frames') or \
+           len(glob.glob(op.join(activity_fol, 't*.npy'))) > 0
+
+
+def save_activity_frame(activity_fol, t, frame, frames_dtype=np.float32):
+    # If the activity store has the frame, the frame is updated in the store, which is written again (a quantized
+    # store is quantized with the new frame's range). Otherwise, the frame is saved in activity_fol/t{t}.npy
+    store_fol = get_activity_store_fol(activity_fol)
+    frames = load_activity_store(store_fol, 'frames')
+    if frames is None or t >= frames.shape[0]:
+        make_dir(activity_fol)
+        np.save(op.join(activity_fol, 't{}'.format(t)), np.asarray(frame).astype(frames_dtype))
+        return op.isfile(op.join(activity_fol, 't{}.npy'.format(t)))
+    vertices = load_activity_store(store_fol, 'vertices')
+    vertices_major, dtype = vertices is not None, str(frames.dtype)
+    data = decode_storage_data(vertices if vertices_major else frames.T, get_store_quantization(store_fol))
+    del frames, vertices
+    data[:, t] = frame
+    return save_activity_store(store_fol, data, vertices_major=vertices_major, dtype=dtype)
+
+
+# The storage precision policy: modality -> storage dtype. The float types are plain casts, int16 is a scaled
+# quantization (x ~ q * scale + offset), which is used only where the files are read back with
+# decode_storage_data (the activity stores and load_storage_npy). Everywhere else int16 falls back to float32, as
+# float16 can't hold small amplitudes (like MEG's ~1e-10) and flushes them to zero.
+STORAGE_PRECISION_POLICY = dict(
+    default='float32', meg_activity='float32', fmri_activity='float32', labels_data='float32', connectivity='float32')
+STORAGE_DTYPES = ('float64', 'float32', 'float16', 'int16')
+QUANTIZED_DTYPES = ('int16',)
+INT16_NAN = -32768
+INT16_MAX = 32767
+PRECISION_INFO_NAME = 'precision.json'
+PRECISION_WARNING_REL_ERR = 1e-2
+_stores_quantization = {}
+
+
+def set_storage_dtype(modality, dtype):
+    if dtype not in STORAGE_DTYPES:
+        raise Exception('Wrong storage dtype {}, should be one of {}'.format(dtype, STORAGE_DTYPES))
+    STORAGE_PRECISION_POLICY[modality] = dtype
+
+
+def set_storage_precision_policy(policy):
+    # policy: dict, or a "modality=dtype,modality=dtype" string (from the command line)
+    if isinstance(policy, str):
+        policy = dict([item.split('=') for item in policy.replace(' ', '').split(',') if '=' in item])
+    for modality, dtype in policy.items():
+        set_storage_dtype(modality, dtype)
+
+
+def read_storage_precision_policy(fol='', ini_name='default_args.ini'):
+    # The [storage_precision] section of the ini file, like meg_activity = float16
+    settings = read_config_ini(fol, ini_name)
+    if 'storage_precision' in settings.sections():
+        set_storage_precision_policy(dict(settings['storage_precision']))
+    return STORAGE_PRECISION_POLICY
+
+
+def get_storage_dtype(modality='default', quantization_allowed=True):
+    dtype = STORAGE_PRECISION_POLICY.get(modality, STORAGE_PRECISION_POLICY['default'])
+    if dtype in QUANTIZED_DTYPES and not quantization_allowed:
+        dtype = 'float32'
+    return dtype
+
+
+def calc_quantization(data_min, data_max):
+    if not np.isfinite(data_min) or not np.isfinite(data_max):
+        data_min, data_max = 0.0, 0.0
+    offset = (data_max + data_min) / 2.0
+    scale = (data_max - data_min) / (2.0 * INT16_MAX)
+    return dict(scale=float(scale) if scale > 0 else 1.0, offset=float(offset))
+
+
+def encode_storage_data(data, dtype, quant=None):
+    if dtype not in QUANTIZED_DTYPES:
+        return np.asarray(data).astype(dtype, copy=False)
+    data = np.asarray(data, dtype=np.float64)
+    if quant is None:
+        quant = calc_quantization(np.nanmin(data), np.nanmax(data)) if np.any(np.isfinite(data)) else \
+            calc_quantization(0, 0)
+    q = np.rint((data - quant['offset']) / quant['scale'])
+    q = np.clip(np.nan_to_num(q, nan=INT16_NAN), INT16_NAN, INT16_MAX).astype(np.int16)
+    q[np.isnan(data)] = INT16_NAN
+    return q
+
+
+def decode_storage_data(data, quant=None, dtype=np.float32):
+    # Upcasts the stored (reduced precision) data for the numerical work. float64 data is kept as float64
+    data = np.asarray(data)
+    if quant is not None:
+        x = data.astype(dtype) * dtype(quant['scale']) + dtype(quant['offset'])
+        x[data == INT16_NAN] = np.nan
+        return x
+    if data.dtype == np.float16:
+        return data.astype(dtype)
+    return np.array(data)
+
+
+def upcast(data, dtype=np.float64):
+    # For accumulations (sums, percentiles, correlations) over reduced precision data
+    data = np.asarray(data)
+    return data if data.dtype == dtype else data.astype(dtype)
+
+
+class PrecisionErrors(object):
+    # The max absolute and relative (to the max abs value) errors of the reduced precision data
+    def __init__(self):
+        self.max_abs_err, self.max_abs_val = 0.0, 0.0
+
+    def update(self, data, encoded, quant=None):
+        data = np.asarray(data, dtype=np.float64)
+        if data.size == 0:
+            return
+        decoded = decode_storage_data(encoded, quant, np.float64).astype(np.float64)
+        finite = np.isfinite(data)
+        if np.any(finite):
+            err = np.abs(decoded[finite] - data[finite])
+            self.max_abs_err = max(self.max_abs_err, float(np.max(err)) if np.all(np.isfinite(err)) else np.inf)
+            self.max_abs_val = max(self.max_abs_val, float(np.max(np.abs(data[finite]))))
+
+    @property
+    def max_rel_err(self):
+        return self.max_abs_err / self.max_abs_val if self.max_abs_val > 0 else 0.0
+
+
+def save_precision_info(fname, dtype, quant, errors, source_dtype=''):
+    import json
+    info = dict(dtype=dtype, source_dtype=source_dtype, quant=quant, max_abs_err=errors.max_abs_err,
+                max_rel_err=errors.max_rel_err, max_abs_val=errors.max_abs_val)
+    with open(fname, 'w') as f:
+        json.dump(info, f, indent=1)
+    if errors.max_rel_err >= PRECISION_WARNING_REL_ERR:
+        print('Warning: {} was saved as {} with a max relative error of {:.3g}!'.format(
+            fname[:-len(PRECISION_INFO_NAME) - 1], dtype, errors.max_rel_err))
+    _stores_quantization.pop(fname, None)
+    return info
+
+
+def load_precision_info(fname):
+    import json
+    if not op.isfile(fname):
+        return None
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def get_store_quantization(store_fol):
+    # Cached per the precision file's mtime, as it's read on every frame
+    fname = op.join(store_fol, PRECISION_INFO_NAME)
+    if not op.isfile(fname):
+        return None
+    mtime = op.getmtime(fname)
+    if fname not in _stores_quantization or _stores_quantization[fname][0] != mtime:
+        info = load_precision_info(fname)
+        _stores_quantization[fname] = (mtime, info.get('quant', None) if info is not None else None)
+    return _stores_quantization[fname][1]
+
+
+def get_precision_info_fname(fname):
+    return '{}.{}'.format(fname, PRECISION_INFO_NAME)
+
+
+def save_storage_npy(fname, data, modality='default'):
+    # np.save with the modality's storage dtype, and a fname.precision.json file with the errors (and the scale
+    # and offset if quantized)
+    if not fname.endswith('.npy'):
+        fname = '{}.npy'.format(fname)
+    dtype = get_storage_dtype(modality)
+    data = np.asarray(data)
+    if not np.issubdtype(data.dtype, np.floating):
+        np.save(fname, data)
+        return fname
+    quant = None
+    if dtype in QUANTIZED_DTYPES:
+        quant = calc_quantization(np.nanmin(data), np.nanmax(data)) if np.any(np.isfinite(data)) else \
+            calc_quantization(0, 0)
+    encoded = encode_storage_data(data, dtype, quant)
+    errors = PrecisionErrors()
+    errors.update(data, encoded, quant)
+    np.save(fname, encoded)
+    save_precision_info(get_precision_info_fname(fname), dtype, quant, errors, str(data.dtype))
+    return fname
+
+
+def load_storage_npy(fname, mmap_mode=None, dtype=np.float32):
+    # Quantized files are decoded (into memory). Float files are returned as they are (can be memmaped),
+    # use upcast before accumulating over float16 data
+    data = np.load(fname, mmap_mode=mmap_mode)
+    info = load_precision_info(get_precision_info_fname(fname))
+    quant = info.get('quant', None) if info is not None else None
+    return data if quant is None else decode_storage_data(data, quant, dtype)
+
+
+def savez_storage(fname, modality='default', **arrays):
+    # np.savez where the float arrays are saved with the modality's storage dtype. The npz files are read directly,
+    # so int16 falls back to float32 here. The max errors are saved in fname.precision.json
+    dtype = get_storage_dtype(modality, quantization_allowed=False)
+    errors, encoded_arrays = PrecisionErrors(), {}
+    for key, arr in arrays.items():
+        arr_np = np.asarray(arr) if not isinstance(arr, str) else arr
+        if isinstance(arr_np, np.ndarray) and np.issubdtype(arr_np.dtype, np.floating):
+            encoded_arrays[key] = encode_storage_data(arr_np, dtype)
+            errors.update(arr_np, encoded_arrays[key])
+        else:
+            encoded_arrays[key] = arr
+    np.savez(fname, **encoded_arrays)
+    if not fname.endswith('.npz'):
+        fname = '{}.npz'.format(fname)
+    save_precision_info(get_precision_info_fname(fname), dtype, None, errors)
+    return fname
+
+
+def calc_verts_faces_csr(faces, verts_num=0):
+    # CSR vertex -> faces corners lookup, built with one argsort and one bincount over the flattened faces.
+    # The corners of vertex v are indices[indptr[v]:indptr[v+1]], which are also the indices of the vertex's loops
+    # in Blender's vertex colors layers. The faces of vertex v are corners // faces.shape[1]
+    faces_flat = np.asarray(faces).ravel()
+    verts_num = max(verts_num, int(faces_flat.max()) + 1 if len(faces_flat) > 0 else 0)
+    indices = np.argsort(faces_flat, kind='mergesort').astype(np.int32)
+    indptr = np.zeros(verts_num + 1, dtype=np.int32)
+    np.cumsum(np.bincount(faces_flat, minlength=verts_num), out=indptr[1:])
+    return indptr, indices
+
+
+def verts_faces_csr_to_lookup(indptr, indices):
+    # The padded (verts_num x max_faces_num) lookup, where the empty cells are -1
+    counts = np.diff(indptr)
+    lookup = np.ones((len(counts), max(counts) if len(counts) > 0 else 0), dtype=np.int32) * -1
+    rows = np.repeat(np.arange(len(counts)), counts)
+    lookup[rows, np.arange(len(indices)) - indptr[rows]] = indices
+    return lookup
+
+
+def save_verts_faces_csr(fname, indptr, indices, face_size=3):
+    np.savez(fname, indptr=indptr, indices=indices, face_size=face_size)
+    return op.isfile(fname)
+
+
+def load_verts_faces_csr(fname):
+    if not op.isfile(fname):
+        return None
+    d = np.load(fname)
+    return VertsFacesLookup(d['indptr'], d['indices'], int(d['face_size']))
+
+
+class VertsFacesLookup(object):
+    # lookup[vert] returns the faces of the vertex, lookup.loops(vert) its faces corners (loops)
+    def __init__(self, indptr, indices, face_size=3):
+        self.indptr, self.indices, self.face_size = indptr, indices, face_size
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, vert):
+        return self.loops(vert) // self.face_size
+
+    def loops(self, vert):
+        return self.indices[self.indptr[vert]:self.indptr[vert + 1]]
+
+
 # def mouse_coo_to_3d_loc(event, context):
 #     from bpy_extras.view3d_utils import region_2d_to_vector_3d, region_2d_to_location_3d
 #     try:
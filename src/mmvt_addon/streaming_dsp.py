@@ -0,0 +1,148 @@
+import numpy as np
+
+try:
+    import scipy.signal
+    SCIPY_EXIST = True
+except:
+    SCIPY_EXIST = False
+
+
+BANDS = dict(delta=[1, 4], theta=[4, 8], alpha=[8, 15], beta=[15, 30], gamma=[30, 55], high_gamma=[65, 120])
+
+
+def notch_sos(sfreq, freq=60, q=30.0):
+    # RBJ's audio EQ cookbook notch biquad
+    w0 = 2 * np.pi * freq / sfreq
+    alpha = np.sin(w0) / (2 * q)
+    b = np.array([1, -2 * np.cos(w0), 1])
+    a = np.array([1 + alpha, -2 * np.cos(w0), 1 - alpha])
+    return np.concatenate((b / a[0], a / a[0]))[np.newaxis, :]
+
+
+def line_noise_sos(sfreq, line_freq=60, harmonics_num=3, q=30.0):
+    freqs = [line_freq * k for k in range(1, harmonics_num + 1) if line_freq * k < sfreq / 2]
+    return np.vstack([notch_sos(sfreq, freq, q) for freq in freqs]) if len(freqs) > 0 else np.zeros((0, 6))
+
+
+def band_pass_sos(sfreq, l_freq=1, h_freq=None, order=4):
+    # Butterworth band-pass (or high-pass/low-pass if one of the freqs is None) second-order sections
+    nyq = sfreq / 2
+    if h_freq is not None and h_freq >= nyq:
+        h_freq = None
+    if l_freq is not None and l_freq <= 0:
+        l_freq = None
+    if l_freq is None and h_freq is None:
+        return np.zeros((0, 6))
+    if SCIPY_EXIST:
+        if l_freq is not None and h_freq is not None:
+            return scipy.signal.butter(order, [l_freq / nyq, h_freq / nyq], btype='bandpass', output='sos')
+        elif l_freq is not None:
+            return scipy.signal.butter(order, l_freq / nyq, btype='highpass', output='sos')
+        else:
+            return scipy.signal.butter(order, h_freq / nyq, btype='lowpass', output='sos')
+    # Without scipy, cascades RBJ's high-pass and low-pass biquads with the Butterworth poles pairs' Qs:
+    # Q_k = 1 / (2cos(theta_k)), theta_k = (2k - 1)pi / 2n (k * pi / n for odd orders, which add a first order section)
+    sections = []
+    for freq, btype in [(l_freq, 'highpass'), (h_freq, 'lowpass')]:
+        if freq is None:
+            continue
+        w0 = 2 * np.pi * freq / sfreq
+        cos_w0 = np.cos(w0)
+        for k in range(1, order // 2 + 1):
+            alpha = np.sin(w0) * np.cos((2 * k - 1 + order % 2) * np.pi / (2 * order))
+            if btype == 'highpass':
+                b = np.array([(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2])
+            else:
+                b = np.array([(1 - cos_w0) / 2, 1 - cos_w0, (1 - cos_w0) / 2])
+            a = np.array([1 + alpha, -2 * cos_w0, 1 - alpha])
+            sections.append(np.concatenate((b / a[0], a / a[0])))
+        if order % 2 == 1:
+            k = np.tan(w0 / 2)
+            b = np.array([1, -1, 0]) if btype == 'highpass' else np.array([k, k, 0])
+            a = np.array([1 + k, k - 1, 0])
+            sections.append(np.concatenate((b / a[0], a / a[0])))
+    return np.array(sections)
+
+
+class OnlineSOSFilter(object):
+    # A causal IIR filter (second-order sections) over channels x samples buffers. The filter's state is carried
+    # between the buffers, so filtering the stream buffer by buffer gives the same output as filtering it at once.
+    def __init__(self, sos, channels_num):
+        self.sos = np.atleast_2d(sos)
+        self.zi = np.zeros((len(self.sos), channels_num, 2))
+
+    def process(self, x):
+        if len(self.sos) == 0:
+            return x
+        x = np.asarray(x, dtype=np.float64)
+        if SCIPY_EXIST:
+            y, self.zi = scipy.signal.sosfilt(self.sos, x, axis=1, zi=self.zi)
+            return y
+        # Transposed direct form II, vectorized over the channels
+        y = x.copy()
+        for section_ind, (b0, b1, b2, a0, a1, a2) in enumerate(self.sos):
+            z = self.zi[section_ind]
+            for t in range(y.shape[1]):
+                x_t = y[:, t].copy()
+                y[:, t] = b0 * x_t + z[:, 0]
+                z[:, 0] = b1 * x_t - a1 * y[:, t] + z[:, 1]
+                z[:, 1] = b2 * x_t - a2 * y[:, t]
+        return y
+
+    def reset(self):
+        self.zi[...] = 0
+
+
+class RunningBandPower(object):
+    # A short-time FFT band power over the last n_fft samples of every channel, updated every hop samples.
+    # All the channels are transformed at once, and the power is smoothed with an exponential moving average.
+    def __init__(self, sfreq, channels_num, bands=None, n_fft=256, hop=None, smoothing=0.5, db=True):
+        self.bands = BANDS if bands is None else bands
+        self.n_fft, self.hop = n_fft, n_fft // 4 if hop is None else hop
+        self.smoothing, self.db = smoothing, db
+        self.window = np.hanning(n_fft)
+        freqs = np.fft.rfftfreq(n_fft, 1.0 / sfreq)
+        self.bands_masks = np.array([(freqs >= lf) & (freqs <= hf) for lf, hf in self.bands.values()], dtype=float)
+        bins_num = self.bands_masks.sum(1)
+        self.bands_masks[bins_num > 0] /= bins_num[bins_num > 0, np.newaxis]
+        self.ring = np.zeros((channels_num, n_fft))
+        self.samples_num, self.samples_since_update = 0, 0
+        self.power = None
+
+    def update(self, x):
+        # x: channels x samples. Returns the current power (channels x bands), None before the first window is full
+        x = np.asarray(x)
+        for t_from in range(0, x.shape[1], self.n_fft):
+            chunk = x[:, t_from:t_from + self.n_fft]
+            n = chunk.shape[1]
+            self.ring = np.roll(self.ring, -n, axis=1)
+            self.ring[:, -n:] = chunk
+            self.samples_num += n
+            self.samples_since_update += n
+        if self.samples_num >= self.n_fft and (self.power is None or self.samples_since_update >= self.hop):
+            self.samples_since_update = 0
+            spectrum = np.abs(np.fft.rfft(self.ring * self.window, axis=1)) ** 2
+            power = spectrum.dot(self.bands_masks.T)
+            if self.db:
+                power = 10 * np.log10(np.maximum(power, 1e-20))
+            self.power = power if self.power is None else \
+                self.smoothing * self.power + (1 - self.smoothing) * power
+        return self.power
+
+    def band_index(self, band):
+        return list(self.bands.keys()).index(band)
+
+
+class StreamingDSP(object):
+    # The online DSP stage: line-noise notches, a band-pass and the running band power
+    def __init__(self, sfreq, channels_num, line_freq=60, notch=True, l_freq=None, h_freq=None,
+                 band_power=False, bands=None, n_fft=256):
+        sos = [line_noise_sos(sfreq, line_freq) if notch else np.zeros((0, 6)), band_pass_sos(sfreq, l_freq, h_freq)]
+        self.filter = OnlineSOSFilter(np.vstack(sos), channels_num)
+        self.band_power = RunningBandPower(sfreq, channels_num, bands, n_fft) if band_power else None
+        self.channels_num = channels_num
+
+    def process(self, x):
+        y = self.filter.process(x)
+        power = self.band_power.update(y) if self.band_power is not None else None
+        return y, power
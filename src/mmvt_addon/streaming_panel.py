@@ -1,5 +1,6 @@
 import bpy
 import mmvt_utils as mu
+import streaming_dsp
 import sys
 import os.path as op
 import time
@@ -53,8 +54,36 @@ def electrodes_sep_update(self, context):
     mu.view_all_in_graph_editor()
 
 
+def stream_dsp_update(self, context):
+    StreamingPanel.dsp = None
+
+
+def stream_dsp(data, channels_names=(), stim_channels=()):
+    # Online filtering of the stream's buffers, the filters' states are carried from buffer to buffer.
+    # The stim channels (triggers) aren't filtered, change_graph_all_vals looks for their steps
+    if not bpy.context.scene.stream_dsp:
+        return data, None
+    stim_ch_indices = [channels_names.index(s) for s in stim_channels if s in channels_names]
+    channels_indices = np.setdiff1d(np.arange(data.shape[0]), stim_ch_indices)
+    if StreamingPanel.dsp is None or StreamingPanel.dsp.channels_num != len(channels_indices):
+        scn = bpy.context.scene
+        StreamingPanel.dsp = streaming_dsp.StreamingDSP(
+            scn.streaming_sfreq, len(channels_indices), scn.stream_line_freq, scn.stream_notch,
+            scn.stream_l_freq if scn.stream_l_freq > 0 else None, scn.stream_h_freq if scn.stream_h_freq > 0 else None,
+            band_power=scn.stream_color_by_band_power)
+    filtered_data, power = StreamingPanel.dsp.process(data[channels_indices])
+    data = np.array(data, dtype=filtered_data.dtype)
+    data[channels_indices] = filtered_data
+    if power is not None:
+        # The stim channels get the lowest power
+        band_power = power[:, StreamingPanel.dsp.band_power.band_index(bpy.context.scene.stream_power_band)]
+        power = np.full(data.shape[0], np.min(band_power) if len(band_power) > 0 else 0.0)
+        power[channels_indices] = band_power
+    return data, power
+
+
 # @mu.profileit()
-def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=50):
+def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=50, colors_vals=None):
     MAX_STEPS = StreamingPanel.max_steps
     T = min(mat.shape[1], MAX_STEPS)
     parent_obj = bpy.data.objects['Deep_electrodes']
@@ -71,6 +100,10 @@ def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=
         colors_ratio = 256 / (data_max - data_min)
     StreamingPanel.data_min = data_min = min(data_min, StreamingPanel.data_min)
     StreamingPanel.data_max = data_max = max(data_max, StreamingPanel.data_max)
+    if colors_vals is not None:
+        # Coloring by the running band power, which has its own scale
+        data_min, data_max = np.min(colors_vals), np.max(colors_vals)
+        colors_ratio = 256 / (data_max - data_min) if data_max > data_min else 256
     data_abs_minmax = max([abs(data_min), abs(data_max)])
     StreamingPanel.minmax_vals.append(data_abs_minmax)
     # if len(StreamingPanel.minmax_vals) > 100:
@@ -81,6 +114,7 @@ def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=
         _addon().set_colorbar_max_min(data_max, data_min)
     curr_t = bpy.context.scene.frame_current
     first_curve = True
+    colored_names, colored_vals = [], []
 
     # stim
     stim_ch_indices = [channels_names.index(s) for s in stim_channels if s in channels_names]
@@ -114,9 +148,14 @@ def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=
             fcurve.keyframe_points[t].co[1] = mat[elc_ind, ind] + (C / 2 - fcurve_ind) * bpy.context.scene.electrodes_sep
             # if fcurve.keyframe_points[t].co[1] != 0:
             #     print(elc_ind, ind, fcurve.keyframe_points[t].co[1])
-        _addon().color_objects_homogeneously([mat[elc_ind, ind]], [fcurve_name], None, data_min, colors_ratio)
+        colored_names.append(fcurve_name)
+        colored_vals.append(mat[elc_ind, ind] if colors_vals is None else colors_vals[elc_ind])
         # fcurve.keyframe_points[max_steps + 1].co[1] = 0
         # fcurve.keyframe_points[0].co[1] = 0
+    if len(colored_names) > 0:
+        # All the electrodes are colored at once
+        _addon().color_objects_homogeneously(
+            np.array(colored_vals)[:, np.newaxis], colored_names, None, data_min, colors_ratio)
 
     try:
         StreamingPanel.cycle_data = mat if StreamingPanel.cycle_data == [] else np.hstack((StreamingPanel.cycle_data, mat))
@@ -145,19 +184,8 @@ def show_electrodes_fcurves():
 
 
 def change_color(obj, val, data_min, colors_ratio):
-    colors_ind = calc_color_ind(val, data_min, colors_ratio)
-    colors = StreamingPanel.cm[colors_ind]
-    _addon().object_coloring(obj, colors)
-
-
-def calc_color_ind(val, data_min, colors_ratio):
-    colors_ind = int(((val - data_min) * colors_ratio))
-    N = len(StreamingPanel.cm)
-    if colors_ind < 0:
-        colors_ind = 0
-    if colors_ind > N - 1:
-        colors_ind = N - 1
-    return colors_ind
+    color = mu.values_to_colors(val, data_min, colors_ratio, _addon().get_cm())
+    _addon().object_coloring(obj, color)
 
 
 def reading_from_udp_while_termination_func():
@@ -378,6 +406,7 @@ class StreamButton(bpy.types.Operator):
             context.window_manager.modal_handler_add(self)
             self._timer = context.window_manager.event_timer_add(0.01, context.window)
         if StreamingPanel.is_streaming:
+            StreamingPanel.dsp = None
             init_electrodes_fcurves(bpy.context.scene.streaming_window_length)
             show_electrodes_fcurves()
             self._first_timer = True
@@ -434,8 +463,9 @@ class StreamButton(bpy.types.Operator):
                     #     print('spike!!!!!')
                     # else:
                         # print('only zeros!')
+                    data, band_power = stream_dsp(data, StreamButton._channels_names, StreamButton._stim_channels)
                     change_graph_all_vals(data, StreamButton._channels_names, StreamButton._stim_channels,
-                                          bpy.context.scene.stim_length)
+                                          bpy.context.scene.stim_length, band_power)
                     if bpy.context.scene.stream_type == 'offline' or self._first_time:
                         mu.view_all_in_graph_editor()
                         self._first_time = False
@@ -485,6 +515,20 @@ def streaming_draw(self, context):
     layout.prop(context.scene, 'streaming_window_length', text='Window length')
     layout.prop(context.scene, 'stim_length', text='Stim length')
     layout.prop(context.scene, 'electrodes_sep', text='Curves separation')
+    layout.prop(context.scene, 'stream_dsp', text='Online filtering')
+    if bpy.context.scene.stream_dsp:
+        box = layout.box()
+        col = box.column()
+        col.prop(context.scene, 'streaming_sfreq', text='Sampling freq')
+        row = col.row(align=True)
+        row.prop(context.scene, 'stream_notch', text='Notch')
+        row.prop(context.scene, 'stream_line_freq', text='Line freq')
+        row = col.row(align=True)
+        row.prop(context.scene, 'stream_l_freq', text='From')
+        row.prop(context.scene, 'stream_h_freq', text='To')
+        col.prop(context.scene, 'stream_color_by_band_power', text='Color by band power')
+        if bpy.context.scene.stream_color_by_band_power:
+            col.prop(context.scene, 'stream_power_band', text='')
 
 
 bpy.types.Scene.streaming_buffer_size = bpy.props.IntProperty(default=100, min=1)
@@ -506,6 +550,21 @@ bpy.types.Scene.stream_show_only_good_electrodes = bpy.props.BoolProperty(defaul
 bpy.types.Scene.stim_length = bpy.props.IntProperty(default=50)
 bpy.types.Scene.streaming_window_length = bpy.props.IntProperty(default=100, min=10)
 bpy.types.Scene.streaming_fcruves_are_init = bpy.props.BoolProperty(default=False)
+bpy.types.Scene.stream_dsp = bpy.props.BoolProperty(default=False, update=stream_dsp_update,
+    description='Filters the streaming data online')
+bpy.types.Scene.streaming_sfreq = bpy.props.FloatProperty(default=1000, min=1, update=stream_dsp_update)
+bpy.types.Scene.stream_notch = bpy.props.BoolProperty(default=True, update=stream_dsp_update,
+    description='Removes the line noise and its harmonics')
+bpy.types.Scene.stream_line_freq = bpy.props.IntProperty(default=60, min=1, update=stream_dsp_update)
+bpy.types.Scene.stream_l_freq = bpy.props.FloatProperty(default=1, min=0, update=stream_dsp_update,
+    description='Band-pass low cutoff frequency (0 for none)')
+bpy.types.Scene.stream_h_freq = bpy.props.FloatProperty(default=0, min=0, update=stream_dsp_update,
+    description='Band-pass high cutoff frequency (0 for none)')
+bpy.types.Scene.stream_color_by_band_power = bpy.props.BoolProperty(default=False, update=stream_dsp_update,
+    description='Colors the electrodes by their running band power')
+bpy.types.Scene.stream_power_band = bpy.props.EnumProperty(
+    items=[(band, band, '', ind + 1) for ind, band in enumerate(streaming_dsp.BANDS.keys())],
+    description='Band power to color by')
 
 
 class StreamingPanel(bpy.types.Panel):
@@ -527,6 +586,7 @@ class StreamingPanel(bpy.types.Panel):
     time = datetime.now()
     electrodes_names, electrodes_conditions, offline_data, cycle_data = [], [], [], []
     data_max, data_min, electrodes_colors_ratio = 0, 0, 1
+    dsp = None
 
     def draw(self, context):
         if StreamingPanel.init:
@@ -559,6 +619,8 @@ def init(addon):
         bpy.context.scene.multicast_group = stream_con.get('multicast_group', '1.1.1.1')
         bpy.context.scene.streaming_server_port = int(stream_con.get('port', 222))
         bpy.context.scene.timeout = float(stream_con.get('timeout', 0.1))
+        bpy.context.scene.streaming_sfreq = float(stream_con.get('sfreq', 1000))
+        bpy.context.scene.stream_line_freq = int(stream_con.get('line_freq', 60))
     bpy.context.scene.stream_show_only_good_electrodes = False
     streaming_items = [('udp', 'udp', '', 1)]
     input_fol = op.join(mu.get_user_fol(), 'electrodes', 'streaming')
@@ -0,0 +1,104 @@
+import numpy as np
+
+# The filters plugins, name -> func(traces, t_from, t_to, top_k, threshold) -> (objects_indices, values)
+_filters = {}
+
+
+def register_filter(name, func=None):
+    # Can be used as a decorator (@register_filter('rms')), or called directly
+    if func is None:
+        return lambda f: register_filter(name, f)
+    _filters[name] = func
+    return func
+
+
+def unregister_filter(name):
+    _filters.pop(name, None)
+
+
+def get_filter(name):
+    return _filters.get(name, None)
+
+
+def get_filters_names():
+    return list(_filters.keys())
+
+
+class TracesData(object):
+    # Holds the objects traces (objects x time x conditions) with the prefix sums of x, x^2 and |data| along the
+    # time axis, so any sum over a time range [t_from, t_to) costs O(objects). When there are two conditions,
+    # x is the conditions difference, otherwise it's the conditions sum.
+    def __init__(self, data):
+        data = np.asarray(data)
+        if data.ndim == 2:
+            data = data[:, :, np.newaxis]
+        self.data = data
+        self.objects_num, self.T = data.shape[0], data.shape[1]
+        self._x = None
+        self._prefix = {}
+
+    @property
+    def x(self):
+        if self._x is None:
+            if self.data.shape[2] == 2:
+                self._x = np.diff(self.data, axis=2)[:, :, 0].astype(np.float64)
+            else:
+                self._x = np.sum(self.data, axis=2, dtype=np.float64)
+        return self._x
+
+    def _prefix_sum(self, name, func):
+        if name not in self._prefix:
+            prefix = np.zeros((self.objects_num, self.T + 1))
+            np.cumsum(func(), axis=1, out=prefix[:, 1:])
+            self._prefix[name] = prefix
+        return self._prefix[name]
+
+    def _range_sum(self, prefix, t_from, t_to):
+        t_from, t_to = self.clip_range(t_from, t_to)
+        return prefix[:, t_to] - prefix[:, t_from]
+
+    def clip_range(self, t_from, t_to):
+        t_from = min(max(t_from, 0), self.T)
+        return t_from, min(max(t_to, t_from), self.T)
+
+    def sum(self, t_from, t_to):
+        return self._range_sum(self._prefix_sum('x', lambda: self.x), t_from, t_to)
+
+    def sum_squares(self, t_from, t_to):
+        return self._range_sum(self._prefix_sum('x2', lambda: np.square(self.x)), t_from, t_to)
+
+    def sum_abs(self, t_from, t_to):
+        return self._range_sum(self._prefix_sum(
+            'abs', lambda: np.sum(np.abs(self.data), axis=2, dtype=np.float64)), t_from, t_to)
+
+    def mean(self, t_from, t_to):
+        t_from, t_to = self.clip_range(t_from, t_to)
+        return self.sum(t_from, t_to) / max(t_to - t_from, 1)
+
+    def max_abs(self, t_from, t_to):
+        t_from, t_to = self.clip_range(t_from, t_to)
+        if t_to == t_from:
+            return np.zeros(self.objects_num)
+        return np.max(np.abs(self.x[:, t_from:t_to]), axis=1)
+
+
+def top_k_indices(values, top_k=0, mask=None):
+    # The indices of the top_k largest values (where mask is True), sorted from the largest.
+    # top_k == 0 means all the positive values
+    indices = np.arange(len(values)) if mask is None else np.where(mask)[0]
+    if top_k == 0:
+        top_k = np.sum(values > 0)
+    top_k = min(top_k, len(indices))
+    if top_k == 0:
+        return np.array([], dtype=int)
+    candidates = -values[indices]
+    if top_k < len(indices):
+        top = np.argpartition(candidates, top_k - 1)[:top_k]
+    else:
+        top = np.arange(len(indices))
+    return indices[top[np.argsort(candidates[top], kind='stable')]]
+
+
+def t_range_to_from_to(t_range):
+    t_range = list(t_range)
+    return (t_range[0], t_range[-1] + 1) if len(t_range) > 0 else (0, 0)
@@ -1,9 +1,11 @@
-import numpy as np
+from . import filters_engine as fe
+
+
+@fe.register_filter('sum_abs')
+def filter_traces_range(traces, t_from, t_to, top_k=0, threshold=0):
+    sub_abs = traces.sum_abs(t_from, t_to)
+    return fe.top_k_indices(sub_abs, top_k), sub_abs
 
 
 def filter_traces(data, t_range, top_k=0, threshold=0):
-    sub_abs = np.sum(abs(data[:, t_range, :]), (1, 2))
-    if top_k == 0:
-        top_k = sum(sub_abs > 0)
-    objects = np.argsort(sub_abs)[::-1][:top_k]
-    return objects, sub_abs
+    return filter_traces_range(fe.TracesData(data), *fe.t_range_to_from_to(t_range), top_k, threshold)
@@ -0,0 +1,182 @@
+import os
+import os.path as op
+import numpy as np
+
+# A tractography store: all the streamlines of a pathway are saved as one concatenated float32 (points x 3) array,
+# with the streamlines offsets (streamlines_num + 1), so streamline i is points[offsets[i]:offsets[i + 1]].
+# The level-of-detail (LOD) subsets are saved in the same npz file.
+
+STORE_POSTFIX = '.npz'
+LODS = ['high', 'medium', 'low']
+
+
+class TractsStore(object):
+    def __init__(self, points, offsets):
+        self.points = np.asarray(points, dtype=np.float32).reshape((-1, 3))
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @property
+    def tracts_num(self):
+        return len(self.offsets) - 1
+
+    @property
+    def points_num(self):
+        return len(self.points)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return self.tracts_num
+
+    def __getitem__(self, ind):
+        return self.points[self.offsets[ind]:self.offsets[ind + 1]]
+
+    def tracts_ids(self):
+        # The streamline index of every point
+        return np.repeat(np.arange(self.tracts_num), self.lengths)
+
+    def subset(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        points_indices = np.repeat(self.offsets[indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return TractsStore(self.points[points_indices], offsets)
+
+    def edges(self):
+        # The (points_num - tracts_num) x 2 segments between consecutive points of the same streamline
+        starts = np.arange(self.points_num - 1)
+        last_points = self.offsets[1:-1] - 1
+        mask = np.ones(len(starts), dtype=bool)
+        mask[last_points[(last_points >= 0) & (last_points < len(starts))]] = False
+        starts = starts[mask]
+        return np.column_stack((starts, starts + 1))
+
+
+def from_tracks(tracks):
+    # From the legacy list of (points_num x 3) arrays
+    tracks = [np.asarray(track, dtype=np.float32).reshape((-1, 3)) for track in tracks]
+    lengths = [len(track) for track in tracks]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    points = np.concatenate(tracks) if len(tracks) > 0 else np.zeros((0, 3), dtype=np.float32)
+    return TractsStore(points, offsets)
+
+
+def save(store, fname, lods=None):
+    # lods: {lod name: TractsStore}
+    arrs = dict(points=store.points, offsets=store.offsets)
+    for lod_name, lod_store in (lods or {}).items():
+        arrs['{}_points'.format(lod_name)] = lod_store.points
+        arrs['{}_offsets'.format(lod_name)] = lod_store.offsets
+    tmp_fname = fname + '.tmp.npz'
+    np.savez(tmp_fname, **arrs)
+    os.replace(tmp_fname, fname)
+
+
+def load(fname, lod=None):
+    # Returns the lod's subset if it was saved, otherwise all the streamlines
+    with np.load(fname) as d:
+        if lod is not None and lod != LODS[0] and '{}_points'.format(lod) in d:
+            return TractsStore(d['{}_points'.format(lod)], d['{}_offsets'.format(lod)])
+        return TractsStore(d['points'], d['offsets'])
+
+
+def get_saved_lods(fname):
+    with np.load(fname) as d:
+        return [LODS[0]] + [lod for lod in LODS[1:] if '{}_points'.format(lod) in d.files]
+
+
+def decimate(store, points_step=2, tracts_step=1):
+    # Takes every tracts_step streamline, and every points_step point of each streamline (always keeping both ends)
+    if tracts_step > 1:
+        store = store.subset(np.arange(0, store.tracts_num, tracts_step))
+    if points_step <= 1 or store.tracts_num == 0:
+        return store
+    ids = store.tracts_ids()
+    points_inds = np.arange(store.points_num) - store.offsets[ids]
+    mask = (points_inds % points_step == 0) | (points_inds == store.lengths[ids] - 1)
+    lengths = np.bincount(ids[mask], minlength=store.tracts_num)
+    return TractsStore(store.points[mask], np.concatenate(([0], np.cumsum(lengths))))
+
+
+def resample(store, points_num=12):
+    # Resamples every streamline to points_num points, equally spaced along its arc length.
+    # Returns a (tracts_num x points_num x 3) array
+    ids = store.tracts_ids()
+    seg_lengths = np.linalg.norm(np.diff(store.points.astype(np.float64), axis=0), axis=1)
+    seg_lengths[store.offsets[1:-1] - 1] = 0
+    arc = np.concatenate(([0], np.cumsum(seg_lengths)))
+    arc -= arc[store.offsets[ids]]
+    tracts_lengths = arc[np.maximum(store.offsets[1:] - 1, 0)]
+    targets = np.linspace(0, 1, points_num)[np.newaxis, :] * tracts_lengths[:, np.newaxis]
+    # Every target's arc position, searched in the concatenated arc (shifted per streamline to keep it increasing)
+    shift = np.concatenate(([0], np.cumsum(tracts_lengths[:-1] + 1)))
+    global_arc = arc + shift[ids]
+    global_targets = targets + shift[:, np.newaxis]
+    inds = np.searchsorted(global_arc, global_targets.ravel(), side='right') - 1
+    inds = np.clip(inds.reshape(targets.shape), store.offsets[:-1, np.newaxis],
+                   np.maximum(store.offsets[1:, np.newaxis] - 2, store.offsets[:-1, np.newaxis]))
+    next_inds = np.minimum(inds + 1, store.offsets[1:, np.newaxis] - 1)
+    span = global_arc[next_inds] - global_arc[inds]
+    w = np.where(span > 0, (global_targets - global_arc[inds]) / np.where(span > 0, span, 1), 0)
+    w = np.clip(w, 0, 1)[:, :, np.newaxis]
+    return ((1 - w) * store.points[inds] + w * store.points[next_inds]).astype(np.float32)
+
+
+def cluster(store, clusters_num=500, points_num=12, iters_num=10, chunk_size=10000, seed=0):
+    # Clusters the streamlines with k-means on their resampled points, where every streamline is first flipped to
+    # a canonical direction (its first point has the smaller x). Returns the clusters centroids as a TractsStore,
+    # the streamlines labels, and the clusters sizes.
+    if store.tracts_num == 0:
+        return TractsStore(np.zeros((0, 3)), [0]), np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    X = resample(store, points_num)
+    flip = X[:, 0, 0] > X[:, -1, 0]
+    X[flip] = X[flip, ::-1]
+    X = X.reshape((len(X), -1))
+    clusters_num = min(clusters_num, len(X))
+    rs = np.random.RandomState(seed)
+    centroids = X[rs.choice(len(X), clusters_num, replace=False)].astype(np.float64)
+    labels = np.zeros(len(X), dtype=int)
+    for _ in range(iters_num):
+        centroids_norm = np.sum(centroids ** 2, axis=1)
+        for t_from in range(0, len(X), chunk_size):
+            chunk = X[t_from:t_from + chunk_size]
+            labels[t_from:t_from + chunk_size] = np.argmin(centroids_norm - 2 * chunk.dot(centroids.T), axis=1)
+        sizes = np.bincount(labels, minlength=clusters_num)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, X)
+        non_empty = sizes > 0
+        centroids[non_empty] = sums[non_empty] / sizes[non_empty, np.newaxis]
+    sizes = np.bincount(labels, minlength=clusters_num)
+    non_empty = sizes > 0
+    centroids, sizes = centroids[non_empty], sizes[non_empty]
+    labels = np.cumsum(non_empty)[labels] - 1
+    offsets = np.arange(0, (len(centroids) + 1) * points_num, points_num)
+    return TractsStore(centroids.reshape((-1, 3)), offsets), labels, sizes
+
+
+def calc_lods(store, medium_max_tracts=20000, medium_points_step=2, low_clusters_num=500):
+    # medium: a decimated subset of the streamlines, low: the clusters centroids
+    lods = {}
+    tracts_step = int(np.ceil(store.tracts_num / medium_max_tracts)) if medium_max_tracts > 0 else 1
+    lods['medium'] = decimate(store, medium_points_step, max(tracts_step, 1))
+    if low_clusters_num > 0 and store.tracts_num > low_clusters_num:
+        lods['low'], _, _ = cluster(store, low_clusters_num)
+    else:
+        lods['low'] = lods['medium']
+    return lods
+
+
+def convert_tracks_file(tracks_fname, output_fname='', overwrite=False, **lods_kwargs):
+    # Converts the legacy pickle of tracks into the store (with its lods)
+    if output_fname == '':
+        output_fname = op.splitext(tracks_fname)[0] + STORE_POSTFIX
+    if op.isfile(output_fname) and not overwrite:
+        return output_fname
+    import pickle
+    with open(tracks_fname, 'rb') as fp:
+        tracks = pickle.load(fp)
+    store = from_tracks(tracks)
+    save(store, output_fname, calc_lods(store, **lods_kwargs))
+    return output_fname
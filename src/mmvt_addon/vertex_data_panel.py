@@ -197,12 +197,16 @@ class CreateVertexData(bpy.types.Operator):
 
     def keyframe_empty_test(self, empty_name, closest_mesh_name, vertex_ind, data_path):
         obj = bpy.data.objects[empty_name]
-        lookup = np.load(op.join(data_path, 'activity_map_' + closest_mesh_name + '_verts_lookup.npy'))
-        file_num_str = str(int(lookup[vertex_ind, 0]))
-        line_num = int(lookup[vertex_ind, 1])
-        data_file = np.load(
-            op.join(data_path, 'activity_map_' + closest_mesh_name + '_verts', file_num_str + '.npy'))
-        data = data_file[line_num, :].squeeze()
+        store_fol = mu.get_activity_store_fol(op.join(data_path, 'activity_map_' + closest_mesh_name))
+        if mu.activity_store_exists(store_fol):
+            data = mu.read_vertex_time_course(store_fol, vertex_ind)
+        else:
+            lookup = np.load(op.join(data_path, 'activity_map_' + closest_mesh_name + '_verts_lookup.npy'))
+            file_num_str = str(int(lookup[vertex_ind, 0]))
+            line_num = int(lookup[vertex_ind, 1])
+            data_file = np.load(
+                op.join(data_path, 'activity_map_' + closest_mesh_name + '_verts', file_num_str + '.npy'))
+            data = data_file[line_num, :].squeeze()
 
         number_of_time_points = len(data)
         mu.insert_keyframe_to_custom_prop(obj, 'data', 0, 0)
@@ -247,7 +251,8 @@ class DataInVertMakerPanel(bpy.types.Panel):
 
 def init(addon):
     DataInVertMakerPanel.addon = addon
-    lookup_files = glob.glob(op.join(mu.get_user_fol(), 'activity_map_*_verts_lookup.npy'))
+    lookup_files = glob.glob(op.join(mu.get_user_fol(), 'activity_map_*_verts_lookup.npy')) + \
+                   glob.glob(op.join(mu.get_user_fol(), 'activity_map_*_store', 'vertices.npy'))
     if len(lookup_files) == 0:
         print('No lookup files for vertex_data_panel')
         DataInVertMakerPanel.init = False
@@ -20,6 +20,7 @@ from src.utils import utils
 from src.utils import freesurfer_utils as fu
 from src.utils import args_utils as au
 from src.utils import preproc_utils as pu
+from src.utils import memo_utils as memo
 
 
 SUBJECTS_DIR, MMVT_DIR, FREESURFER_HOME = pu.get_links()
@@ -315,6 +316,17 @@ def create_surfaces(subject, surfaces_types=('inflated', 'pial'), hemi='both', o
 #         # utils.copy_file(ply_file, op.join(MMVT_DIR, subject, 'surf', '{}.{}.ply'.format(hemi, surf_type)))
 
 
+def get_annot_fname(subject, atlas):
+    return op.join(SUBJECTS_DIR, subject, 'label', '{}.{}.annot'.format('{hemi}', atlas))
+
+
+@memo.memoize(
+    inputs=lambda subject, atlas, **_: [
+        op.join(SUBJECTS_DIR, subject, 'surf', '{hemi}.curv'), get_annot_fname(subject, atlas),
+        op.join(SUBJECTS_DIR, subject, 'label', atlas, '*.label')],
+    outputs=lambda subject, atlas, **_: [
+        op.join(MMVT_DIR, subject, 'surf', '{hemi}.curv.npy'),
+        op.join(MMVT_DIR, subject, 'surf', '{}_{}_curves'.format(atlas, '{hemi}'), '*_curv.npy')])
 def save_hemis_curv(subject, atlas):
     out_curv_file = op.join(MMVT_DIR, subject, 'surf', '{hemi}.curv.npy')
     # out_border_file = op.join(MMVT_DIR, subject, 'surf', '{hemi}.curv.borders.npy')
@@ -635,6 +647,10 @@ def save_matlab_labels_vertices(subject, atlas):
 
 
 @utils.tryit()
+@memo.memoize(
+    inputs=lambda subject, atlas, **_: [
+        get_annot_fname(subject, atlas), op.join(SUBJECTS_DIR, subject, 'label', atlas, '*.label')],
+    outputs=lambda subject, atlas, **_: [op.join(MMVT_DIR, subject, 'labels_vertices_{}.pkl'.format(atlas))])
 def save_labels_vertices(subject, atlas, overwrite=False):
     output_fname = op.join(MMVT_DIR, subject, 'labels_vertices_{}.pkl'.format(atlas))
     if op.isfile(output_fname) and not overwrite:
@@ -657,9 +673,11 @@ def create_spatial_connectivity(subject, surf_types=('pial', 'dural'), overwrite
     for surf in surf_types:
         verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors{}_{}.pkl'.format(
             '' if surf == 'pial' else '_{}'.format(surf), '{hemi}'))
+        verts_neighbors_csr_fname = get_verts_neighbors_csr_fname(subject, surf)
         connectivity_fname = op.join(MMVT_DIR, subject, 'spatial_connectivity{}.pkl'.format(
             '' if surf == 'pial' else '_{}'.format(surf)))
-        if utils.both_hemi_files_exist(verts_neighbors_fname) and op.isfile(connectivity_fname) and not overwrite:
+        if utils.both_hemi_files_exist(verts_neighbors_fname) and utils.both_hemi_files_exist(
+                verts_neighbors_csr_fname) and op.isfile(connectivity_fname) and not overwrite:
             continue
         connectivity_per_hemi = {}
         for hemi in utils.HEMIS:
@@ -676,15 +694,33 @@ def create_spatial_connectivity(subject, surf_types=('pial', 'dural'), overwrite
             #     continue
             # d = np.load(conn_fname)
             connectivity_per_hemi[hemi] = mne.spatial_tris_connectivity(faces)
-            rows, cols = connectivity_per_hemi[hemi].nonzero()
-            for ind in range(len(rows)):
-                neighbors[rows[ind]].append(cols[ind])
+            # The neighbors are saved as a CSR lookup (loaded with load_verts_neighbors), and as a pkl for the addon
+            csr = connectivity_per_hemi[hemi].tocsr()
+            csr.eliminate_zeros()
+            csr.sort_indices()
+            indptr, indices = csr.indptr.astype(np.int32), csr.indices.astype(np.int32)
+            utils.save_verts_faces_csr(verts_neighbors_csr_fname.format(hemi=hemi), indptr, indices, 1)
+            for vert in np.where(np.diff(indptr) > 0)[0]:
+                neighbors[vert] = list(indices[indptr[vert]:indptr[vert + 1]])
             utils.save(neighbors, verts_neighbors_fname.format(hemi=hemi))
         utils.save(connectivity_per_hemi, connectivity_fname)
         ret = ret and op.isfile(connectivity_fname)
     return ret
 
 
+def get_verts_neighbors_csr_fname(subject, surf='pial'):
+    return op.join(MMVT_DIR, subject, 'verts_neighbors_csr{}_{}.npz'.format(
+        '' if surf == 'pial' else '_{}'.format(surf), '{hemi}'))
+
+
+def load_verts_neighbors(subject, surf='pial'):
+    # {hemi: lookup}, where lookup[vert] is the array of the vertex's neighbors (a VertsFacesLookup with face_size 1)
+    verts_neighbors_fname = get_verts_neighbors_csr_fname(subject, surf)
+    if not utils.both_hemi_files_exist(verts_neighbors_fname):
+        create_spatial_connectivity(subject, surf_types=(surf,), overwrite=True)
+    return {hemi: utils.load_verts_faces_csr(verts_neighbors_fname.format(hemi=hemi)) for hemi in utils.HEMIS}
+
+
 def load_connectivity(subject):
     connectivity_fname = op.join(MMVT_DIR, subject, 'spatial_connectivity.pkl')
     if not op.isfile(connectivity_fname):
@@ -712,10 +748,7 @@ def calc_three_rois_intersection(subject, rois, output_fol='', model_name='', at
         if op.isfile(output_fname) and not overwrite:
             return utils.load(output_fname)
 
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{hemi}.pkl')
-    if not utils.both_hemi_files_exist(verts_neighbors_fname):
-        print('calc_labeles_contours: You should first run create_spatial_connectivity')
-        create_spatial_connectivity(subject)
+    verts_neighbors = load_verts_neighbors(subject)
 
     contours = op.join(MMVT_DIR, subject, 'labels', '{}_contours_{}.npz'.format(atlas, '{hemi}'))
     if not utils.both_hemi_files_exist(contours):
@@ -726,7 +759,7 @@ def calc_three_rois_intersection(subject, rois, output_fol='', model_name='', at
         d = np.load(contours.format(hemi=hemi))
         hemi_contours = d['contours']
         surf, _ = utils.read_pial(subject, MMVT_DIR, hemi)
-        vertices_neighbors = np.load(verts_neighbors_fname.format(hemi=hemi))
+        vertices_neighbors = verts_neighbors[hemi]
         labels = lu.read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi)
         labels_names = [label.name for label in labels]
         labels_contoures_inds = [set(np.where(hemi_contours == labels_names.index('{}-{}'.format(roi, hemi)) + 1)[0]) \
@@ -767,11 +800,7 @@ def calc_flat_patch_cut_vertices(subject, atlas='aparc.DKTatlas', overwrite=True
                                 ('caudalanteriorcingulate', 'posteriorcingulate'),
                                 ('superiorfrontal', 'posteriorcingulate'), ('paracentral', 'superiorfrontal')]
 
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{hemi}.pkl')
-    if not utils.both_hemi_files_exist(verts_neighbors_fname):
-        print('calc_labeles_contours: You should first run create_spatial_connectivity')
-        create_spatial_connectivity(subject)
-        # return calc_labeles_contours(subject, atlas, overwrite, verbose)
+    verts_neighbors = load_verts_neighbors(subject)
     # vertices_labels_lookup = lu.create_vertices_labels_lookup(subject, atlas, False, overwrite)
     bad_vertices = {}
 
@@ -781,7 +810,7 @@ def calc_flat_patch_cut_vertices(subject, atlas='aparc.DKTatlas', overwrite=True
         calc_labeles_contours(subject, atlas)
     for hemi in utils.HEMIS:
         d = np.load(contours_tempalte.format(hemi=hemi))
-        vertices_neighbors = np.load(verts_neighbors_fname.format(hemi=hemi))
+        vertices_neighbors = verts_neighbors[hemi]
         labels = lu.read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi)
         bad_vertices_hemi = []
         for regions_pair in neighbors_regions_for_cut:
@@ -927,11 +956,7 @@ def calc_labeles_contours(subject, atlas, hemi='both', min_nei_num=2, overwrite=
         else:
             return True
     if verts_neighbors_dict is None:
-        verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{hemi}.pkl')
-        if not utils.both_hemi_files_exist(verts_neighbors_fname):
-            print('calc_labeles_contours: You should first run create_spatial_connectivity')
-            create_spatial_connectivity(subject)
-            return calc_labeles_contours(subject, atlas, overwrite=overwrite, verbose=verbose)
+        verts_neighbors_dict = load_verts_neighbors(subject)
     vertices_labels_lookup = lu.create_vertices_labels_lookup(
         subject, atlas, False, overwrite, hemi=hemi, labels_dict=labels_dict, verts_dict=verts_dict,
         check_unknown=check_unknown, save_lookup=save_lookup)
@@ -942,10 +967,7 @@ def calc_labeles_contours(subject, atlas, hemi='both', min_nei_num=2, overwrite=
         else:
             verts = verts_dict[hemi]
         contours = np.zeros((len(verts)))
-        if verts_neighbors_dict is None:
-            vertices_neighbors = utils.load(verts_neighbors_fname.format(hemi=hemi))
-        else:
-            vertices_neighbors = verts_neighbors_dict[hemi]
+        vertices_neighbors = verts_neighbors_dict[hemi]
         # labels = lu.read_hemi_labels(subject, SUBJECTS_DIR, atlas, hemi)
         if labels_dict is None:
             labels = lu.read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi)
@@ -986,37 +1008,30 @@ def calc_labeles_contours(subject, atlas, hemi='both', min_nei_num=2, overwrite=
 
 
 @utils.timeit
-def create_verts_faces_lookup(subject, surface_type='pial'):
-    output_fname = op.join(MMVT_DIR, subject, 'faces_verts_lookup_{}{}.pkl'.format(
-        '{hemi}', '' if surface_type == 'pial' else '{}_'.format(surface_type)))
-    if utils.both_hemi_files_exist(output_fname):
-        return {hemi:utils.load(output_fname.format(hemi=hemi)) for hemi in utils.HEMIS}
-
+def create_verts_faces_lookup(subject, surface_type='pial', overwrite=False):
+    output_fname = op.join(MMVT_DIR, subject, 'verts_faces_csr_{}{}.npz'.format(
+        '{hemi}', '' if surface_type == 'pial' else '_{}'.format(surface_type)))
     for hemi in utils.HEMIS:
-        if op.isfile(output_fname.format(hemi=hemi)):
+        if op.isfile(output_fname.format(hemi=hemi)) and not overwrite:
             continue
         verts, faces = utils.read_pial(subject, MMVT_DIR, hemi, surface_type)
-        lookup = defaultdict(list)
-        for f_ind, f in tqdm(enumerate(faces)):
-            for v_ind in f:
-                lookup[v_ind].append(f_ind)
-        utils.save(lookup, output_fname.format(hemi=hemi))
+        indptr, indices = utils.calc_verts_faces_csr(faces, len(verts))
+        utils.save_verts_faces_csr(output_fname.format(hemi=hemi), indptr, indices, faces.shape[1])
+    return {hemi: utils.load_verts_faces_csr(output_fname.format(hemi=hemi)) for hemi in utils.HEMIS}
 
 
 @utils.timeit
 def calc_faces_contours(subject, atlas):
-    create_verts_faces_lookup(subject)
+    verts_faces_lookups = create_verts_faces_lookup(subject)
     vertices_labels_lookup = lu.create_vertices_labels_lookup(subject, atlas)
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{hemi}.pkl')
+    verts_neighbors = load_verts_neighbors(subject)
     contours_fname = op.join(MMVT_DIR, subject, 'labels', '{}_contours_{}.npz'.format(atlas, '{hemi}'))
-    # verts_faces_lookup_fname = op.join(MMVT_DIR, subject, 'faces_verts_{}.npy'.format('{hemi}'))
-    verts_faces_lookup_fname = op.join(MMVT_DIR, subject, 'faces_verts_lookup_{}.pkl'.format('{hemi}'))
     output_fname = op.join(MMVT_DIR, subject, 'contours_faces_{}.pkl'.format(atlas))
     contours_faces = dict(rh=set(), lh=set())
     for hemi in utils.HEMIS:
         contours_dict = np.load(contours_fname.format(hemi=hemi))
-        vertices_neighbors = np.load(verts_neighbors_fname.format(hemi=hemi))
-        verts_faces_lookup = utils.load(verts_faces_lookup_fname.format(hemi=hemi))
+        vertices_neighbors = verts_neighbors[hemi]
+        verts_faces_lookup = verts_faces_lookups[hemi]
         contours_vertices = np.where(contours_dict['contours'])[0]
         for vert in tqdm(contours_vertices):
             vert_label = vertices_labels_lookup[hemi].get(vert, '')
@@ -1050,6 +1065,13 @@ def calc_faces_contours(subject, atlas):
 #     return utils.both_hemi_files_exist(out_file)
 
 
+@memo.memoize(
+    inputs=lambda subject, atlas, **_: [
+        get_annot_fname(subject, atlas), op.join(SUBJECTS_DIR, subject, 'label', atlas, '*.label'),
+        op.join(MMVT_DIR, subject, 'surf', '{hemi}.pial.ply')],
+    outputs=lambda subject, atlas, **_: [
+        op.join(SUBJECTS_DIR, subject, 'label', '{}_center_of_mass.{}'.format(atlas, ext)) for ext in ['pkl', 'csv']] +
+        [op.join(MMVT_DIR, subject, '{}_center_of_mass.pkl'.format(atlas))])
 def calc_labels_center_of_mass(subject, atlas, overwrite=False):
     com_fname = op.join(SUBJECTS_DIR, subject, 'label', '{}_center_of_mass.pkl'.format(atlas))
     if op.isfile(com_fname) and not overwrite:
@@ -8,11 +8,12 @@ import shutil
 import itertools
 from scipy.spatial.distance import cdist
 import fnmatch
-from tqdm import tqdm
+from functools import partial
 
 from src.utils import utils
 from src.utils import preproc_utils as pu
 from src.utils import labels_utils as lu
+from src.utils import memo_utils as memo
 from src.preproc import fMRI as fmri
 
 SUBJECTS_DIR, MMVT_DIR, FREESURFER_HOME = pu.get_links()
@@ -369,6 +370,8 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
         #     windows[win_ind] = [win_ind * args.windows_shift, win_ind * args.windows_shift + args.windows_length]
         # windows = windows.astype(np.int)
     elif data.ndim == 3:
+        # The data is already split into windows
+        windows = None
         windows_num = data.shape[2]
     else:
         print('Wronge number of dims in data! Can be 2 or 3, not {}.'.format(data.ndim))
@@ -383,7 +386,7 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
     output_mat_fname = get_output_mat_fname(args.connectivity_method[0], labels_extract_mode)
     static_conn = None
     if op.isfile(output_mat_fname) and not args.recalc_connectivity:
-        conn = np.load(output_mat_fname)
+        conn = utils.upcast(utils.load_storage_npy(output_mat_fname))
         if conn.shape[0] != data.shape[0]:
             args.recalc_connectivity = True
         if 'corr' in args.connectivity_method:
@@ -394,6 +397,8 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
             connectivity_method = 'MI'
         elif 'coherence' in args.connectivity_method:
             connectivity_method = 'COH'
+        elif 'gc' in args.connectivity_method:
+            connectivity_method = 'GC'
     if not op.isfile(output_mat_fname) or args.recalc_connectivity:
         if 'corr' in args.connectivity_method:
             conn = np.zeros((data.shape[0], data.shape[0], windows_num))
@@ -425,7 +430,7 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
                 conn = conn.squeeze()
             backup(output_mat_fname)
             print('Saving {}, {}'.format(output_mat_fname, conn.shape))
-            np.save(output_mat_fname, conn)
+            utils.save_storage_npy(output_mat_fname, conn, 'connectivity')
             connectivity_method = 'Pearson corr'
 
         if 'pli' in args.connectivity_method:
@@ -452,28 +457,65 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
                 # output_mat_fname = op.join(utils.get_parent_fol(output_fname), '{}_{}.npy'.format(
                 #     utils.namebase(output_mat_fname), cond_name))
                 backup(output_mat_fname)
-                np.save(output_mat_fname, conn)
+                utils.save_storage_npy(output_mat_fname, conn, 'connectivity')
             connectivity_method = 'PLI'
 
         if 'coherence' in args.connectivity_method:
             if args.bands == '':
                 args.bands = dict(theta=[4, 8], alpha=[8, 15], beta=[15, 30], gamma=[30, 55], high_gamma=[65, 200])
-            conn = np.zeros((data.shape[0], data.shape[0], len(args.bands))) # What about windows_num?
             if args.use_epochs_for_connectivity_calc:
                 args.epochs_fname = args.epochs_fname.format(subject=subject)
                 if not op.isfile(args.epochs_fname):
                     print('If use_epochs_for_connectivity_calc is True, you should set the flag --epochs_fname')
                     return False
-                data = mne.read_epochs(args.epochs_fname)
-            indices = np.array_split(np.arange(len(args.bands)), args.n_jobs)
-            # for iband, (band, (fmin, fmax)) in enumerate(args.bands.items()):
-            chunks = [(data, chunk_indices, args.sfreq, args.bands)
-                      for chunk_indices in indices]
-            results = utils.run_parallel(_coh_parallel, chunks, args.n_jobs)
-            for chunk in results:
-                for iband, con in chunk.items():
-                    # todo: fix this
-                    conn[:, :, iband] = con
+                epochs = mne.read_epochs(args.epochs_fname)
+                coh_data, sfreq = epochs.get_data(), epochs.info['sfreq']
+                coh_windows = calc_windows(coh_data.shape[2], args.windows_length, args.windows_shift)
+            else:
+                # 3D labels data (labels x time x windows/conditions) -> the third dim is used as epochs
+                coh_data = data if data.ndim == 2 else np.transpose(data, [2, 0, 1])
+                sfreq = args.sfreq
+                coh_windows = windows[:windows_num] if windows is not None else None
+            # All the measures, for all the bands, are calculated from the same cross spectral density, and the
+            # windows are calculated in parallel. The output is labels x labels x bands x windows
+            spectral_conn = calc_spectral_connectivity(
+                coh_data, sfreq, args.bands, windows=coh_windows, n_jobs=args.n_jobs)
+            if spectral_conn['coh'].shape[3] > 1:
+                # One labels x labels x windows output per band, the windows shouldn't be saved as conditions
+                return save_bands_coherence(
+                    subject, spectral_conn, labels_names, conditions, output_fname, conn_mean_mat_fname,
+                    labels_extract_mode, get_output_mat_fname, backup, args)
+            spectral_conn = {method: method_conn[:, :, :, 0] for method, method_conn in spectral_conn.items()}
+            conn = spectral_conn['coh']
+            backup(output_mat_fname)
+            print('Saving {}, {}'.format(output_mat_fname, conn.shape))
+            utils.save_storage_npy(output_mat_fname, conn, 'connectivity')
+            for method in ['imcoh', 'plv', 'wpli']:
+                method_fname = get_output_mat_fname(method, labels_extract_mode)
+                backup(method_fname)
+                utils.save_storage_npy(method_fname, spectral_conn[method], 'connectivity')
+            connectivity_method = 'COH'
+
+        if 'gc' in args.connectivity_method:
+            # conn[i, j, w] is the granger causality j -> i in window w
+            calc_gc = partial(
+                calc_granger_causality, sfreq=args.sfreq, min_order=args.gc_min_order, max_order=args.gc_max_order,
+                criterion=args.gc_criterion, gc_type=args.gc_type, n_jobs=args.n_jobs)
+            if data.ndim == 2:
+                conn = calc_gc(data, windows_length=args.windows_length,
+                               windows_shift=args.windows_shift)[:, :, :windows_num]
+            elif windows is not None:
+                # The third dim is the conditions (or the PCA components): labels x labels x windows x conditions
+                conn = np.stack([calc_gc(data[:, :, ind], windows_length=args.windows_length,
+                                         windows_shift=args.windows_shift)[:, :, :windows_num]
+                                 for ind in range(data.shape[2])], axis=3)
+            else:
+                # The third dim is the windows
+                conn = np.concatenate([calc_gc(data[:, :, w]) for w in range(windows_num)], axis=2)
+            backup(output_mat_fname)
+            print('Saving {}, {}'.format(output_mat_fname, conn.shape))
+            utils.save_storage_npy(output_mat_fname, conn, 'connectivity')
+            connectivity_method = 'GC'
 
         if 'mi' in args.connectivity_method or 'mi_vec' in args.connectivity_method:
             conn = np.zeros((data.shape[0], data.shape[0], windows_num))
@@ -492,7 +534,7 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
             if 'mi' in args.connectivity_method or 'mi_vec' in args.connectivity_method and corr.ndim == 3:
                 conn_fname = get_output_mat_fname('mi', labels_extract_mode)
                 if op.isfile(conn_fname) and not args.recalc_connectivity:
-                    conn = np.load(conn_fname)
+                    conn = utils.upcast(utils.load_storage_npy(conn_fname))
                 if not op.isfile(conn_fname) or conn.shape[0] != data.shape[0] or args.recalc_connectivity:
                     conn = np.zeros(corr.shape)
                     params = [(corr[:, :, w]) for w in range(windows_num)]
@@ -502,11 +544,11 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
                         for w, con in chunk.items():
                             conn[:, :, w] = con
                     backup(conn_fname)
-                    np.save(conn_fname, conn)
+                    utils.save_storage_npy(conn_fname, conn, 'connectivity')
             if 'mi_vec' in args.connectivity_method and corr.ndim == 5:
                 conn_fname = get_output_mat_fname('mi_vec', labels_extract_mode)
                 if op.isfile(conn_fname):
-                    conn = np.load(conn_fname)
+                    conn = utils.upcast(utils.load_storage_npy(conn_fname))
                 if not op.isfile(conn_fname) or conn.shape[0] != data.shape[0]:
                     # comps_num = int(labels_extract_mode.split('_')[1])
                     dims = (data.shape[0], data.shape[0], windows_num)
@@ -518,7 +560,7 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
                         for w, con in chunk.items():
                             conn[:, :, w] = con
                     backup(conn_fname)
-                    np.save(conn_fname, conn)
+                    utils.save_storage_npy(conn_fname, conn, 'connectivity')
             connectivity_method = 'MI'
 
     if 'corr' in args.connectivity_method or 'pli' in args.connectivity_method and \
@@ -528,13 +570,13 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
         for hemi in utils.HEMIS:
             inds = labels_hemi_indices[hemi]
             backup(labels_avg_output_fname.format(hemi=hemi))
-            np.savez(labels_avg_output_fname.format(hemi=hemi), data=avg_per_label[inds], names=labels_names[inds],
-                     conditions=conditions, minmax=[-abs_minmax, abs_minmax])
+            utils.savez_storage(labels_avg_output_fname.format(hemi=hemi), 'connectivity', data=avg_per_label[inds],
+                                names=labels_names[inds], conditions=conditions, minmax=[-abs_minmax, abs_minmax])
         if len(labels_subs_indices) > 0:
             inds = labels_subs_indices
             backup(subs_avg_output_fname)
-            np.savez(subs_avg_output_fname, data=avg_per_label[inds], names=labels_names[inds],
-                     conditions=conditions, minmax=[-abs_minmax, abs_minmax])
+            utils.savez_storage(subs_avg_output_fname, 'connectivity', data=avg_per_label[inds],
+                                names=labels_names[inds], conditions=conditions, minmax=[-abs_minmax, abs_minmax])
     if 'cv' in args.connectivity_method:
         no_wins_connectivity_method = '{} CV'.format(args.connectivity_method)
         # todo: check why if it's not always True, the else fails
@@ -577,7 +619,7 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
                 colors_map='YlOrRd')
     if windows_num > 1 and conn.ndim == 3: # and not op.isfile(conn_mean_mat_fname) :
         mean_conn = np.mean(conn, 2)
-        np.save(conn_mean_mat_fname, mean_conn)
+        utils.save_storage_npy(conn_mean_mat_fname, mean_conn, 'connectivity')
     if not args.save_mmvt_connectivity:
         return True
     if conn.ndim == 3:
@@ -602,6 +644,33 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
     return ret
 
 
+def save_bands_coherence(subject, spectral_conn, labels_names, conditions, output_fname, conn_mean_mat_fname,
+                         labels_extract_mode, get_output_mat_fname, backup, args):
+    # spectral_conn: method: labels x labels x bands x windows. Each band is saved in its own files, with
+    # the windows in the third dim (like the other windowed measures)
+    ret = True
+    for band_ind, band in enumerate(args.bands.keys()):
+        for method, method_conn in spectral_conn.items():
+            method_name = args.connectivity_method[0] if method == 'coh' else method
+            method_fname = get_output_mat_fname('{}_{}'.format(method_name, band), labels_extract_mode)
+            backup(method_fname)
+            print('Saving {}, {}'.format(method_fname, method_conn[:, :, band_ind].shape))
+            utils.save_storage_npy(method_fname, method_conn[:, :, band_ind], 'connectivity')
+        conn = spectral_conn['coh'][:, :, band_ind]
+        utils.save_storage_npy(utils.add_str_to_file_name(conn_mean_mat_fname, '_{}'.format(band)),
+                               np.mean(conn, 2), 'connectivity')
+        if not args.save_mmvt_connectivity:
+            continue
+        band_output_fname = utils.add_str_to_file_name(output_fname, '_{}'.format(band))
+        save_connectivity(
+            subject, conn[:, :, :, np.newaxis], args.atlas, args.connectivity_method, ROIS_TYPE, labels_names,
+            conditions, band_output_fname, windows=args.windows, stat=args.stat,
+            norm_by_percentile=args.norm_by_percentile, norm_percs=args.norm_percs, threshold=args.threshold,
+            threshold_percentile=args.threshold_percentile, symetric_colors=args.symetric_colors)
+        ret = ret and op.isfile(band_output_fname)
+    return ret
+
+
 def pli(data, channels_num, window_length):
     try:
         from scipy.signal import hilbert
@@ -636,28 +705,99 @@ def _pli_parallel(p):
     return res
 
 
-def _coh_parallel(p):
-    res = {}
-    conn_data, indices, sfreq, bands = p
-    # for window_ind, window in zip(indices, conn_data):
-    for iband, (fmin, fmax) in enumerate(bands.values()):
-        print('COH: band {}-{}'.format(fmin, fmax))
-        coh_val = coherence(conn_data, sfreq, fmin, fmax)
-        if not coh_val is None:
-            res[iband] = coh_val
-        else:
-            print('Error in COH! window_ind: {}'.format(iband))
-    return res
+def coherence(data, sfreq, fmin, fmax):
+    return calc_spectral_connectivity(data, sfreq, {'band': (fmin, fmax)}, ('coh',))['coh'][:, :, 0, 0]
 
 
-def coherence(data, sfreq, fmin, fmax):
-    from mne.connectivity import spectral_connectivity
-    # Shouldn't be epochs, should be sources
-    # https://martinos.org/mne/stable/auto_examples/connectivity/plot_mne_inverse_label_connectivity.html#sphx-glr-auto-examples-connectivity-plot-mne-inverse-label-connectivity-py
-    con, freqs, times, n_epochs, n_tapers = spectral_connectivity(
-        data, method='coh', mode='multitaper', sfreq=sfreq, fmin=fmin,
-        fmax=fmax, faverage=True, mt_adaptive=True, n_jobs=1)
-    return con
+SPECTRAL_CONNECTIVITY_METHODS = ('coh', 'imcoh', 'plv', 'wpli')
+GC_MAX_BATCH_MEMORY_GB = 2
+CORR_DEGREE_MAX_BLOCK_MEMORY_MB = 256
+
+
+def calc_spectral_connectivity(data, sfreq, bands, methods=SPECTRAL_CONNECTIVITY_METHODS, windows=None,
+                               mt_bandwidth=None, mt_low_bias=True, n_jobs=1):
+    # data: signals x time, or epochs x signals x time. bands: dict of band name: (fmin, fmax).
+    # The multitaper cross spectral density is calculated once per window, and all the methods, for all the bands,
+    # are derived from it (like mne's spectral_connectivity with faverage=True, but with non adaptive weights).
+    # Returns a dict of method: signals x signals x bands x windows
+    data = np.asarray(data)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    if windows is None:
+        windows = np.array([[0, data.shape[2]]])
+    bands = list(bands.values()) if isinstance(bands, dict) else list(bands)
+    indices = np.array_split(np.arange(len(windows)), max(min(n_jobs, len(windows)), 1))
+    chunks = [([data[:, :, int(windows[w, 0]):int(windows[w, 1])] for w in chunk_indices], chunk_indices, sfreq,
+               bands, methods, mt_bandwidth, mt_low_bias) for chunk_indices in indices if len(chunk_indices) > 0]
+    results = utils.run_parallel(_calc_spectral_connectivity_parallel, chunks, len(chunks))
+    C = data.shape[1]
+    conn = {method: np.zeros((C, C, len(bands), len(windows))) for method in methods}
+    for chunk_conn in results:
+        for w, window_conn in chunk_conn.items():
+            for method in methods:
+                conn[method][:, :, :, w] = window_conn[method]
+    return conn
+
+
+def _calc_spectral_connectivity_parallel(p):
+    windows_data, windows_indices, sfreq, bands, methods, mt_bandwidth, mt_low_bias = p
+    return {w: calc_window_spectral_connectivity(window_data, sfreq, bands, methods, mt_bandwidth, mt_low_bias)
+            for w, window_data in zip(windows_indices, windows_data)}
+
+
+def calc_window_spectral_connectivity(data, sfreq, bands, methods=SPECTRAL_CONNECTIVITY_METHODS, mt_bandwidth=None,
+                                      mt_low_bias=True):
+    from scipy.signal import windows as sig_windows
+    E, C, T = data.shape
+    # The same tapers as mne's _compute_mt_params
+    half_nbw = float(mt_bandwidth) * T / (2. * sfreq) if mt_bandwidth is not None else 4.
+    tapers, eigvals = sig_windows.dpss(T, half_nbw, max(int(2 * half_nbw), 1), return_ratios=True)
+    tapers, eigvals = np.atleast_2d(tapers), np.atleast_1d(eigvals)
+    if mt_low_bias and np.any(eigvals > 0.9):
+        tapers, eigvals = tapers[eigvals > 0.9], eigvals[eigvals > 0.9]
+    freqs = np.fft.rfftfreq(T, 1. / sfreq)
+    freqs_mask = np.zeros(len(freqs), dtype=bool)
+    for fmin, fmax in bands:
+        freqs_mask |= (freqs >= fmin) & (freqs <= fmax)
+    freqs_inds = np.where(freqs_mask)[0]
+    # x_mt: epochs x tapers x signals x freqs, only in the bands' frequencies
+    x_mt = np.fft.rfft(data[:, np.newaxis] * tapers[np.newaxis, :, np.newaxis], axis=-1)[..., freqs_inds]
+    x_mt *= np.sqrt(eigvals)[np.newaxis, :, np.newaxis, np.newaxis]
+    # csd: epochs x freqs x signals x signals
+    csd = np.einsum('ekif,ekjf->efij', x_mt, x_mt.conj()) * (2. / np.sum(eigvals))
+    psd = np.real(np.einsum('efii->efi', csd))
+    freqs = freqs[freqs_inds]
+    conn = {method: np.zeros((C, C, len(bands))) for method in methods}
+    for iband, (fmin, fmax) in enumerate(bands):
+        band_inds = np.where((freqs >= fmin) & (freqs <= fmax))[0]
+        if len(band_inds) == 0:
+            print('calc_spectral_connectivity: No frequencies in {}-{}'.format(fmin, fmax))
+            continue
+        band_csd = csd[:, band_inds]
+        csd_mean = band_csd.mean(0)
+        psd_mean = psd[:, band_inds].mean(0)
+        norm = np.sqrt(psd_mean[:, :, np.newaxis] * psd_mean[:, np.newaxis, :])
+        norm[norm == 0] = np.inf
+        for method in methods:
+            if method == 'coh':
+                band_conn = np.abs(csd_mean) / norm
+            elif method == 'imcoh':
+                band_conn = np.imag(csd_mean) / norm
+            elif method == 'plv':
+                abs_csd = np.abs(band_csd)
+                abs_csd[abs_csd == 0] = np.inf
+                band_conn = np.abs(np.mean(band_csd / abs_csd, 0))
+            elif method == 'wpli':
+                im_csd = np.imag(band_csd)
+                denom = np.mean(np.abs(im_csd), 0)
+                denom[denom == 0] = np.inf
+                band_conn = np.abs(np.mean(im_csd, 0)) / denom
+            else:
+                raise Exception('Unknown spectral connectivity method {}!'.format(method))
+            # Average over the band frequencies
+            conn[method][:, :, iband] = np.mean(band_conn, 0)
+            np.fill_diagonal(conn[method][:, :, iband], 0)
+    return conn
 
 
 def corr_matrix(data, comps_num):
@@ -722,6 +862,186 @@ def _mi_vec_parallel(windows_chunk):
     return res
 
 
+def calc_var_covariances(data, max_order):
+    # data: batch x C x T (demeaned). Returns the normal equations of the VAR(max_order) least squares for all the
+    # batch at once: G = Z Z' (batch x Cp x Cp), B = Z Y' (batch x Cp x C) and Syy = Y Y' (batch x C x C), where
+    # Z is the stacked lagged design matrix (row k * C + c is channel c at lag k + 1) and Y = x(t), t >= max_order.
+    # The leading (C * p) blocks are the normal equations of VAR(p), so all the orders reuse the same covariances.
+    T = data.shape[2]
+    Z = np.concatenate([data[:, :, max_order - k - 1: T - k - 1] for k in range(max_order)], axis=1)
+    Y = data[:, :, max_order:]
+    G = np.matmul(Z, Z.transpose(0, 2, 1))
+    B = np.matmul(Z, Y.transpose(0, 2, 1))
+    Syy = np.matmul(Y, Y.transpose(0, 2, 1))
+    return G, B, Syy, T - max_order
+
+
+def calc_var_orders(G, B, Syy, N, min_order, max_order, criterion='bic'):
+    # Returns the best VAR order per batch item, using AIC or BIC. Orders with singular normal equations are skipped
+    # (0 is returned if all of them are singular)
+    batch, C = Syy.shape[:2]
+    ics = np.full((batch, max_order + 1), np.inf)
+    penalty = 2 if criterion == 'aic' else np.log(N)
+    for order in range(min_order, max_order + 1):
+        Cp = C * order
+        try:
+            A = np.linalg.solve(G[:, :Cp, :Cp], B[:, :Cp])
+        except np.linalg.LinAlgError:
+            # At least one of the batch items is singular, solving them one by one
+            A = np.full((batch, Cp, C), np.nan)
+            for ind in range(batch):
+                try:
+                    A[ind] = np.linalg.solve(G[ind, :Cp, :Cp], B[ind, :Cp])
+                except np.linalg.LinAlgError:
+                    pass
+        sigma = (Syy - np.matmul(B[:, :Cp].transpose(0, 2, 1), A)) / N
+        with np.errstate(invalid='ignore'):
+            sign, logdet = np.linalg.slogdet(sigma)
+        ics[:, order] = np.where(sign > 0, logdet + penalty * order * C ** 2 / N, np.inf)
+    return np.where(np.isinf(ics.min(axis=1)), 0, np.argmin(ics, axis=1))
+
+
+def calc_conditional_granger(G, B, Syy, N, order):
+    # Conditional (multivariate) time domain granger causality: gc[b, i, j] = ln(var(i | all) / var(i | all but j)).
+    # The restricted models aren't fitted: removing the lags of j from the full model increases the residuals sum
+    # of squares of i by a' inv(inv(G)_jj) a, where a are the full model coefficients of j's lags.
+    C = Syy.shape[1]
+    Cp = C * order
+    G_inv = np.linalg.inv(G[:, :Cp, :Cp])
+    A = np.matmul(G_inv, B[:, :Cp])
+    rss = np.diagonal(Syy, axis1=1, axis2=2) - np.einsum('bki,bki->bi', B[:, :Cp], A)
+    lags_inds = np.arange(C)[:, np.newaxis] + C * np.arange(order)[np.newaxis, :]
+    G_inv_jj = G_inv[:, lags_inds[:, :, np.newaxis], lags_inds[:, np.newaxis, :]]
+    A_j = A[:, lags_inds, :]
+    delta_rss = np.einsum('bjki,bjkl,bjli->bij', A_j, np.linalg.inv(G_inv_jj), A_j)
+    gc = np.log(1 + delta_rss / rss[:, :, np.newaxis])
+    gc[:, np.arange(C), np.arange(C)] = 0
+    return gc
+
+
+def calc_pairwise_granger(G, B, Syy, N, order, sfreq=1, fmin=None, fmax=None, n_freqs=64):
+    # Pairwise (bivariate) granger causality: gc[b, i, j] is the causality j -> i. The bivariate models are
+    # sub-blocks of the multivariate covariances. If fmin or fmax are set, the Geweke spectral causality is
+    # averaged over the band (like nitime's GrangerAnalyzer), otherwise the time domain causality is returned.
+    batch, C = Syy.shape[:2]
+    lags = C * np.arange(order)
+    gc = np.zeros((batch, C, C))
+    spectral = fmin is not None or fmax is not None
+    if spectral:
+        freqs = np.linspace(0, sfreq / 2, n_freqs)
+        freqs_mask = np.ones(n_freqs, dtype=bool)
+        if fmin is not None:
+            freqs_mask &= freqs > fmin
+        if fmax is not None:
+            freqs_mask &= freqs < fmax
+        freqs = freqs[freqs_mask]
+        # e^(-2*pi*i*f*k/sfreq) for k = 1..order
+        exps = np.exp(-2j * np.pi * np.outer(freqs, np.arange(1, order + 1)) / sfreq)
+    for i in range(C):
+        # The diagonal is replaced by another channel and zeroed at the end, to keep G_ij invertible
+        others = np.array([j if j != i else (i + 1) % C for j in range(C)])
+        inds = np.concatenate((np.tile(i + lags, (C, 1)), others[:, np.newaxis] + lags[np.newaxis, :]), axis=1)
+        G_ij = G[:, inds[:, :, np.newaxis], inds[:, np.newaxis, :]]
+        B_ij = np.stack((B[:, inds, i], np.take_along_axis(
+            B[:, inds, :], others[np.newaxis, :, np.newaxis, np.newaxis], axis=3)[..., 0]), axis=3)
+        A_ij = np.linalg.solve(G_ij, B_ij)
+        S_ij = np.empty((batch, C, 2, 2))
+        S_ij[:, :, 0, 0] = Syy[:, i, i][:, np.newaxis]
+        S_ij[:, :, 0, 1] = S_ij[:, :, 1, 0] = Syy[:, i, others]
+        S_ij[:, :, 1, 1] = Syy[:, others, others]
+        sigma = (S_ij - np.matmul(B_ij.transpose(0, 1, 3, 2), A_ij)) / N
+        if not spectral:
+            # The restricted model is the univariate AR of i
+            own_inds = i + lags
+            b_i = B[:, own_inds, i]
+            rss_restricted = Syy[:, i, i] - np.einsum('bk,bk->b', b_i, np.linalg.solve(
+                G[:, own_inds[:, np.newaxis], own_inds], b_i[:, :, np.newaxis])[:, :, 0])
+            gc[:, i] = np.log(rss_restricted[:, np.newaxis] / (N * sigma[:, :, 0, 0]))
+        else:
+            # A_k[target, source], A_ij rows are [i lags, j lags], columns are [i, j]
+            A_k = np.stack((A_ij[:, :, :order], A_ij[:, :, order:]), axis=3)  # batch x C x order x 2(source) x 2(target)
+            A_f = np.eye(2) - np.einsum('fk,bckst->bcfts', exps, A_k)
+            H = np.linalg.inv(A_f)
+            S_xx = np.einsum('bcfs,bcst,bcft->bcf', H[:, :, :, 0, :], sigma.astype(complex),
+                             H[:, :, :, 0, :].conj()).real
+            partial_var = sigma[:, :, 1, 1] - sigma[:, :, 0, 1] ** 2 / sigma[:, :, 0, 0]
+            gc_f = np.log(S_xx / (S_xx - partial_var[:, :, np.newaxis] * np.abs(H[:, :, :, 0, 1]) ** 2))
+            gc[:, i] = np.nanmean(gc_f, axis=2) if gc_f.shape[2] > 0 else 0
+    gc[:, np.arange(C), np.arange(C)] = 0
+    gc[np.isnan(gc)] = 0
+    return gc
+
+
+def calc_gc_batch_size(C, T, max_order, max_memory_gb=GC_MAX_BATCH_MEMORY_GB):
+    # The lagged design matrix (Cp x T) and the normal equations (Cp x Cp, where Cp = C * max_order, a few copies of
+    # them are made while solving) of every batch item are in memory together
+    Cp = C * max_order
+    item_bytes = 8 * (Cp * (T + C) + 3 * Cp ** 2)
+    batch_size = int(max_memory_gb * 2 ** 30 // item_bytes)
+    if batch_size == 0:
+        print('calc_granger_causality: A single VAR({}) model of {} channels needs {:.1f}GB!'.format(
+            max_order, C, item_bytes / 2 ** 30))
+    return max(1, batch_size)
+
+
+def calc_granger_causality(data, sfreq=1, min_order=1, max_order=10, fmin=None, fmax=None, windows_length=0,
+                           windows_shift=0, criterion='bic', gc_type='pairwise', batch_size=0, n_jobs=1,
+                           max_memory_gb=GC_MAX_BATCH_MEMORY_GB):
+    # data: C x T or epochs x C x T. Returns C x C x windows (the calc_lables_connectivity layout), where
+    # gc[i, j, w] is the causality j -> i in window w, averaged over the epochs.
+    # All the windows (and epochs) are estimated together, in batches of batch_size (if 0, as many as fit in
+    # max_memory_gb per job).
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    E, C, T = data.shape
+    windows = calc_windows(T, windows_length, windows_shift)
+    windows_data = np.array([data[:, :, w_from:w_to] for w_from, w_to in windows])
+    W = len(windows)
+    windows_data = windows_data.reshape((W * E, C, windows_data.shape[3]))
+    windows_data -= windows_data.mean(axis=2, keepdims=True)
+    # The VAR(p) normal equations are singular if there are less samples than parameters (T - p <= C * p)
+    max_possible_order = (windows_data.shape[2] - 1) // (C + 1)
+    if max_order > max_possible_order:
+        print('calc_granger_causality: The windows ({} samples) are too short for VAR({}) of {} channels, '
+              'using max order {}'.format(windows_data.shape[2], max_order, C, max_possible_order))
+        max_order = max_possible_order
+        min_order = min(min_order, max_order)
+    if max_order < 1:
+        raise Exception('calc_granger_causality: The windows are too short for {} channels!'.format(C))
+    if batch_size <= 0:
+        batch_size = calc_gc_batch_size(C, windows_data.shape[2], max_order, max_memory_gb)
+    batches = [windows_data[ind:ind + batch_size] for ind in range(0, W * E, batch_size)]
+    params = [(batch, sfreq, min_order, max_order, fmin, fmax, criterion, gc_type) for batch in batches]
+    results = utils.run_parallel(_calc_granger_causality_parallel, params, n_jobs)
+    gc = np.concatenate(results).reshape((W, E, C, C)).mean(axis=1)
+    return np.transpose(gc, (1, 2, 0))
+
+
+def _calc_granger_causality_parallel(p):
+    data, sfreq, min_order, max_order, fmin, fmax, criterion, gc_type = p
+    G, B, Syy, N = calc_var_covariances(data, max_order)
+    if min_order == max_order:
+        orders = np.full(len(data), max_order)
+    else:
+        orders = calc_var_orders(G, B, Syy, N, min_order, max_order, criterion)
+    gc = np.zeros((len(data), data.shape[1], data.shape[1]))
+    for order in np.unique(orders):
+        inds = np.where(orders == order)[0]
+        if order == 0:
+            print('calc_granger_causality: The VAR models of {} windows are singular for all the orders'.format(
+                len(inds)))
+            continue
+        try:
+            if gc_type == 'conditional':
+                gc[inds] = calc_conditional_granger(G[inds], B[inds], Syy[inds], N, order)
+            else:
+                gc[inds] = calc_pairwise_granger(G[inds], B[inds], Syy[inds], N, order, sfreq, fmin, fmax)
+        except np.linalg.LinAlgError:
+            print('calc_granger_causality: The VAR({}) model of {} windows is singular'.format(order, len(inds)))
+    return gc
+
+
 @utils.tryit()
 def save_connectivity(subject, conn, atlas, connectivity_method, obj_type, labels_names, conditions, output_fname,
                       windows=0, stat=STAT_DIFF, norm_by_percentile=True, norm_percs=[1, 99],
@@ -983,9 +1303,9 @@ def calc_electrodes_rest_connectivity(subject, args):
         #     con = np.mean(con, 2) # Over freqs
         #     conn[:, :, w] = con + con.T
 
-        np.save(output_mat_fname, conn)
+        utils.save_storage_npy(output_mat_fname, conn, 'connectivity')
     else:
-        conn = np.load(output_mat_fname)
+        conn = utils.upcast(utils.load_storage_npy(output_mat_fname))
 
     connectivity_method = 'PLI'
     no_wins_connectivity_method = '{} CV'.format(connectivity_method)
@@ -1049,13 +1369,7 @@ def calc_label_corr(subject, x, label, hemi, label_name, identifier, overwrite=F
     label_ts = np.mean(x[hemi][label.vertices, :], 0)
     corr_min, corr_max = 0 , 0
     for hemi in utils.HEMIS:
-        verts_num = x[hemi].shape[0]
-        corr_vals = np.zeros((verts_num))
-        indices = np.array_split(np.arange(verts_num), n_jobs)
-        chunks = [(x[hemi][indices_chunk], indices_chunk, label_ts, thread) for thread, indices_chunk in enumerate(indices)]
-        for hemi_corr_chunk, indices_chunk in utils.run_parallel(_calc_label_corr, chunks, n_jobs):
-            corr_vals[indices_chunk] = hemi_corr_chunk
-        corr_vals[np.isnan(corr_vals)] = 0
+        corr_vals = calc_seed_corr_map(x[hemi], label_ts)
         np.save(output_fname_template.format(hemi=hemi), corr_vals)
         corr_min = min(corr_min, np.min(corr_vals))
         corr_max = max(corr_max, np.max(corr_vals))
@@ -1065,32 +1379,105 @@ def calc_label_corr(subject, x, label, hemi, label_name, identifier, overwrite=F
     return utils.both_hemi_files_exist(output_fname_template) and op.isfile(minmax_fname)
 
 
-@utils.ignore_warnings
-def _calc_label_corr(p):
-    hemi_data, indices_chunk, label_ts, thread = p
-    hemi_corr = np.zeros((len(indices_chunk)))
-    for ind, v_ts in tqdm(enumerate(hemi_data), total=len(indices_chunk)):
-        hemi_corr[ind] = np.corrcoef(label_ts, v_ts)[0, 1]
-    return hemi_corr, indices_chunk
+def zscore_time_series(x):
+    # Normalizes each row (time series) to zero mean and unit norm, so the dot product of two rows is their
+    # Pearson correlation. Constant time series are set to zeros (zero correlation instead of nan).
+    x = np.array(x, dtype=np.float64)
+    x -= x.mean(axis=-1, keepdims=True)
+    norm = np.linalg.norm(x, axis=-1, keepdims=True)
+    norm[norm == 0] = np.inf
+    x /= norm
+    return x
+
+
+def calc_seed_corr_map(data, seed_ts, block_size=10000):
+    # The correlation between the seed and all the vertices, as one matrix-vector product per vertices block
+    seed_ts = zscore_time_series(seed_ts)
+    corr_vals = np.zeros(data.shape[0])
+    for from_ind in range(0, data.shape[0], block_size):
+        to_ind = min(from_ind + block_size, data.shape[0])
+        corr_vals[from_ind:to_ind] = zscore_time_series(data[from_ind:to_ind]).dot(seed_ts)
+    return corr_vals
+
+
+def calc_corr_block_size(N, max_memory_mb=CORR_DEGREE_MAX_BLOCK_MEMORY_MB):
+    # The number of rows of a (float64) block x N correlation block that fit in max_memory_mb
+    return max(1, int(max_memory_mb * 2 ** 20 // (8 * N)))
+
+
+def calc_corr_degree(data, threshold=0.7, block_size=0, max_memory_mb=CORR_DEGREE_MAX_BLOCK_MEMORY_MB):
+    # The degree (number of correlations > threshold) and strength (sum of these correlations) of each time series.
+    # The correlation matrix is calculated in blocks of rows (block_size x N), and never as a whole N x N matrix.
+    # If block_size <= 0, it's derived from max_memory_mb
+    z = zscore_time_series(data)
+    N = z.shape[0]
+    if block_size <= 0:
+        block_size = calc_corr_block_size(N, max_memory_mb)
+    degree, strength = np.zeros(N, dtype=np.int64), np.zeros(N)
+    for from_ind in range(0, N, block_size):
+        to_ind = min(from_ind + block_size, N)
+        corr = z[from_ind:to_ind].dot(z.T)
+        block_indices = np.arange(to_ind - from_ind)
+        corr[block_indices, block_indices + from_ind] = 0
+        corr[corr <= threshold] = 0
+        degree[from_ind:to_ind] = np.count_nonzero(corr, axis=1)
+        strength[from_ind:to_ind] = np.sum(corr, axis=1)
+    return degree, strength
+
+
+def calc_fmri_vertices_corr_degree(subject, identifier='', threshold=0.7, block_size=0, overwrite=False):
+    output_fname_template = op.join(MMVT_DIR, subject, 'fmri', 'fmri_{}corr_{}_{}_{}.npy'.format(
+        '{}_'.format(identifier) if identifier != '' else '', str(threshold), '{measure}', '{hemi}'))
+    if all([utils.both_hemi_files_exist(output_fname_template.replace('{measure}', measure))
+            for measure in ['degree', 'strength']]) and not overwrite:
+        return True
+    x = fmri.load_fmri_data_for_both_hemis(subject, identifier)
+    for hemi in utils.HEMIS:
+        degree, strength = calc_corr_degree(x[hemi], threshold, block_size)
+        np.save(output_fname_template.format(measure='degree', hemi=hemi), degree)
+        np.save(output_fname_template.format(measure='strength', hemi=hemi), strength)
+    return all([utils.both_hemi_files_exist(output_fname_template.replace('{measure}', measure))
+                for measure in ['degree', 'strength']])
 
 
-def calc_fmri_corr_degree(subject, identifier='', threshold=0.7, connectivity_method='corr'):
-    if isinstance(connectivity_method, str):
-        connectivity_method = [connectivity_method]
-    connectivity_method = connectivity_method[0]
+def get_fmri_corr_degree_fnames(subject, identifier='', threshold=0.7, connectivity_method='corr'):
+    if not isinstance(connectivity_method, str):
+        connectivity_method = connectivity_method[0]
     identifier = '{}_static_'.format(identifier) if identifier != '' else 'static_'
     corr_fname = op.join(MMVT_DIR, subject, 'connectivity', 'fmri_{}{}.npy'.format(identifier, connectivity_method))
+    output_fname = op.join(MMVT_DIR, subject, 'connectivity',  '{}{}_{}_degree.npy'.format(
+        identifier.replace('_static', ''), connectivity_method, str(threshold)))
+    return corr_fname, output_fname
+
+
+@memo.memoize(
+    inputs=lambda subject, identifier, threshold, connectivity_method, **_: get_fmri_corr_degree_fnames(
+        subject, identifier, threshold, connectivity_method)[:1],
+    outputs=lambda subject, identifier, threshold, connectivity_method, **_: [
+        fname for fname in get_fmri_corr_degree_fnames(subject, identifier, threshold, connectivity_method)[1:]
+        for fname in [fname, fname.replace('_degree.npy', '_strength.npy')]],
+    ignore_args=('block_size',))
+def calc_fmri_corr_degree(subject, identifier='', threshold=0.7, connectivity_method='corr', block_size=0):
+    corr_fname, output_fname = get_fmri_corr_degree_fnames(subject, identifier, threshold, connectivity_method)
     if not op.isfile(corr_fname):
         print("Can't find the connectivity fname ({})!".format(corr_fname))
         print("You should call calc_lables_connectivity first, like in " +
               "src.preproc.examples.connectivity.calc_fmri_static_connectivity with windows_length=0")
         return False
-    corr = np.load(corr_fname)
-    np.fill_diagonal(corr, 0)
-    degree_mat = np.sum(corr > threshold, 1)
-    output_fname = op.join(MMVT_DIR, subject, 'connectivity',  '{}{}_{}_degree.npy'.format(
-        identifier.replace('_static', ''), connectivity_method, str(threshold)))
+    corr = utils.load_storage_npy(corr_fname, mmap_mode='r')
+    degree_mat, strength_mat = np.zeros(corr.shape[0], dtype=np.int64), np.zeros(corr.shape[0])
+    if block_size <= 0:
+        block_size = calc_corr_block_size(corr.shape[1])
+    for from_ind in range(0, corr.shape[0], block_size):
+        to_ind = min(from_ind + block_size, corr.shape[0])
+        corr_block = utils.upcast(np.array(corr[from_ind:to_ind]))
+        block_indices = np.arange(to_ind - from_ind)
+        corr_block[block_indices, block_indices + from_ind] = 0
+        corr_block[corr_block <= threshold] = 0
+        degree_mat[from_ind:to_ind] = np.count_nonzero(corr_block, axis=1)
+        strength_mat[from_ind:to_ind] = np.sum(corr_block, axis=1)
     np.save(output_fname, degree_mat)
+    np.save(output_fname.replace('_degree.npy', '_strength.npy'), strength_mat)
     return op.isfile(output_fname)
 
 
@@ -1123,6 +1510,10 @@ def main(subject, remote_subject_dir, args, flags):
         flags['calc_fmri_corr_degree'] = calc_fmri_corr_degree(
             subject, args.identifier, args.connectivity_threshold, args.connectivity_method)
 
+    if utils.should_run(args, 'calc_fmri_vertices_corr_degree'):
+        flags['calc_fmri_vertices_corr_degree'] = calc_fmri_vertices_corr_degree(
+            subject, args.identifier, args.connectivity_threshold, overwrite=args.overwrite_seed_data)
+
     return flags
 
 
@@ -1165,6 +1556,10 @@ def read_cmd_args(argv=None):
     parser.add_argument('--fmax', help='', required=False, default=0, type=float)
     parser.add_argument('--bands', required=False, default='')
     parser.add_argument('--epochs_fname', required=False, default='')
+    parser.add_argument('--gc_min_order', help='', required=False, default=1, type=int)
+    parser.add_argument('--gc_max_order', help='', required=False, default=10, type=int)
+    parser.add_argument('--gc_criterion', help='aic/bic', required=False, default='bic')
+    parser.add_argument('--gc_type', help='pairwise/conditional', required=False, default='pairwise')
 
 
     parser.add_argument('--use_epochs_for_connectivity_calc', help='', required=False, default=0, type=au.is_true)
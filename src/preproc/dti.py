@@ -1,8 +1,10 @@
 import nibabel as nib
 import os.path as op
 from src.utils import utils
+from src.mmvt_addon import tracts_store as ts
 import numpy as np
 import os
+import glob
 
 LINKS_DIR = utils.get_links_dir()
 SUBJECTS_DIR = utils.get_link_dir(LINKS_DIR, 'subjects', 'SUBJECTS_DIR')
@@ -33,11 +35,28 @@ def load_tracula_trk(subject):
         hdr = convert_header(hdr)
         vox2ras_trans = get_vox2ras_trans(subject)
         tracks = read_tracks(track_gen, hdr, vox2ras_trans)
-        output_fname = op.join(output_fol, '{}.pkl'.format(track_fol_name))
-        utils.save(tracks, output_fname)
+        output_fname = op.join(output_fol, '{}{}'.format(track_fol_name, ts.STORE_POSTFIX))
+        save_tracks(tracks, output_fname)
         print('Save in {}'.format(output_fname))
 
 
+def save_tracks(tracks, output_fname, medium_max_tracts=20000, medium_points_step=2, low_clusters_num=500):
+    # Saves the tracks as one concatenated float32 points array with offsets, with the level-of-detail subsets
+    store = ts.from_tracks(tracks)
+    lods = ts.calc_lods(store, medium_max_tracts, medium_points_step, low_clusters_num)
+    ts.save(store, output_fname, lods)
+    print('{} tracks ({} points), lods: {}'.format(store.tracts_num, store.points_num, ', '.join(
+        ['{} {}'.format(lod, lod_store.tracts_num) for lod, lod_store in lods.items()])))
+
+
+def convert_legacy_tracks(subject, overwrite=False):
+    # Converts the pickles of tracks list into the tracts store
+    output_fol = op.join(BLENDER_ROOT_DIR, subject, 'dti', 'tracula')
+    for pkl_fname in glob.glob(op.join(output_fol, '*.pkl')):
+        output_fname = ts.convert_tracks_file(pkl_fname, overwrite=overwrite)
+        print('{} was converted to {}'.format(pkl_fname, output_fname))
+
+
 def convert_header(hdr):
     props = ['id_string', 'dim', 'voxel_size', 'origin', 'n_scalars', 'scalar_name', 'n_properties', 'property_name',
         'vox_to_ras', 'reserved', 'voxel_order', 'pad2', 'image_orientation_patient', 'pad1', 'invert_x', 'invert_y',
@@ -115,7 +115,12 @@ def calc_elas(subject, template, specific_elecs_names=[], bipolar=False, atlas='
     template_header = nib.load(op.join(SUBJECTS_DIR, template, 'mri', 'T1.mgz')).header
     epsilon = 0
     max_run_num = 1000
-    parallel = True
+    # The template's data is loaded once into the workers, and the candidates are evaluated in one batched call
+    template_ela_evaluator = TemplateElaEvaluator(
+        template, bipolar, template_labels_vertices, template_aseg_data, lut, template_pia_verts,
+        template_len_lh_pia, template_regions_center_of_mass, template_regions_names,
+        template_header.get_vox2ras_tkr(), excludes, error_radius, elc_length, n_jobs)
+    dxyzs = np.array([(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)])
 
     for elec_name, elec_pos, elec_dist, elec_type, elec_ori in elecs_info:
         elec_output_fname = op.join(fol, '{}_ela_morphed.npz'.format(elec_name))
@@ -133,7 +138,7 @@ def calc_elas(subject, template, specific_elecs_names=[], bipolar=False, atlas='
         template_elec_pos = calc_prob_pos(elec_labeling_no_whites, template_regions_center_of_mass, template_regions_names)
         subject_prob_pos_in_template_space = template_elec_pos.copy()
         template_elec_vox = np.rint(
-            utils.apply_trans(np.linalg.inv(template_header.get_vox2ras_tkr()), template_elec_pos).astype(int))
+            utils.apply_trans(np.linalg.inv(template_header.get_vox2ras_tkr()), template_elec_pos)).astype(int)
 
         elec_labeling_template = calc_ela(
             template, bipolar, elec_name, template_elec_pos, elec_type, elec_ori, elec_dist, template_labels_vertices, template_aseg_data, lut,
@@ -141,57 +146,31 @@ def calc_elas(subject, template, specific_elecs_names=[], bipolar=False, atlas='
         err = comp_elecs_labeling(
             elec_labeling_template, template_regions_center_of_mass, template_regions_names,
             subject_prob_pos_in_template_space)
+        template_ela_evaluator.set_electrode(
+            elec_name, elec_type, elec_ori, elec_dist, subject_prob_pos_in_template_space)
+        new_template_pos = template_elec_pos
         run_num = 0
         stop_gradient = False
         print(err)
         while not stop_gradient and err > epsilon and run_num < max_run_num:
-            dxyzs = [(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)]
-            if parallel:
-                new_template_elec_pos_arr = [
-                    utils.apply_trans(template_header.get_vox2ras_tkr(), template_elec_vox + dxyz) for
-                    dxyz in dxyzs]
-                params = [(template, bipolar, elec_name, new_template_elec_pos, elec_type, elec_ori, elec_dist,
-                           template_labels_vertices, template_aseg_data, lut, template_pia_verts, template_len_lh_pia,
-                           elec_labeling_no_whites, regions_center_of_mass, regions_names,
-                           template_regions_center_of_mass, template_regions_names, subject_prob_pos_in_template_space,
-                           excludes, error_radius, elc_length, overwrite)
-                          for new_template_elec_pos in new_template_elec_pos_arr]
-                results = utils.run_parallel(_parallel_calc_ela_err, params, len(dxyzs) if n_jobs > 1 else 1)
-                errs = [res[1] for res in results]
-                ind = np.argmin(errs)
-                new_template_pos = new_template_elec_pos_arr[ind]
-                best_ela = results[ind][0]
-                regions, new_probs = norm_probs(calc_elec_labeling_no_white(best_ela))
-                print(['{} ({}) '.format(r, p) for r, p in zip(regions, new_probs)])
-                min_err = errs[ind]
-                if min_err >= err:
-                    stop_gradient = True
-                else:
-                    err = min_err
+            candidates_voxels = template_elec_vox + dxyzs
+            results = template_ela_evaluator.calc_elas_errs(candidates_voxels)
+            errs = [res[1] for res in results]
+            ind = np.argmin(errs)
+            min_err = errs[ind]
+            if min_err >= err:
+                stop_gradient = True
             else:
-                for dxyz in dxyzs:
-                    new_template_elec_pos = utils.apply_trans(
-                        template_header.get_vox2ras_tkr(), template_elec_vox + dxyz)
-                    elec_labeling_template = calc_ela(
-                        template, bipolar, elec_name, new_template_elec_pos, elec_type, elec_ori, elec_dist,
-                        template_labels_vertices, template_aseg_data, lut,
-                        template_pia_verts, template_len_lh_pia, excludes, error_radius, elc_length,
-                        print_warnings, overwrite, n_jobs)
-                    new_err = comp_elecs_labeling(
-                        elec_labeling_template, template_regions_center_of_mass, template_regions_names,
-                        subject_prob_pos_in_template_space)
-                    if new_err < err:
-                        new_template_pos = new_template_elec_pos
-                        err = new_err
-                        break
-                else:
-                    stop_gradient = True
+                err = min_err
+                elec_labeling_template = results[ind][0]
+                template_elec_vox = candidates_voxels[ind]
+                new_template_pos = utils.apply_trans(template_header.get_vox2ras_tkr(), template_elec_vox)
+                regions, new_probs = norm_probs(calc_elec_labeling_no_white(elec_labeling_template))
+                print(['{} ({}) '.format(r, p) for r, p in zip(regions, new_probs)])
 
             print('*** {}){} ***'.format(run_num + 1, err))
             print_ela(elec_labeling_template)
             run_num += 1
-            template_elec_vox = np.rint(
-                utils.apply_trans(np.linalg.inv(template_header.get_vox2ras_tkr()), new_template_pos).astype(int))
             if stop_gradient:
                 print('Stop gradient!!!')
                 print('subject_ela:')
@@ -200,29 +179,77 @@ def calc_elas(subject, template, specific_elecs_names=[], bipolar=False, atlas='
                 print_ela(elec_labeling_template)
         print('Save output to {}'.format(elec_output_fname))
         np.savez(elec_output_fname, pos=new_template_pos, name=elec_name, err=err)
+    template_ela_evaluator.close()
+
+
+class TemplateElaEvaluator(object):
+    # Evaluates the template's ela (and its error) in candidate voxels. The template's data is sent only once to the
+    # workers (pool initializer), and the results are memoized per voxel for the current electrode.
+    def __init__(self, template, bipolar, labels_vertices, aseg_data, lut, pia_verts, len_lh_pia,
+                 regions_center_of_mass, regions_names, vox2ras_tkr, excludes, error_radius=3, elc_length=4,
+                 n_jobs=1):
+        template_data = dict(
+            template=template, bipolar=bipolar, labels_vertices=labels_vertices, aseg_data=aseg_data, lut=lut,
+            pia_verts=pia_verts, len_lh_pia=len_lh_pia, regions_center_of_mass=regions_center_of_mass,
+            regions_names=regions_names, vox2ras_tkr=vox2ras_tkr, excludes=excludes, error_radius=error_radius,
+            elc_length=elc_length)
+        self.n_jobs = n_jobs
+        if n_jobs > 1:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(
+                processes=n_jobs, initializer=_init_template_ela_data, initargs=(template_data,))
+        else:
+            self.pool = None
+            _init_template_ela_data(template_data)
+        self.elec_info = None
+        self.cache = {}
+
+    def set_electrode(self, elec_name, elec_type, elec_ori, elec_dist, subject_prob_pos):
+        self.elec_info = (elec_name, elec_type, elec_ori, elec_dist, subject_prob_pos)
+        self.cache = {}
+
+    def calc_elas_errs(self, voxels):
+        voxels = [tuple(int(x) for x in vox) for vox in voxels]
+        new_voxels = [vox for vox in set(voxels) if vox not in self.cache]
+        if len(new_voxels) > 0:
+            params = [(vox, self.elec_info) for vox in new_voxels]
+            if self.pool is None:
+                results = [_calc_template_vox_ela_err(p) for p in params]
+            else:
+                results = self.pool.map(_calc_template_vox_ela_err, params)
+            self.cache.update(zip(new_voxels, results))
+        return [self.cache[vox] for vox in voxels]
 
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
 
-def print_ela(ela):
-    print(','.join(sorted(['{}:{:.2f}'.format(region, prob) for region, prob in zip(
-        ela['regions'], ela['regions_probs'])])))
+_template_ela_data = {}
+
 
+def _init_template_ela_data(template_data):
+    _template_ela_data.update(template_data)
 
-def _parallel_calc_ela_err(p):
-    (template, bipolar, elec_name, new_template_elec_pos, elec_type, elec_ori, elec_dist, template_labels_vertices,
-     template_aseg_data, lut, template_pia_verts, template_len_lh_pia, elec_labeling_no_whites, regions_center_of_mass,
-     regions_names, template_regions_center_of_mass, template_regions_names, subject_prob_pos, excludes,
-     error_radius, elc_length, overwrite) = p
+
+def _calc_template_vox_ela_err(p):
+    vox, (elec_name, elec_type, elec_ori, elec_dist, subject_prob_pos) = p
+    d = utils.Bag(_template_ela_data)
+    template_elec_pos = utils.apply_trans(d.vox2ras_tkr, np.array(vox))
     elec_labeling_template = calc_ela(
-        template, bipolar, elec_name, new_template_elec_pos, elec_type, elec_ori, elec_dist,
-        template_labels_vertices, template_aseg_data, lut,
-        template_pia_verts, template_len_lh_pia, excludes, error_radius, elc_length, overwrite, 1)
+        d.template, d.bipolar, elec_name, template_elec_pos, elec_type, elec_ori, elec_dist, d.labels_vertices,
+        d.aseg_data, d.lut, d.pia_verts, d.len_lh_pia, d.excludes, d.error_radius, d.elc_length)
     err = comp_elecs_labeling(
-        elec_labeling_template, template_regions_center_of_mass, template_regions_names,
-        subject_prob_pos)
+        elec_labeling_template, d.regions_center_of_mass, d.regions_names, subject_prob_pos)
     return elec_labeling_template, err
 
 
+def print_ela(ela):
+    print(','.join(sorted(['{}:{:.2f}'.format(region, prob) for region, prob in zip(
+        ela['regions'], ela['regions_probs'])])))
+
+
 def calc_elec_labeling_no_white(elec_labeling):
     return [(region, prob) for region, prob in zip(elec_labeling['regions'], elec_labeling['regions_probs']) if
         region not in WHITES]
@@ -24,6 +24,7 @@ from src.utils import preproc_utils as pu
 from src.utils import geometry_utils as gu
 from src.utils import labels_utils as lu
 from src.utils import args_utils as au
+from src.utils import memo_utils as memo
 
 SUBJECTS_DIR, MMVT_DIR, FREESURFER_HOME = pu.get_links()
 ELECTRODES_DIR = utils.get_link_dir(utils.get_links_dir(), 'electrodes')
@@ -233,13 +234,19 @@ def read_electrodes_data(elecs_data_dic, conditions, montage_file, output_file_n
     np.savez(output_file_name, data=data, names=sfp.ch_names, conditions=conditions, colors=colors)
 
 
-def calc_dist_mat(subject, bipolar=False, snap=False):
-    from scipy.spatial import distance
-
+def get_dist_mat_fnames(subject, bipolar=False, snap=False):
     pos_fname = 'electrodes{}_{}positions.npz'.format('_bipolar' if bipolar else '', 'snap_' if snap else '')
     pos_fname = op.join(MMVT_DIR, subject, 'electrodes', pos_fname)
     output_fname = 'electrodes{}_{}dists.npy'.format('_bipolar' if bipolar else '', 'snap_' if snap else '')
     output_fname = op.join(MMVT_DIR, subject, 'electrodes', output_fname)
+    return pos_fname, output_fname
+
+
+@memo.memoize(inputs=lambda **kw: get_dist_mat_fnames(**kw)[:1], outputs=lambda **kw: get_dist_mat_fnames(**kw)[1:])
+def calc_dist_mat(subject, bipolar=False, snap=False):
+    from scipy.spatial import distance
+
+    pos_fname, output_fname = get_dist_mat_fnames(subject, bipolar, snap)
 
     if not op.isfile(pos_fname):
         return False
@@ -807,7 +814,7 @@ def create_raw_data_from_edf(subject, args, stat=STAT_DIFF, electrodes_type=None
         power_line_freqs = np.arange(args.power_line_freq, args.power_line_freq * 4 + 1, args.power_line_freq)
         power_line_freqs = [f for f in power_line_freqs if f < fs / 2] # must be less than the Nyquist frequency
         edf_raw.notch_filter(power_line_freqs, notch_widths=args.power_line_notch_widths)
-    if not (args.lower_freq_filter is None and args.upper_freq_filter is None):
+    if args.preload and not (args.lower_freq_filter is None and args.upper_freq_filter is None):
         edf_raw.filter(args.lower_freq_filter, args.upper_freq_filter)
     dt = (edf_raw.times[1] - edf_raw.times[0])
     hz = int(1/ dt)
@@ -835,6 +842,9 @@ def create_raw_data_from_edf(subject, args, stat=STAT_DIFF, electrodes_type=None
     ref_ind = edf_raw.ch_names.index(args.ref_elec) if args.ref_elec != '' else -1
     if do_plot:
         plot_electrodes(subject, edf_raw, data_channels, ref_ind)
+    if not args.preload:
+        return stream_edf_to_electrodes_data(
+            subject, edf_raw, args, channels_indices, labels, ref_ind, stat, electrodes_type)
 
     data = None
     cond_id = 0
@@ -907,6 +917,141 @@ def create_raw_data_from_edf(subject, args, stat=STAT_DIFF, electrodes_type=None
             return op.isfile(data_fname) and op.isfile(meta_fname)
 
 
+def calc_stream_stat_moving_avg(data, win_size, output_fname, chunk_len):
+    # The moving average of the conditions' STAT_DIFF (or of the data itself, if there is only one condition),
+    # calculated chunk by chunk from the memory-mapped data (C x T x conditions) into a memory-mapped C x T' array.
+    # Every output chunk needs win_size - 1 more input samples.
+    C, T = data.shape[:2]
+    mv_len = max(T - win_size + 1, 0)
+    stat_data_mv = np.lib.format.open_memmap(output_fname, mode='w+', dtype=np.float64, shape=(C, mv_len))
+    for t in range(0, mv_len, chunk_len):
+        chunk_to_t = min(t + chunk_len, mv_len)
+        chunk_data = data[:, t:chunk_to_t + win_size - 1]
+        stat_chunk = chunk_data[:, :, 0] if data.shape[2] == 1 else calc_stat_data(chunk_data, STAT_DIFF)
+        stat_data_mv[:, t:chunk_to_t] = utils.moving_avg(np.atleast_2d(stat_chunk), win_size)
+    stat_data_mv.flush()
+    return stat_data_mv
+
+
+def stream_edf_to_electrodes_data(subject, edf_raw, args, channels_indices, labels, ref_ind=-1, stat=STAT_DIFF,
+                                  electrodes_type=None):
+    # Reads the EDF in blocks of args.edf_chunk_len seconds, and writes them straight to a memory-mapped
+    # electrodes_data array, so the memory is bounded by the chunk size. The filters are causal IIR (sos) filters,
+    # where the filters' state is carried over from one chunk to the next.
+    from scipy import signal
+    fol = op.join(MMVT_DIR, subject, 'electrodes')
+    fs = float(edf_raw.info['sfreq'])
+    hz = int(fs)
+    chunk_len = max(int(args.edf_chunk_len * fs), 1)
+    sos = calc_edf_filters_sos(fs, args)
+    conds_windows = [(cond['name'], int(cond['from_t'] * hz), int(cond['to_t'] * hz)) if 'from_t' in cond else
+                     (cond['name'], 0, edf_raw.n_times) for cond in args.conditions]
+    # The baseline is streamed first, because its mean and std are needed for the other conditions
+    conds_windows = sorted(conds_windows, key=lambda c: c[0] != 'baseline')
+    conditions = [name for name, _, _ in conds_windows if name != 'baseline']
+    if len(conditions) == 0:
+        print('stream_edf_to_electrodes_data: No conditions besides the baseline!')
+        return False
+    T = min([to_t - from_t for name, from_t, to_t in conds_windows if name != 'baseline'])
+    C = len(channels_indices)
+    data_fname = op.join(fol, 'electrodes_data{}.npy'.format(
+        '_{}'.format(STAT_NAME[stat]) if len(conditions) > 1 else ''))
+    meta_fname = op.join(fol, 'electrodes_meta_data{}.npz'.format(
+        '_{}'.format(STAT_NAME[stat]) if len(conditions) > 1 else ''))
+    data = np.lib.format.open_memmap(data_fname, mode='w+', dtype=np.float64, shape=(C, T, len(conditions)))
+    baseline_mean, baseline_std, cond_id, times = None, None, 0, []
+    for cond_name, from_t, to_t in conds_windows:
+        is_baseline = cond_name == 'baseline'
+        if is_baseline:
+            baseline_fname = op.join(fol, 'electrodes{}_baseline.npy'.format('_bipolar' if args.bipolar else ''))
+            cond_output = np.lib.format.open_memmap(
+                baseline_fname, mode='w+', dtype=np.float64, shape=(C, to_t - from_t))
+            baseline_sum, baseline_sum_sq = np.zeros(C), np.zeros(C)
+        else:
+            to_t = from_t + T
+            cond_output = data
+            times = edf_raw.times[from_t:to_t]
+        zi = None
+        print('Streaming {} ({:.1f}s)'.format(cond_name, (to_t - from_t) / fs))
+        for chunk_from_t in range(from_t, to_t, chunk_len):
+            chunk_to_t = min(chunk_from_t + chunk_len, to_t)
+            chunk_data, _ = edf_raw[channels_indices, chunk_from_t:chunk_to_t]
+            if ref_ind != -1:
+                ref_data, _ = edf_raw[ref_ind, chunk_from_t:chunk_to_t]
+                chunk_data -= ref_data
+            if sos is not None:
+                if zi is None:
+                    zi = signal.sosfilt_zi(sos)[:, np.newaxis, :] * chunk_data[np.newaxis, :, 0, np.newaxis]
+                chunk_data, zi = signal.sosfilt(sos, chunk_data, axis=1, zi=zi)
+            if is_baseline:
+                cond_output[:, chunk_from_t - from_t:chunk_to_t - from_t] = chunk_data
+                baseline_sum += chunk_data.sum(1)
+                baseline_sum_sq += (chunk_data ** 2).sum(1)
+            else:
+                if baseline_mean is not None and args.remove_baseline:
+                    chunk_data -= baseline_mean[:, np.newaxis]
+                    if args.calc_zscore:
+                        chunk_data /= baseline_std[:, np.newaxis]
+                cond_output[:, chunk_from_t - from_t:chunk_to_t - from_t, cond_id] = chunk_data
+        if is_baseline:
+            cond_output.flush()
+            baseline_mean = baseline_sum / (to_t - from_t)
+            baseline_std = np.sqrt(np.maximum(baseline_sum_sq / (to_t - from_t) - baseline_mean ** 2, 0))
+        else:
+            cond_id += 1
+    # Second pass for the normalization and the factor
+    factor = args.factor
+    if args.normalize_data:
+        max_abs = max([np.max(np.abs(data[:, t:t + chunk_len])) for t in range(0, T, chunk_len)])
+        factor = factor / max_abs if max_abs > 0 else factor
+    if factor != 1:
+        for t in range(0, T, chunk_len):
+            data[:, t:t + chunk_len] *= factor
+    data.flush()
+
+    if args.moving_average_win_size > 0:
+        output_fname = op.join(
+            fol, 'electrodes_data_{}.npz'.format('_{}'.format(STAT_NAME[stat] if len(conditions) > 1 else '')))
+        stat_fname = op.join(fol, 'electrodes_stat_mv.npy')
+        stat_data_mv = calc_stream_stat_moving_avg(data, args.moving_average_win_size, stat_fname, chunk_len)
+        # np.savez writes the memory-mapped arrays in buffered chunks
+        np.savez(output_fname, data=data, stat=stat_data_mv, names=labels, conditions=conditions, times=times)
+        del data, stat_data_mv
+        os.remove(data_fname)
+        os.remove(stat_fname)
+        ret = op.isfile(output_fname)
+    else:
+        np.savez(meta_fname, names=labels, conditions=conditions, times=times)
+        del data
+        ret = op.isfile(data_fname) and op.isfile(meta_fname)
+    if args.bipolar:
+        return data_electrodes_to_bipolar(subject, electrodes_type)
+    else:
+        return ret
+
+
+def calc_edf_filters_sos(fs, args):
+    # Power line notch filters and band-pass filter as one second-order sections cascade
+    from scipy import signal
+    nyq = fs / 2
+    sos = []
+    if args.remove_power_line_noise:
+        power_line_freqs = np.arange(args.power_line_freq, args.power_line_freq * 4 + 1, args.power_line_freq)
+        for freq in [f for f in power_line_freqs if f < nyq]:
+            # Like mne's notch_filter, the default notch width is freq / 200
+            notch_width = args.power_line_notch_widths if args.power_line_notch_widths is not None else freq / 200.
+            b, a = signal.iirnotch(freq / nyq, freq / notch_width)
+            sos.append(signal.tf2sos(b, a))
+    low, high = args.lower_freq_filter, args.upper_freq_filter
+    if low is not None and high is not None:
+        sos.append(signal.butter(4, [low / nyq, high / nyq], btype='bandpass', output='sos'))
+    elif low is not None:
+        sos.append(signal.butter(4, low / nyq, btype='highpass', output='sos'))
+    elif high is not None:
+        sos.append(signal.butter(4, high / nyq, btype='lowpass', output='sos'))
+    return np.vstack(sos) if len(sos) > 0 else None
+
+
 def data_electrodes_to_bipolar(subject, electrodes_type=None):
     fol = op.join(MMVT_DIR, subject, 'electrodes')
     meta_data = np.load(op.join(fol, 'electrodes_meta_data.npz'))
@@ -1866,6 +2011,8 @@ def read_cmd_args(argv=None):
     parser.add_argument('--input_matlab_fname', help='', required=False, default='')
     parser.add_argument('--normalize_data', help='normalize_data', required=False, default=1, type=au.is_true)
     parser.add_argument('--preload', help='preload', required=False, default=1, type=au.is_true)
+    parser.add_argument('--edf_chunk_len', help='EDF chunk length (sec) when not preloading', required=False,
+                        default=60, type=float)
     parser.add_argument('--sigma', help='surf sigma', required=False, default=0, type=float)
     parser.add_argument('--find_hemis_manual', required=False, default=0, type=au.is_true)
 
@@ -15,6 +15,7 @@ from src.utils import freesurfer_utils as fu
 from src.preproc import meg as meg
 from src.utils import preproc_utils as pu
 from src.utils import labels_utils as lu
+from src.utils import memo_utils as memo
 
 
 SUBJECTS_DIR, MMVT_DIR, FREESURFER_HOME = pu.get_links()
@@ -895,6 +896,15 @@ def copy_volumes(subject, contrast_file_template, contrast, volume_fol, volume_n
         utils.copy_file(subject_volume_fname, blender_volume_fname)
 
 
+@memo.memoize(
+    inputs=lambda subject, atlas, input_fname_template, template_brain, **_: [
+        get_fmri_fname(subject, input_fname_template, only_volumes=False, raise_exception=False),
+        op.join(SUBJECTS_DIR, subject if template_brain == '' else template_brain, 'label',
+                '{}.{}.annot'.format('{hemi}', atlas))],
+    outputs=lambda subject, atlas, measures, **_: [
+        op.join(MMVT_DIR, subject, 'fmri', 'labels_data_{}_{}_{}.npz'.format(atlas, em, '{hemi}')) for em in measures] +
+        [op.join(MMVT_DIR, subject, 'fmri', 'labels_data_{}_{}_minmax.pkl'.format(atlas, em)) for em in measures],
+    ignore_args=('remote_fmri_dir', 'do_plot_all_vertices'))
 def analyze_4d_data(subject, atlas, input_fname_template='rest.sm6.{subject}.{hemi}.mgz', measures=['mean'],
                     template_brain='', norm_percs=(1,99), overwrite=False, remote_fmri_dir='', do_plot=False,
                     do_plot_all_vertices=False, excludes=('corpuscallosum', 'unknown'), input_format='nii.gz'):
@@ -925,7 +935,7 @@ def analyze_4d_data(subject, atlas, input_fname_template='rest.sm6.{subject}.{he
             if op.isfile(output_fname) and not overwrite:
                 print('{} already exist'.format(output_fname))
                 if not op.isfile(minmax_fname_template.format(em=em)) or overwrite:
-                    labels_data = np.load(output_fname)['data']
+                    labels_data = utils.upcast(np.load(output_fname)['data'])
                     labels_minmax[em].append(utils.calc_min_max(labels_data, norm_percs=norm_percs))
                 continue
             if len(labels) == 0:
@@ -936,7 +946,7 @@ def analyze_4d_data(subject, atlas, input_fname_template='rest.sm6.{subject}.{he
                     return False
             labels_data, labels_names = lu.calc_time_series_per_label(
                 x, labels, em, excludes, figures_dir, do_plot, do_plot_all_vertices)
-            np.savez(output_fname, data=labels_data, names=labels_names)
+            utils.savez_storage(output_fname, 'labels_data', data=labels_data, names=labels_names)
             labels_minmax[em].append(utils.calc_min_max(labels_data, norm_percs=norm_percs))
             print('{} was saved'.format(output_fname))
 
@@ -1212,7 +1222,7 @@ def save_dynamic_activity_map(subject, fmri_file_template='', template_brains='f
         # Check if there is a morphed file
         data = nib.load(fmri_fname).get_data().squeeze()
         T = data.shape[1]
-        if not overwrite and len(glob.glob(op.join(fol, '*.npy'))) == T:
+        if not overwrite and utils.activity_frame_exists(fol, T - 1):
             hemi_minmax.append(utils.calc_min_max(data, norm_percs=norm_percs))
             continue
         verts, faces = utils.read_pial(subject, MMVT_DIR, hemi)
@@ -1236,17 +1246,14 @@ def save_dynamic_activity_map(subject, fmri_file_template='', template_brains='f
             data = nib.load(fmri_fname).get_data().squeeze()
         assert (data.shape[0] == subject_verts_num)
         hemi_minmax.append(utils.calc_min_max(data, norm_percs=norm_percs))
+        # All the frames are in the activity store, the old frames files are deleted
         utils.delete_folder_files(fol)
-        now = time.time()
-        T = data.shape[1]
-        for t in range(T):
-            utils.time_to_go(now, t, T, runs_num_to_print=10)
-            np.save(op.join(fol, 't{}'.format(t)), data[:, t])
+        utils.save_activity_store(utils.get_activity_store_fol(fol), data, dtype=utils.get_storage_dtype('fmri_activity'))
 
     data_min, data_max = utils.calc_minmax_from_arr(hemi_minmax)
     print('save_dynamic_activity_map minmax: {},{}'.format(data_min, data_max))
     np.save(minmax_fname, (data_min, data_max))
-    return np.all([len(glob.glob(op.join(MMVT_DIR, subject, 'fmri', 'activity_map_{}'.format(hemi), '*.npy'))) == T
+    return np.all([utils.activity_frame_exists(op.join(MMVT_DIR, subject, 'fmri', 'activity_map_{}'.format(hemi)), T - 1)
                    for hemi in utils.HEMIS])
 
 
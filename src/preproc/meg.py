@@ -27,6 +27,8 @@ from src.utils import preproc_utils as pu
 from src.utils import labels_utils as lu
 from src.utils import args_utils as au
 from src.utils import freesurfer_utils as fu
+from src.utils import memo_utils as memo
+from src.utils import epochs_store
 from src.preproc import anatomy as anat
 from src.preproc import connectivity
 
@@ -277,7 +279,7 @@ def calc_epoches(raw, conditions, tmin, tmax, baseline, read_events_from_file=Fa
     if not read_from_raw:
         epo_fname = get_epo_fname(epo_fname, overwrite=overwrite_epochs)
         if op.isfile(epo_fname) and not overwrite_epochs:
-            epochs = mne.read_epochs(epo_fname)
+            epochs = epochs_store.read_epochs(epo_fname)
             return epochs
     try:
         events, _ = read_events(
@@ -416,7 +418,7 @@ def calc_epochs_using_auto_reject(raw_or_epochs, events, events_conditions, tmin
     ar_epo_fname = '{}ar-epo.fif'.format(epo_fname[:-len('epo.fif')])
     if op.isfile(ar_epo_fname) and not overwrite:
         print('Autoreject already calculated, use \'overwrite=True\' to recalculate.')
-        epochs_ar = mne.read_epochs(ar_epo_fname)
+        epochs_ar = epochs_store.read_epochs(ar_epo_fname)
         return epochs_ar
 
     if consensus_percs is None:
@@ -517,13 +519,13 @@ def calc_epochs_wrapper(
                 epochs = {}
                 for cond in conditions.keys():
                     if op.isfile(get_cond_fname(epo_fname, cond)):
-                        epochs[cond] = mne.read_epochs(get_cond_fname(epo_fname, cond))
+                        epochs[cond] = epochs_store.read_epochs(get_cond_fname(epo_fname, cond))
                     else:
                         epo_exist = False
                         break
             else:
                 if op.isfile(epo_fname):
-                    epochs = mne.read_epochs(epo_fname)
+                    epochs = epochs_store.read_epochs(epo_fname)
         if not epo_exist or overwrite_epochs:
             read_from_raw = False
             if raw is None:
@@ -571,7 +573,7 @@ def calc_epochs_psd(subject, events, mri_subject='', epo_fname='', apply_SSP_pro
             if not op.isfile(epo_cond_fname):
                 print('Epochs file was not found! ({})'.format(epo_cond_fname))
                 return False
-            epochs = mne.read_epochs(epo_cond_fname, apply_SSP_projection_vectors, add_eeg_ref)
+            epochs = epochs_store.read_epochs(epo_cond_fname, apply_SSP_projection_vectors, add_eeg_ref)
         if max_epochs_num > 0:
             epochs = epochs[:max_epochs_num]
         try:
@@ -672,7 +674,7 @@ def calc_baseline_sensors_bands_psd(mri_subject, epo_fname='', raw_template='',
     cond_name = 'baseline_{}'.format(cond_name)
     sensors_picks, sensors_names = get_sensors_picks(modality, raw_template=raw_template)
     epo_fname = get_epo_fname(epo_fname)
-    epochs = mne.read_epochs(epo_fname)
+    epochs = epochs_store.read_epochs(epo_fname)
     t_end = epochs.events[0, 0]
     t_start = 0 if t_end <= baseline_len else t_end - baseline_len
     raw.crop(t_start / raw.info['sfreq'], t_end / raw.info['sfreq'])
@@ -726,7 +728,7 @@ def calc_source_baseline_psd(subject, task, mri_subject='', raw_fname='', epo_fn
     except:
         print('calc_raw_bands_psd: Can\'t set_eeg_reference')
 
-    epochs = mne.read_epochs(epo_fname)
+    epochs = epochs_store.read_epochs(epo_fname)
     t_end = epochs.events[0, 0]
     t_start = 0 if t_end <= baseline_len else t_end - baseline_len
     raw.crop(t_start / raw.info['sfreq'], t_end / raw.info['sfreq'])
@@ -790,25 +792,23 @@ def calc_source_power_spectrum(
         mri_subject = subject
     if inv_fname == '':
         inv_fname = get_inv_fname(inv_fname, fwd_usingMEG, fwd_usingEEG)
-    if epochs is None:
+    read_epochs = epochs is None
+    if read_epochs:
         epo_fname = get_epo_fname(epo_fname)
     if isinstance(extract_modes, str):
         extract_modes = [extract_modes]
-    label_stat = getattr(np, label_stat)
     events_keys = list(events.keys()) if events is not None and isinstance(events, dict) else ['all']
     lambda2 = 1.0 / snr ** 2
     fol = utils.make_dir(op.join(MMVT_DIR, mri_subject, 'meg'))
     plots_fol = utils.make_dir(op.join(MMVT_DIR, subject, 'meg', 'plots'))
-    tmp_fol = utils.make_dir(op.join(fol, 'labels_power'))
     power_spectrum, power_spectrum_baseline = None, None
-    first_time = True
-    labels = None
-    freqs = None
+    labels, labels_projection, inverse_operator, baseline = None, None, None, None
+    freqs, baseline_freqs = None, None
     freqs_bins = np.arange(fmin, fmax)
+    # The source psd doesn't depend on the extract mode, so it's calculated once per condition
+    conds_psds = {}
     for (cond_ind, cond_name), em in product(enumerate(events_keys), extract_modes):
-        vertices_data = {hemi: dict() for hemi in utils.HEMIS}
-        vertices_baseline_data = {hemi: dict() for hemi in utils.HEMIS}
-        vertices_data_fname = op.join(fol, '{}_{}_{}_vertices_power_spectrum.pkl'.format(cond_name, inverse_method, em))
+        vertices_data_fname = op.join(fol, '{}_{}_{}_vertices_power_spectrum.npy'.format(cond_name, inverse_method, em))
         output_fname = op.join(fol, '{}_{}_{}_power_spectrum.npz'.format(cond_name, inverse_method, em))
         if op.isfile(output_fname) and not overwrite:
             print('{} already exist'.format(output_fname))
@@ -822,104 +822,144 @@ def calc_source_power_spectrum(
             else:
                 continue
 
-        if epochs is None:
-            epo_cond_fname = get_cond_fname(epo_fname, cond_name)
-            print('Reading epochs from {}'.format(epo_cond_fname))
-            if not op.isfile(epo_cond_fname):
-                print('single_trial_stc and not epochs file was found! ({})'.format(epo_cond_fname))
-                return False
-            epochs = mne.read_epochs(epo_cond_fname, apply_SSP_projection_vectors) #, preload=False) # add_eeg_ref
-            epochs_times = (None, 1) # todo: should be None, None!!!
-            epochs.crop(epochs_times[0], epochs_times[1])
-            if not (baseline_times[0] is None and baseline_times[1] is None):
-                baseline = epochs.copy().crop(baseline_times[0], baseline_times[1])
-                epochs = epochs.crop(baseline_times[1], None)
-            else:
-                baseline = None
-
-        if first_time:
-            first_time = False
-            labels = lu.read_labels(mri_subject, SUBJECTS_MRI_DIR, atlas, surf_name=surf_name, n_jobs=n_jobs)
-            if len(labels) == 0:
-                print('Can\'t find {} labels!'.format(atlas))
-                return False
-            inverse_operator, src = get_inv_src(inv_fname, src)
-
-        try:
-            mne.set_eeg_reference(epochs, ref_channels=None)
-            epochs.apply_proj()
-        except:
-            print('annot create EEG average reference projector (no EEG data found)')
-        if inverse_operator is None:
-            inverse_operator, src = get_inv_src(inv_fname, src, cond_name)
+        if cond_name in conds_psds:
+            labels_psd, labels_baseline_psd, freqs, baseline_freqs, vertices, cond_vertices_data_fname = \
+                conds_psds[cond_name]
+            if save_vertices_data:
+                _copy_vertices_power_spectrum(cond_vertices_data_fname, vertices_data_fname)
+                _copy_vertices_power_spectrum(*[fname.replace('_vertices_', '_vertices_baseline_') for fname in (
+                    cond_vertices_data_fname, vertices_data_fname)])
+        else:
+            if read_epochs:
+                epo_cond_fname = get_cond_fname(epo_fname, cond_name)
+                print('Reading epochs from {}'.format(epo_cond_fname))
+                if not op.isfile(epo_cond_fname):
+                    print('single_trial_stc and not epochs file was found! ({})'.format(epo_cond_fname))
+                    return False
+                epochs = epochs_store.read_epochs(epo_cond_fname, apply_SSP_projection_vectors) #, preload=False) # add_eeg_ref
+                epochs_times = (None, 1) # todo: should be None, None!!!
+                epochs.crop(epochs_times[0], epochs_times[1])
+                if not (baseline_times[0] is None and baseline_times[1] is None):
+                    baseline = epochs.copy().crop(baseline_times[0], baseline_times[1])
+                    epochs = epochs.crop(baseline_times[1], None)
+                else:
+                    baseline = None
 
-        now = time.time()
-        epochs_num = min(max_epochs_num, len(epochs)) if max_epochs_num != 0 else len(epochs)
+            if labels is None:
+                labels = lu.read_labels(mri_subject, SUBJECTS_MRI_DIR, atlas, surf_name=surf_name, n_jobs=n_jobs)
+                if len(labels) == 0:
+                    print('Can\'t find {} labels!'.format(atlas))
+                    return False
+                inverse_operator, src = get_inv_src(inv_fname, src)
 
-        for label_ind, label in enumerate(labels):
-            utils.time_to_go(now, label_ind, len(labels), 1)
-            _, src_sel = mne.minimum_norm.inverse.label_src_vertno_sel(label, inverse_operator['src'])
-            if len(src_sel) == 0:
-                continue
-            stcs = mne.minimum_norm.compute_source_psd_epochs(
-                epochs, inverse_operator, lambda2=lambda2, method=inverse_method, fmin=fmin, fmax=fmax,
-                bandwidth=bandwidth, label=label, return_generator=True, n_jobs=n_jobs)
+            try:
+                mne.set_eeg_reference(epochs, ref_channels=None)
+                epochs.apply_proj()
+            except:
+                print('annot create EEG average reference projector (no EEG data found)')
+            if inverse_operator is None:
+                inverse_operator, src = get_inv_src(inv_fname, src, cond_name)
+            if labels_projection is None:
+                labels_projection = lu.calc_labels_projection(mri_subject, atlas, labels, inverse_operator['src'])
+
+            epochs_num = min(max_epochs_num, len(epochs)) if max_epochs_num != 0 else len(epochs)
+            labels_psd, freqs, vertices = calc_epochs_source_psd(
+                epochs, inverse_operator, labels_projection, freqs_bins, epochs_num, lambda2, inverse_method, fmin,
+                fmax, bandwidth, label_stat, vertices_data_fname if save_vertices_data else '', n_jobs)
             if baseline is not None:
-                baseline_stcs = mne.minimum_norm.compute_source_psd_epochs(
-                    baseline, inverse_operator, lambda2=lambda2, method=inverse_method, fmin=fmin, fmax=fmax,
-                    bandwidth=bandwidth, label=label, return_generator=True, n_jobs=n_jobs)
+                labels_baseline_psd, baseline_freqs, _ = calc_epochs_source_psd(
+                    baseline, inverse_operator, labels_projection, freqs_bins, epochs_num, lambda2, inverse_method,
+                    fmin, fmax, bandwidth, label_stat,
+                    vertices_data_fname.replace('_vertices_', '_vertices_baseline_') if save_vertices_data else '',
+                    n_jobs)
             else:
-                baseline_stcs = [None] * epochs_num
-            for epoch_ind, (stc, baseline_stc) in enumerate(zip(stcs, baseline_stcs)):
-                if epoch_ind >= epochs_num:
-                    break
-                freqs = stc.times
-                baseline_freqs = baseline_stc.times if baseline is not None else None
-                label_vertices = stc.lh_vertno if label.hemi == 'lh' else stc.rh_vertno
-                if power_spectrum is None:
-                    power_spectrum = np.zeros((epochs_num, len(labels), len(freqs_bins), len(events)))
-                    if baseline is not None:
-                        power_spectrum_baseline = np.zeros((epochs_num, len(labels), len(freqs_bins), len(events)))
-                label_power_spectrum = bin_power_spectrum(label_stat(stc.data, axis=0), freqs, freqs_bins)
-                label_power_spectrum = 10 * np.log10(label_power_spectrum) # dB/Hz
-                power_spectrum[epoch_ind, label_ind, :, cond_ind] = label_power_spectrum
-                if baseline is not None:
-                    label_baseline_power_spectrum = bin_power_spectrum(
-                        label_stat(baseline_stc.data, axis=0), baseline_freqs, freqs_bins)
-                    label_baseline_power_spectrum = 10 * np.log10(label_baseline_power_spectrum) # dB/Hz
-                    power_spectrum_baseline[epoch_ind, label_ind, :, cond_ind] = label_baseline_power_spectrum
-                if save_vertices_data:
-                    if epoch_ind == 0:
-                        for vert_ind, vert_no in enumerate(label_vertices):
-                            vertices_data[label.hemi][vert_no] = np.zeros((epochs_num, len(freqs)))
-                            if baseline is not None:
-                                vertices_baseline_data[label.hemi][vert_no] = np.zeros((epochs_num, len(baseline_freqs)))
-                    for vert_ind, vert_no in enumerate(label_vertices):
-                        vertices_data[label.hemi][vert_no][epoch_ind] = stc.data[vert_ind]
-                        if baseline is not None:
-                            vertices_baseline_data[label.hemi][vert_no][epoch_ind] = baseline_stc.data[vert_ind]
-            # if save_tmp_files:
-            #     bsp = power_spectrum_baseline[:, label_ind, :, cond_ind] if baseline is not None else None
-            #     np.savez(output_fname, power_spectrum=power_spectrum[:, label_ind, :, cond_ind], frequencies=freqs,
-            #              label=label.name, cond=cond_name, power_spectrum_basline=bsp, baseline_freqs=baseline_freqs)
-            if do_plot:
-                plot_label_psd(power_spectrum[:, label_ind, :, cond_ind], freqs, label, cond_name, plots_fol)
-        # for hemi in utils.HEMIS:
-        #     for vert_no in vertices_data[hemi].keys():
-        #         vertices_data[hemi][vert_no]
+                labels_baseline_psd = None
+            conds_psds[cond_name] = (
+                labels_psd, labels_baseline_psd, freqs, baseline_freqs, vertices, vertices_data_fname)
+
+        if power_spectrum is None:
+            power_spectrum = np.zeros((labels_psd.shape[0], len(labels), len(freqs_bins), len(events)))
+        power_spectrum[:, :, :, cond_ind] = labels_psd
+        if labels_baseline_psd is not None:
+            if power_spectrum_baseline is None:
+                power_spectrum_baseline = np.zeros(power_spectrum.shape)
+            power_spectrum_baseline[:, :, :, cond_ind] = labels_baseline_psd
+        if do_plot:
+            for label_ind, label in enumerate(labels):
+                plot_label_psd(power_spectrum[:, label_ind, :, cond_ind], freqs_bins, label, cond_name, plots_fol)
         if save_vertices_data:
-            utils.save((vertices_data, vertices_baseline_data, freqs, baseline_freqs), vertices_data_fname)
-        bsp = power_spectrum_baseline if baseline is not None else None
+            np.savez(vertices_data_fname.replace('.npy', '_meta.npz'), lh_vertno=vertices[0], rh_vertno=vertices[1],
+                     frequencies=freqs, baseline_frequencies=baseline_freqs)
+        bsp = power_spectrum_baseline if labels_baseline_psd is not None else None
         np.savez(output_fname, power_spectrum=power_spectrum, frequencies=freqs, power_spectrum_baseline=bsp,
                  baseline_frequencies=baseline_freqs)
 
     if save_vertices_data:
-        calc_vertices_data_power_bands(subject, events, mri_subject, inverse_method, extract_modes, vertices_data, freqs)
+        calc_vertices_data_power_bands(subject, events, mri_subject, inverse_method, extract_modes, bands=bands)
     # calc_labels_power_bands(
     #     mri_subject, atlas, events, inverse_method, extract_modes, precentiles, bands, labels, overwrite, n_jobs=n_jobs)
     return True
 
 
+def calc_epochs_source_psd(epochs, inverse_operator, labels_projection, freqs_bins, epochs_num, lambda2,
+                           inverse_method='dSPM', fmin=1, fmax=120, bandwidth=2., label_stat='mean',
+                           vertices_data_fname='', n_jobs=6):
+    # The inverse and the multitaper psd are calculated once per epoch for the whole source space. The labels
+    # spectra (epochs x labels x freqs_bins, in dB/Hz) are reduced from it with the sparse labels projection, and
+    # if vertices_data_fname is set, the vertices spectra are written to an (epochs x vertices x freqs) memmap.
+    stcs = mne.minimum_norm.compute_source_psd_epochs(
+        epochs, inverse_operator, lambda2=lambda2, method=inverse_method, fmin=fmin, fmax=fmax,
+        bandwidth=bandwidth, return_generator=True, n_jobs=n_jobs)
+    labels_num = len(labels_projection.indptr) - 1
+    empty_labels = np.diff(labels_projection.indptr) == 0
+    labels_psd, vertices_psd, bins_mat, freqs, vertices = None, None, None, None, None
+    now = time.time()
+    for epoch_ind, stc in enumerate(stcs):
+        if epoch_ind >= epochs_num:
+            break
+        utils.time_to_go(now, epoch_ind, epochs_num, 1)
+        if labels_psd is None:
+            freqs, vertices = stc.times, stc.vertices
+            labels_psd = np.zeros((epochs_num, labels_num, len(freqs_bins)))
+            bins_mat = calc_freqs_bins_mat(freqs, freqs_bins)
+            if vertices_data_fname != '':
+                vertices_psd = np.lib.format.open_memmap(
+                    vertices_data_fname, mode='w+', dtype=np.float32, shape=(epochs_num, ) + stc.data.shape)
+        if label_stat in lu.LABELS_PROJECTION_MODES:
+            epoch_labels_psd = lu.apply_labels_projection(labels_projection, stc.data, label_stat)
+        else:
+            label_stat_func = getattr(np, label_stat)
+            epoch_labels_psd = np.zeros((labels_num, len(freqs)))
+            for label_ind, (ind_from, ind_to) in enumerate(
+                    zip(labels_projection.indptr[:-1], labels_projection.indptr[1:])):
+                if ind_to > ind_from:
+                    epoch_labels_psd[label_ind] = label_stat_func(
+                        stc.data[labels_projection.indices[ind_from:ind_to]], axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            labels_psd[epoch_ind] = 10 * np.log10(epoch_labels_psd.dot(bins_mat.T)) # dB/Hz
+        labels_psd[epoch_ind, empty_labels] = 0
+        if vertices_psd is not None:
+            vertices_psd[epoch_ind] = stc.data
+    if vertices_psd is not None:
+        vertices_psd.flush()
+        del vertices_psd
+    return labels_psd, freqs, vertices
+
+
+def calc_freqs_bins_mat(frequencies, freqs_bins):
+    # (freqs_bins x frequencies) averaging matrix, the same as bin_power_spectrum (empty bins are nan)
+    round_freqs = np.round(frequencies)
+    bins_mat = (round_freqs[np.newaxis, :] == np.asarray(freqs_bins)[:, np.newaxis]).astype(np.float64)
+    bins_count = bins_mat.sum(1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return bins_mat / bins_count
+
+
+def _copy_vertices_power_spectrum(source_fname, target_fname):
+    if source_fname != target_fname and op.isfile(source_fname):
+        shutil.copyfile(source_fname, target_fname)
+
+
 def bin_power_spectrum(power_spectrum, frequencies, freqs_bins):
     round_freqs = np.round(frequencies)
     bin_powers = np.array([power_spectrum[np.where(round_freqs == f)[0]].mean(0) for f in freqs_bins])
@@ -927,9 +967,18 @@ def bin_power_spectrum(power_spectrum, frequencies, freqs_bins):
     return bin_powers
 
 
+def load_vertices_power_spectrum(vertices_data_fname):
+    # The vertices power spectrum (an epochs x vertices x freqs memmap, the lh vertices first) and its meta
+    # (lh_vertno, rh_vertno, frequencies and baseline_frequencies), as written by calc_source_power_spectrum
+    vertices_meta_fname = vertices_data_fname.replace('.npy', '_meta.npz')
+    if not op.isfile(vertices_data_fname) or not op.isfile(vertices_meta_fname):
+        return None, None
+    return np.load(vertices_data_fname, mmap_mode='r'), utils.Bag(np.load(vertices_meta_fname))
+
+
 def calc_vertices_data_power_bands(
-        subject, events, mri_subject='', inverse_method='dSPM', extract_modes=['mean_flip'],
-        vertices_data=None, freqs=None, bands=None, overwrite=False):
+        subject, events, mri_subject='', inverse_method='dSPM', extract_modes=['mean_flip'], bands=None,
+        overwrite=False):
     if mri_subject == '':
         mri_subject = subject
     events_keys = list(events.keys()) if events is not None and isinstance(events, dict) else ['all']
@@ -939,20 +988,25 @@ def calc_vertices_data_power_bands(
 
     results_num = 0
     for (cond_ind, cond_name), em in product(enumerate(events_keys), extract_modes):
-        if vertices_data is None or freqs is None:
-            vertices_data_fname = op.join(fol, '{}_{}_{}_vertices_power_spectrum.pkl'.format(cond_name, inverse_method, em))
-            if not op.isfile(vertices_data_fname):
-                print('Can\'t find {}!'.format(vertices_data_fname))
-                continue
-            vertices_data, freqs = utils.load(vertices_data_fname)
+        vertices_data_fname = op.join(fol, '{}_{}_{}_vertices_power_spectrum.npy'.format(cond_name, inverse_method, em))
+        vertices_psd, meta = load_vertices_power_spectrum(vertices_data_fname) # epochs x vertices x freqs
+        if vertices_psd is None:
+            print('Can\'t find {}!'.format(vertices_data_fname))
+            continue
+        vertices_psd_mean = None
         for band, (lf, hf) in bands.items():
             stc_fname = op.join(fol, '{}_{}_{}_{}_power'.format(cond_name, inverse_method, em, band))
             if utils.both_hemi_files_exist('{}-{}.stc'.format(stc_fname, '{hemi}')) and not overwrite:
                 continue
-            band_mask = np.where((freqs >= lf) & (freqs <= hf))[0]
-            data = {hemi: [vertices_data[hemi][vert_ind][:, band_mask].mean() for vert_ind in vertices_data[hemi].keys()]
-                    for hemi in utils.HEMIS}
-            stc_power = creating_stc_obj(data, vertices_data, subject)
+            if vertices_psd_mean is None:
+                # The average over the epochs is calculated once, one epoch at a time
+                vertices_psd_mean = np.zeros(vertices_psd.shape[1:])
+                for epoch_psd in vertices_psd:
+                    vertices_psd_mean += epoch_psd
+                vertices_psd_mean /= len(vertices_psd)
+            band_mask = (meta.frequencies >= lf) & (meta.frequencies <= hf)
+            data = vertices_psd_mean[:, band_mask].mean(axis=1)[:, np.newaxis]
+            stc_power = mne.SourceEstimate(data, [meta.lh_vertno, meta.rh_vertno], 0, 0, subject=subject)
             print('Saving power stc to: {}'.format(stc_fname))
             stc_power.save(stc_fname)
             results_num += 1 if utils.both_hemi_files_exist('{}-{}.stc'.format(stc_fname, '{hemi}')) else 0
@@ -1053,7 +1107,7 @@ def calc_labels_induced_power(subject, atlas, events, inverse_method='dSPM', ext
             print('single_trial_stc and not epochs file was found! ({})'.format(epo_cond_fname))
             return False
         if epochs is None:
-            epochs = mne.read_epochs(epo_cond_fname, apply_SSP_projection_vectors, add_eeg_ref)
+            epochs = epochs_store.read_epochs(epo_cond_fname, apply_SSP_projection_vectors, add_eeg_ref)
         epochs_num = min(max_epochs_num, len(epochs)) if max_epochs_num != 0 else len(epochs)
         if ws is None:
             ws = [(mne.time_frequency.morlet(
@@ -1126,11 +1180,9 @@ def calc_labels_power_bands(mri_subject, atlas, events, inverse_method='dSPM', e
         for band, (lf, hf) in bands.items():
             output_fname = op.join(fol, '{}_labels_{}_{}_{}_power.npz'.format(cond_name, inverse_method, em, band))
             if op.isfile(output_fname) and not overwrite:
-                return True
-            band_mask = np.where((freqs >= lf) & (freqs <= hf))
-            band_power = np.empty((len(labels), psd.shape[0]))
-            for label_ind, label_name in enumerate(labels):
-                band_power[label_ind] = psd[:, label_ind, band_mask, cond_ind].mean(axis=2).squeeze()
+                continue
+            band_mask = (freqs >= lf) & (freqs <= hf)
+            band_power = psd[:, :, band_mask, cond_ind].mean(axis=2).T # labels x epochs
             data_max = utils.calc_max(band_power, norm_percs=precentiles)
             print('calc_labels_power_bands: Saving results in {}'.format(output_fname))
             np.savez(output_fname, names=np.array(labels), atlas=atlas, data=band_power,
@@ -1157,7 +1209,7 @@ def calc_labels_connectivity(
         subject, atlas, events, mri_subject='', subjects_dir='', mmvt_dir='', inverse_method='dSPM',
         epo_fname='', inv_fname='', raw_fname='', snr=3.0, pick_ori=None, apply_SSP_projection_vectors=True,
         add_eeg_ref=True, fwd_usingMEG=True, fwd_usingEEG=True, extract_modes=['mean_flip'], surf_name='pial',
-        con_method='coh', con_mode='cwt_morlet', cwt_n_cycles=7, max_epochs_num=0, min_order=1, max_order=100,
+        con_method='coh', con_mode='cwt_morlet', cwt_n_cycles=7, max_epochs_num=0, min_order=1, max_order=20,
         windows_length=0, windows_shift=0, overwrite_connectivity=False, raw=None, epochs=None, src=None, bands=None,
         labels=None, cwt_frequencies=None, con_indentifer='', symetric_con=None, downsample=1, n_jobs=6):
     modality = get_modality(fwd_usingMEG, fwd_usingEEG)
@@ -1211,7 +1263,7 @@ def calc_labels_connectivity(
             if not op.isfile(epo_cond_fname):
                 print('single_trial_stc and not epochs file was found! ({})'.format(epo_cond_fname))
                 return False
-            epochs = mne.read_epochs(epo_cond_fname, apply_SSP_projection_vectors, add_eeg_ref)
+            epochs = epochs_store.read_epochs(epo_cond_fname, apply_SSP_projection_vectors, add_eeg_ref)
         sfreq = epochs.info['sfreq']
         try:
             mne.set_eeg_reference(epochs, ref_channels=None)
@@ -1278,7 +1330,7 @@ def save_connectivity(subject, atlas, events, modality='meg', extract_modes=['me
 
 def calc_stcs_spectral_connectivity(
         stcs, labels, src, em, bands, con_method, con_mode, sfreq, cwt_frequencies,
-        cwt_n_cycles, connectivity_template, min_order=1, max_order=100, downsample=1,
+        cwt_n_cycles, connectivity_template, min_order=1, max_order=20, downsample=1,
         windows_length=0, windows_shift=0, overwrite=False, n_jobs=1):
     label_ts = mne.extract_label_time_course(stcs, labels, src, mode=em, allow_empty=True, return_generator=False)
     if downsample > 1:
@@ -1297,7 +1349,7 @@ def calc_stcs_spectral_connectivity(
             continue
         if con_method == 'gc': # granger-causality
             con = granger_causality(
-                label_ts, sfreq, max_order, min_order, fmin, fmax, windows_length, windows_shift, n_jobs > 1)
+                label_ts, sfreq, max_order, min_order, fmin, fmax, windows_length, windows_shift, n_jobs=n_jobs)
         else:
             con, _, _, _, _ = spectral_connectivity(
                 label_ts, con_method, con_mode, sfreq, fmin, fmax, faverage=True, mt_adaptive=True,
@@ -1457,58 +1509,12 @@ def spectral_connectivity(label_ts, con_method, con_mode, sfreq, fmin, fmax, fav
 
 
 def granger_causality(epochs_ts, sfreq, max_order, min_order=1, fmin=None, fmax=None, windows_length=0, windows_shift=0,
-                      parallel=True):
-    ijs = []
-    N = epochs_ts[0].shape[0]
-    for i in range(N):
-        for j in range(i, N):
-            if not np.all(epochs_ts[0][i] == epochs_ts[0][j]):
-                ijs.append((i, j))
-
-    params = [(epoch_ts, sfreq, min_order, max_order, fmin, fmax, ijs, windows_length, windows_shift)
-              for epoch_ts in epochs_ts]
-    results = utils.run_parallel(_granger_causality_parallel, params, len(epochs_ts) if parallel else 1)
-    res = np.array(results).mean(0)
-    return res
-
-
-def _granger_causality_parallel(p):
-    import nitime.timeseries as ts
-    import nitime.analysis as nta
-    import nitime.utils as tsu
-
-    epoch_ts, sfreq, min_order, max_order, fmin, fmax, ijs, windows_length, windows_shift = p
-    C, T = epoch_ts.shape
-    # epoch_ts = tsu.percent_change(epoch_ts)
-    windows = connectivity.calc_windows(T, windows_length, windows_shift)
-    res = np.zeros((C, C, len(windows), max_order))
-    now = time.time()
-    for ord in range(min_order, max_order + 1):
-        utils.time_to_go(now, ord, max_order, 1)
-        print('Calc granger causality for order {}, {}-{} Hz, {} windows'.format(ord, fmin, fmax, len(windows)))
-        for w_ind, (t_from, t_to) in enumerate(windows):
-            time_series = ts.TimeSeries(epoch_ts[:, t_from: t_to], sampling_interval=1 / sfreq)
-            G = nta.GrangerAnalyzer(time_series, order=ord, ij=ijs)
-            if fmin is None and fmax is None:
-                freq_idx_G = np.arange(len(G.frequencies))
-            elif fmin is None and fmax is not None:
-                freq_idx_G = np.where((G.frequencies < fmax))[0]
-            elif fmin is not None and fmax is None:
-                freq_idx_G = np.where((G.frequencies > fmin))[0]
-            else:
-                freq_idx_G = np.where((G.frequencies > fmin) * (G.frequencies < fmax))[0]
-            try:
-                g1 = np.mean(G.causality_xy[:, :, freq_idx_G], -1)
-                g2 = np.mean(G.causality_yx[:, :, freq_idx_G], -1)
-                g1[np.where(np.isnan(g1))] = 0
-                g2[np.where(np.isnan(g2))] = 0
-                res[:, :, w_ind, ord - 1] = g1.T + g2
-                del G, g1, g2
-            except:
-                print('error with ord {}'.format(ord))
-                utils.print_last_error_line()
-                del G
-    return res
+                      criterion='bic', gc_type='pairwise', n_jobs=1):
+    # Returns labels x labels x windows, where con[i, j, w] is the causality j -> i, averaged over the epochs.
+    # The VAR models of all the epochs, windows and orders are estimated in batches (connectivity.calc_var_covariances)
+    return connectivity.calc_granger_causality(
+        np.array(epochs_ts), sfreq, min_order, max_order, fmin, fmax, windows_length, windows_shift, criterion,
+        gc_type, n_jobs=n_jobs)
 
 #
 # def calc_granger_ij(time_series, order):
@@ -1571,7 +1577,7 @@ def calc_evokes(epochs, events, mri_subject, normalize_data=False, epo_fname='',
                                     norm_percs, modality, calc_max_min_diff, task, bad_channels)
             return True, evoked
         if epochs is None:
-            epochs = mne.read_epochs(epo_fname)
+            epochs = epochs_store.read_epochs(epo_fname)
         if average_per_event and not (len(events_keys) == 1 and events_keys[0] == 'rest'):
             if any([event not in epochs.event_id for event in events_keys]):
                 print('Not all the events can be found in the epochs! (events = {})'.format(events_keys))
@@ -2170,7 +2176,7 @@ def calc_noise_cov(epochs=None, noise_t_min=None, noise_t_max=0, noise_cov_fname
             noise_cov = recalc_epochs_for_noise_cov(noise_t_min, noise_t_max, args, raw)
     else:
         if op.isfile(EPO_NOISE):
-            demi_epochs = mne.read_epochs(EPO_NOISE)
+            demi_epochs = epochs_store.read_epochs(EPO_NOISE)
         else:
             raise Exception("You should split first your epochs into small demi epochs, see calc_demi_epoches")
         noise_cov = calc_noise_cov(demi_epochs, use_eeg=use_eeg, use_meg=use_meg)
@@ -2330,7 +2336,7 @@ def calc_inverse_operator(
                     noise_cov.save(noise_cov_fname)
                 else:
                     epo = get_cond_fname(epo_fname, cond)
-                    epochs = mne.read_epochs(epo)
+                    epochs = epochs_store.read_epochs(epo)
                     noise_cov = calc_noise_cov(
                         epochs, noise_t_min, noise_t_max, noise_cov_fname, args,
                         use_eeg=fwd_usingEEG, use_meg=fwd_usingMEG)
@@ -2570,7 +2576,7 @@ def calc_stc_per_condition(subject, events=None, task='', stc_t_min=None, stc_t_
                             evoked = get_evoked_cond(
                                 cond_name, evo_fname, epo_fname, baseline, apply_SSP_projection_vectors, add_eeg_ref)
                     else:
-                        epochs = mne.read_epochs(epo_fname, apply_SSP_projection_vectors, add_eeg_ref)
+                        epochs = epochs_store.read_epochs(epo_fname, apply_SSP_projection_vectors, add_eeg_ref)
                 try:
                     mne.set_eeg_reference(epochs, ref_channels=None)
                 except:
@@ -3266,11 +3272,11 @@ def get_evoked_cond(cond_name, evo_fname='', epo_fname='', baseline=(None, 0), a
                 print('No epochs were found!')
                 return None
             if '{cond}' not in epo_fname:
-                epochs = mne.read_epochs(epo_fname, apply_SSP_projection_vectors, add_eeg_ref)
+                epochs = epochs_store.read_epochs(epo_fname, apply_SSP_projection_vectors, add_eeg_ref)
                 evoked = epochs[cond_name].average()
             else:
                 epo_cond = get_cond_fname(epo_fname, cond_name)
-                epochs = mne.read_epochs(epo_cond, apply_SSP_projection_vectors, add_eeg_ref)
+                epochs = epochs_store.read_epochs(epo_cond, apply_SSP_projection_vectors, add_eeg_ref)
                 evoked = epochs.average()
             mne.write_evokeds(evo_cond, evoked)
     return evoked[0] if isinstance(evoked, list) else evoked
@@ -3320,7 +3326,7 @@ def calc_sub_cortical_activity(events, sub_corticals_codes_file=None, inverse_me
             inverse_operator = read_inverse_operator(inv_fname)
         if inverse_method in ['lcmv', 'dics', 'rap_music']:
             if not epochs_given:
-                epochs = mne.read_epochs(get_cond_fname(EPO, event))
+                epochs = epochs_store.read_epochs(get_cond_fname(EPO, event))
             fwd_fname = get_cond_fname(FWD_SUB, event) if len(sub_corticals) > 1 else get_cond_fname(FWD_X, event, region=regions[0])
             forward = mne.read_forward_solution(fwd_fname)
         if inverse_method in ['lcmv', 'rap_music']:
@@ -3586,8 +3592,58 @@ def calc_stc_for_all_vertices(stc, subject='', morph_to_subject='', n_jobs=6):
     subject = MRI_SUBJECT if subject == '' else subject
     morph_to_subject = subject if morph_to_subject == '' else morph_to_subject
     grade = None if morph_to_subject != 'fsaverage' else 5
-    vertices_to = mne.grade_to_vertices(morph_to_subject, grade)
-    return mne.morph_data(subject, morph_to_subject, stc, n_jobs=n_jobs, grade=vertices_to)
+    return morph_stcs([stc], subject, morph_to_subject, grade)[0]
+
+
+def compute_morph_mat(subject_from, subject_to, vertices_from, vertices_to, smooth=None):
+    # The surface morphing matrix, through the public API. The source is an empty stc, as only its vertices are used
+    src = mne.SourceEstimate(np.zeros((sum(len(v) for v in vertices_from), 1)), vertices_from, 0, 1,
+                             subject=subject_from)
+    morph = mne.compute_source_morph(
+        src, subject_from, subject_to, subjects_dir=SUBJECTS_MRI_DIR, spacing=[np.asarray(v) for v in vertices_to],
+        smooth=smooth, xhemi=False, verbose=False)
+    return morph.morph_mat
+
+
+def get_morph_mat(subject_from, subject_to, vertices_from, grade=None, smooth=None, overwrite=False):
+    # The sparse morphing (and smoothing) matrix is cached in the subject_from folder, keyed by subject_to, the
+    # source space vertices, the smoothing steps and the grade, so it's calculated only once.
+    import hashlib
+    import scipy.sparse
+    vertices_hash = hashlib.md5(b''.join(
+        [np.ascontiguousarray(v, dtype=np.int64).tobytes() for v in vertices_from])).hexdigest()[:12]
+    grade_str = grade if grade is None or isinstance(grade, int) else hashlib.md5(b''.join(
+        [np.ascontiguousarray(v, dtype=np.int64).tobytes() for v in grade])).hexdigest()[:12]
+    output_fname = op.join(MMVT_DIR, subject_from, 'morph_mats', '{}-{}-grade{}-smooth{}.npz'.format(
+        subject_to, vertices_hash, grade_str, smooth))
+    if op.isfile(output_fname) and not overwrite:
+        d = np.load(output_fname)
+        morph_mat = scipy.sparse.csr_matrix((d['data'], d['indices'], d['indptr']), shape=d['shape'])
+        return morph_mat, [d['lh_vertices_to'], d['rh_vertices_to']]
+    vertices_to = mne.grade_to_vertices(subject_to, grade, subjects_dir=SUBJECTS_MRI_DIR)
+    print('Calculating the morphing matrix from {} to {} (grade: {}, smooth: {})'.format(
+        subject_from, subject_to, grade_str, smooth))
+    morph_mat = compute_morph_mat(subject_from, subject_to, vertices_from, vertices_to, smooth).tocsr()
+    utils.make_dir(utils.get_parent_fol(output_fname))
+    np.savez(output_fname, data=morph_mat.data, indices=morph_mat.indices, indptr=morph_mat.indptr,
+             shape=morph_mat.shape, lh_vertices_to=vertices_to[0], rh_vertices_to=vertices_to[1])
+    return morph_mat, vertices_to
+
+
+def morph_stcs(stcs, subject_from, subject_to, grade=None, smooth=None, overwrite_morph_mat=False):
+    # All the stcs (with the same source space) are morphed with a single sparse matrix product
+    if len(stcs) == 0:
+        return []
+    morph_mat, vertices_to = get_morph_mat(
+        subject_from, subject_to, stcs[0].vertices, grade, smooth, overwrite_morph_mat)
+    for stc in stcs[1:]:
+        if not all([np.array_equal(v1, v2) for v1, v2 in zip(stc.vertices, stcs[0].vertices)]):
+            raise Exception('morph_stcs: All the stcs should have the same vertices!')
+    times_num = [stc.data.shape[1] for stc in stcs]
+    morphed_data = morph_mat.dot(np.hstack([stc.data for stc in stcs]))
+    morphed_data = np.split(morphed_data, np.cumsum(times_num)[:-1], axis=1)
+    return [mne.SourceEstimate(data, vertices_to, stc.tmin, stc.tstep, subject=subject_to)
+            for stc, data in zip(stcs, morphed_data)]
 
 
 @utils.files_needed({'surf': ['lh.sphere.reg', 'lh.sphere.reg']})
@@ -3614,11 +3670,7 @@ def calc_source_morph_mat(subject_from, subject_to, src_vertices=None, zooms=5,
     vertices_from = src_data['vertices_from']
     pial = utils.get_pial_vertices(subject_to, MMVT_DIR)
     vertices_to = [np.arange(len(pial['lh'])), np.arange(len(pial['rh']))]
-    morph_mat = mne.morph._compute_morph_matrix(
-        subject_from=subject_from, subject_to=subject_to,
-        vertices_from=vertices_from, vertices_to=vertices_to,
-        subjects_dir=SUBJECTS_MRI_DIR, smooth=None,
-        xhemi=False)
+    morph_mat = compute_morph_mat(subject_from, subject_to, vertices_from, vertices_to)
     n_verts = sum(len(v) for v in vertices_to)
     assert morph_mat.shape[0] == n_verts
     morph = mne.SourceMorph(
@@ -3689,8 +3741,7 @@ def morph_stc(subject, events, morph_to_subject, inverse_method='dSPM', grade=5,
             continue
         utils.make_dir(utils.get_parent_fol(output_fname))
         stc = mne.read_source_estimate(stc_fname)
-        stc_morphed = mne.morph_data(
-            subject, morph_to_subject, stc, grade=grade, smooth=smoothing_iterations, n_jobs=n_jobs)
+        stc_morphed = morph_stcs([stc], subject, morph_to_subject, grade, smoothing_iterations)[0]
         stc_morphed.save(output_fname)
         print('Morphed stc file was saves in {}'.format(output_fname))
         ret = ret and utils.both_hemi_files_exist(output_fname)
@@ -3703,7 +3754,7 @@ def morph_stc(subject, events, morph_to_subject, inverse_method='dSPM', grade=5,
 # @utils.timeit
 def smooth_stc(events, stcs_conds=None, inverse_method='dSPM', t=-1, morph_to_subject='', n_jobs=6):
     try:
-        stcs = {}
+        stcs, input_stcs, output_fnames = {}, {}, {}
         for ind, cond in enumerate(events.keys()):
             output_fname = STC_HEMI_SMOOTH_SAVE.format(cond=cond, method=inverse_method)
             if morph_to_subject != '':
@@ -3716,9 +3767,15 @@ def smooth_stc(events, stcs_conds=None, inverse_method='dSPM', t=-1, morph_to_su
             if t != -1:
                 stc = create_stc_t(stc, t)
                 output_fname = '{}-t{}'.format(output_fname, t)
-            stc_smooth = calc_stc_for_all_vertices(stc, MRI_SUBJECT, morph_to_subject, n_jobs)
+            input_stcs[cond], output_fnames[cond] = stc, output_fname
+        # All the conditions are smoothed together, with the same (cached) smoothing matrix
+        morph_to_subject = MRI_SUBJECT if morph_to_subject == '' else morph_to_subject
+        grade = None if morph_to_subject != 'fsaverage' else 5
+        conds = list(input_stcs.keys())
+        for cond, stc_smooth in zip(conds, morph_stcs([input_stcs[c] for c in conds], MRI_SUBJECT, morph_to_subject,
+                                                      grade)):
             check_stc_with_ply(stc_smooth, cond, morph_to_subject)
-            stc_smooth.save(output_fname)
+            stc_smooth.save(output_fnames[cond])
             stcs[cond] = stc_smooth
         flag = True
     except:
@@ -3772,15 +3829,13 @@ def save_activity_map(events, stat, stcs_conds=None, inverse_method='dSPM', smoo
             if morph_to_subject != '':
                 fol = fol.replace(MRI_SUBJECT, morph_to_subject)
             if stc_t == -1:
+                # All the frames are in the activity store, the old frames files are deleted
                 utils.delete_folder_files(fol)
-                now = time.time()
-                T = data.shape[1]
-                for t in range(T):
-                    utils.time_to_go(now, t, T, runs_num_to_print=10)
-                    np.save(op.join(fol, 't{}'.format(t)), data[:, t])
+                utils.save_activity_store(
+                    utils.get_activity_store_fol(fol), data, dtype=utils.get_storage_dtype('meg_activity'))
             else:
-                utils.make_dir(fol)
-                np.save(op.join(fol, 't{}'.format(stc_t)), data)
+                utils.save_activity_frame(
+                    fol, stc_t, data, utils.get_storage_dtype('meg_activity', quantization_allowed=False))
         flag = True
     except:
         print(traceback.format_exc())
@@ -3890,7 +3945,9 @@ def get_subject_tris():
     return tris
 
 
-def save_vertex_activity_map(events, stat, stcs_conds=None, inverse_method='dSPM', number_of_files=100):
+def save_vertex_activity_map(events, stat, stcs_conds=None, inverse_method='dSPM', chunk_size=4096):
+    # Writes the activity store (see mmvt_utils.save_activity_store), where both "one vertex, all frames" and
+    # "one frame, all vertices" are single contiguous reads. It replaces the old 100 hashed files + lookup table.
     try:
         if stat not in [STAT_DIFF, STAT_AVG]:
             raise Exception('stat not in [STAT_DIFF, STAT_AVG]!')
@@ -3902,24 +3959,10 @@ def save_vertex_activity_map(events, stat, stcs_conds=None, inverse_method='dSPM
                 raise Exception('save_vertex_activity_map: wrong number of vertices!')
             else:
                 print('Both {}.pial.ply and the stc file have {} vertices'.format(hemi, data.shape[0]))
-
-            data_hash = defaultdict(list)
-            fol = '{}_verts'.format(ACT.format(hemi))
-            utils.delete_folder_files(fol)
-            look_up = np.zeros((data.shape[0], 2), dtype=np.int)
-            for vert_ind in range(data.shape[0]):
-                file_num = vert_ind % number_of_files
-                data_hash[file_num].append(data[vert_ind, :])
-                look_up[vert_ind] = [file_num, len(data_hash[file_num])-1]
-                if vert_ind % 10000 == 0:
-                    print('{}: {} out of {}'.format(hemi, vert_ind, data.shape[0]))
-
-            np.save('{}_verts_lookup'.format(ACT.format(hemi)), look_up)
-            for file_num in range(number_of_files):
-                file_name = op.join(fol, str(file_num))
-                x = np.array(data_hash[file_num])
-                np.save(file_name, x)
-        flag = True
+            store_fol = utils.get_activity_store_fol(ACT.format(hemi))
+            utils.delete_folder_files(store_fol)
+            utils.save_activity_store(store_fol, data, chunk_size)
+        flag = all([utils.activity_store_exists(utils.get_activity_store_fol(ACT.format(hemi))) for hemi in HEMIS])
     except:
         print(traceback.format_exc())
         print('Error in save_vertex_activity_map')
@@ -4083,8 +4126,8 @@ def calc_labels_avg_per_cluster(subject, atlas, events, inverse_method, stc_name
         labels_output_fname = get_labels_data_fname(
             labels_output_fname_template, inverse_method, task, atlas, extract_method, hemi)
         lables_mmvt_fname = op.join(MMVT_DIR, MRI_SUBJECT, modalitiy, op.basename(labels_output_fname))
-        np.savez(labels_output_fname, data=labels_data[hemi][extract_method],
-                 names=labels_names, conditions=conditions)
+        utils.savez_storage(labels_output_fname, 'labels_data', data=labels_data[hemi][extract_method],
+                            names=labels_names, conditions=conditions)
         utils.copy_file(labels_output_fname, lables_mmvt_fname)
 
 
@@ -4140,6 +4183,7 @@ def calc_labels_avg_per_condition(
         conds_incdices = {cond_id:ind for ind, cond_id in zip(range(len(stcs)), events.values())}
         conditions = []
         labels_data = {}
+        labels_projection = None
 
         if not check_source_and_labels_interestion(src, labels):
             return False
@@ -4163,16 +4207,23 @@ def calc_labels_avg_per_condition(
                 stc_cond_num = 1
             for stc_ind, stc in enumerate(stc_cond):
                 for em in extract_modes:
-                    for ind, label in enumerate(labels):
-                        label_data = stc.extract_label_time_course(label, src, mode=em, allow_empty=True)
-                        label_data = np.squeeze(label_data)
-                        # Set flip to be always positive
-                        # mean_flip *= np.sign(mean_flip[np.argmax(np.abs(mean_flip))])
-                        if em not in labels_data:
-                            T = len(stc.times)
-                            labels_data[em] = np.zeros((len(labels), T, len(stcs), stc_cond_num))
-                        labels_data[em][ind, :, conds_incdices[cond_id], stc_ind] = label_data
-                        if do_plot:
+                    if em not in labels_data:
+                        T = len(stc.times)
+                        labels_data[em] = np.zeros((len(labels), T, len(stcs), stc_cond_num))
+                    if em in lu.LABELS_PROJECTION_MODES and lu.stc_fits_source_space(stc, src):
+                        # All the labels at once, using the cached sparse labels x sources projection
+                        if labels_projection is None:
+                            labels_projection = lu.calc_labels_projection(MRI_SUBJECT, atlas, labels, src)
+                        labels_data[em][:, :, conds_incdices[cond_id], stc_ind] = lu.apply_labels_projection(
+                            labels_projection, stc.data, em)
+                    else:
+                        for ind, label in enumerate(labels):
+                            label_data = stc.extract_label_time_course(label, src, mode=em, allow_empty=True)
+                            # Set flip to be always positive
+                            # mean_flip *= np.sign(mean_flip[np.argmax(np.abs(mean_flip))])
+                            labels_data[em][ind, :, conds_incdices[cond_id], stc_ind] = np.squeeze(label_data)
+                    if do_plot:
+                        for ind, label in enumerate(labels):
                             plt.plot(labels_data[em][ind, :, conds_incdices[cond_id]], label=label.name)
 
             if do_plot:
@@ -4244,7 +4295,8 @@ def save_labels_data(labels_data, hemi, labels_names, atlas, conditions, extract
         print('Saving to {}'.format(labels_output_fname))
         utils.make_dir(utils.get_parent_fol(labels_output_fname))
         # If labels_data is per ephoch: labels_num x time x conds_num x epoches_num
-        np.savez(labels_output_fname, data=labels_data[em], names=labels_names, conditions=conditions)
+        utils.savez_storage(labels_output_fname, 'labels_data', data=labels_data[em], names=labels_names,
+                            conditions=conditions)
 
 
 def calc_power_spectrum(subject, events, args, fwd_usingEEG=True, fwd_usingMEG=True, modality='meg', do_plot=False):
@@ -5248,16 +5300,38 @@ def calc_labels_func(subject, task, atlas, inv_method, em, func=None, tmin=None,
     return op.isfile(output_fname)
 
 
+def get_labels_power_bands_input_template(subject, task, atlas, inv_method, em):
+    return op.join(
+        MMVT_DIR, subject, 'meg', 'labels_data_{}_{}_{}_{}_{}.npz'.format(task, atlas, inv_method, em, '{hemi}'))
+
+
+def get_labels_power_bands_conds(conditions):
+    return '{}-{}'.format(conditions[0], conditions[1]) if len(conditions) == 2 else conditions[0]
+
+
+def get_labels_power_bands_output_fnames(subject, task, atlas, inv_method, em, func_name, bands):
+    # The outputs are named after the conditions of the labels data
+    input_fname = get_labels_power_bands_input_template(subject, task, atlas, inv_method, em).format(hemi='rh')
+    if not op.isfile(input_fname):
+        return []
+    conds = get_labels_power_bands_conds(np.load(input_fname)['conditions'])
+    return [op.join(MMVT_DIR, subject, 'labels', 'labels_data', '{}_{}_{}.npz'.format(conds, func_name, band))
+            for band in bands.keys()]
+
+
+@memo.memoize(
+    inputs=lambda subject, task, atlas, inv_method, em, **_: [
+        get_labels_power_bands_input_template(subject, task, atlas, inv_method, em)],
+    outputs=lambda subject, task, atlas, inv_method, em, func_name, bands, **_:
+        get_labels_power_bands_output_fnames(subject, task, atlas, inv_method, em, func_name, bands))
 def calc_labels_power_bands_from_timeseries(
         subject, task, atlas, inv_method, em, tmin, tmax, precentiles=(1, 99), func_name='power', norm_data=False,
         bands=dict(theta=[4, 8], alpha=[8, 15], beta=[15, 30], gamma=[30, 55], high_gamma=[65, 200]),
         overwrite=False):
-    labels_data_template_fname = op.join(
-        MMVT_DIR, subject, 'meg', 'labels_data_{}_{}_{}_{}_{}.npz'.format(task, atlas, inv_method, em, '{hemi}'))
+    labels_data_template_fname = get_labels_power_bands_input_template(subject, task, atlas, inv_method, em)
     fol = utils.make_dir(op.join(MMVT_DIR, subject, 'labels', 'labels_data'))
     labels_data = {hemi: utils.Bag(np.load(labels_data_template_fname.format(hemi=hemi))) for hemi in utils.HEMIS}
-    conds = labels_data['rh'].conditions
-    conds = '{}-{}'.format(conds[0], conds[1]) if len(conds) == 2 else conds[0]
+    conds = get_labels_power_bands_conds(labels_data['rh'].conditions)
     files_exist = all([op.isfile(op.join(fol, '{}_{}_{}.npz'.format(conds, func_name, band))) for band in bands.keys()])
     if files_exist and not overwrite:
         return True
@@ -5901,7 +5975,7 @@ def get_digitization_points(subject, raw_fname):
 
 def stc_to_contours(subject, stc_name, pick_t=0, thresholds_min=None, thresholds_max=None, thresholds_dx=1,
                     min_cluster_size=10, atlas='', clusters_label='', find_clusters_overlapped_labeles=False,
-                    mri_subject='', stc_t_smooth=None, modality='meg', n_jobs=4):
+                    mri_subject='', stc_t_smooth=None, modality='meg', save_func_labels=True, n_jobs=4):
     '''
 
     :param subject:
@@ -5917,6 +5991,7 @@ def stc_to_contours(subject, stc_name, pick_t=0, thresholds_min=None, thresholds
     :param mri_subject:
     :param stc_t_smooth:
     :param modality:
+    :param save_func_labels: save the clusters labels of all the thresholds in the clusters folder
     :param n_jobs:
     :return:
     '''
@@ -5953,30 +6028,153 @@ def stc_to_contours(subject, stc_name, pick_t=0, thresholds_min=None, thresholds
     thresholds = np.arange(thresholds_min, thresholds_max + thresholds_dx, thresholds_dx)
     print('threshold: {}'.format(thresholds))
 
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{}.pkl')
-    verts_neighbors_dict = {hemi: utils.load(verts_neighbors_fname.format(hemi)) for hemi in utils.HEMIS}
-
-    all_contours = {}
-    now = time.time()
-    for run, threshold in enumerate(thresholds):
-        key = '{:.2f}'.format(threshold)
-        all_contours[key] = {}
-        utils.time_to_go(now, run, len(thresholds), 1)
-        flag, contours = find_functional_rois_in_stc(
-            subject, mri_subject, atlas, stc_name, threshold, threshold_is_precentile=False,
-            min_cluster_size=min_cluster_size, time_index=pick_t, extract_time_series_for_clusters=False,
-            stc=stc_t_smooth, stc_t_smooth=stc_t_smooth, verts=verts, connectivity=connectivity, verts_dict=verts,
-            find_clusters_overlapped_labeles=find_clusters_overlapped_labeles, modality=modality,
-            verts_neighbors_dict=verts_neighbors_dict, save_results=False, clusters_label=clusters_label,
-            n_jobs=n_jobs)
-        for hemi in utils.HEMIS:
-            if hemi in contours:
-                all_contours[key][hemi] = np.where(contours[hemi]['contours'])
+    all_contours = {'{:.2f}'.format(threshold): {} for threshold in thresholds}
+    clusters_fol = op.join(clusters_root_fol, stc_name)
+    for hemi in utils.HEMIS:
+        stc_data = (stc_t_smooth.rh_data if hemi == 'rh' else stc_t_smooth.lh_data).squeeze()
+        if np.max(stc_data) < 1e-4:
+            stc_data = stc_data * np.power(10, 9)
+        vertices_labels, labels_names = None, None
+        if find_clusters_overlapped_labeles:
+            labels = [l for l in lu.read_labels(subject, SUBJECTS_MRI_DIR, atlas, hemi=hemi, n_jobs=n_jobs)
+                      if 'unknown' not in l.name]
+            vertices_labels = np.ones(len(stc_data), dtype=int) * -1
+            for label_ind, label in enumerate(labels):
+                vertices_labels[label.vertices[label.vertices < len(stc_data)]] = label_ind
+            labels_names = [l.name for l in labels]
+        print('Calculating the contours of {} thresholds for {}'.format(len(thresholds), hemi))
+        ret = calc_thresholds_contours(
+            stc_data, connectivity[hemi], thresholds, min_cluster_size, vertices_labels, labels_names, clusters_label,
+            return_clusters=save_func_labels, hemi=hemi)
+        hemi_contours, hemi_clusters = ret if save_func_labels else (ret, {})
+        for threshold, contours_verts in hemi_contours.items():
+            all_contours['{:.2f}'.format(threshold)][hemi] = contours_verts
+        if save_func_labels:
+            save_clusters_labels(subject, hemi_clusters, hemi, verts[hemi], clusters_fol)
     print('Results are saved in {}'.format(output_fname))
     utils.save(all_contours, output_fname)
     return op.isfile(output_fname), all_contours
 
 
+def save_clusters_labels(subject, thresholds_clusters, hemi, hemi_verts, clusters_fol):
+    # Saves the clusters of all the thresholds like calc_cluster_labels (the same cluster in several thresholds is
+    # saved once, as its file name is set by its size, max and name)
+    utils.make_dir(clusters_fol)
+    for clusters in thresholds_clusters.values():
+        for cluster in clusters:
+            cluster_name = 'cluster_size_{}_max_{:.2f}_{}.label'.format(cluster['size'], cluster['max'], cluster['name'])
+            cluster_fname = op.join(clusters_fol, cluster_name)
+            if op.isfile(cluster_fname):
+                continue
+            mne.Label(cluster['vertices'], hemi_verts[cluster['vertices']], hemi=hemi, name=cluster['name'],
+                      subject=subject).save(cluster_fname)
+
+
+def calc_thresholds_contours(data, connectivity, thresholds, min_cluster_size=10, vertices_labels=None,
+                             labels_names=None, clusters_label='', return_clusters=False, hemi=''):
+    # Sweeps all the thresholds at once: The vertices are sorted by their value, and added in descending order
+    # to an incremental union-find over the mesh graph. Like mne_clusters._find_clusters, the positive
+    # (data > threshold) and negative (data < -threshold) clusters are found separately, in two sweeps.
+    # For each threshold, the contours are the vertices of the clusters (min_cluster_size and overlapped labels
+    # filters) with a neighbor outside their cluster.
+    import scipy.sparse
+    data = np.asarray(data).squeeze()
+    vertices_num = len(data)
+    adj = scipy.sparse.csr_matrix(connectivity)[:vertices_num, :vertices_num].tocoo()
+    not_self = adj.row != adj.col
+    adj = scipy.sparse.csr_matrix(
+        (np.ones(np.sum(not_self)), (adj.row[not_self], adj.col[not_self])), shape=(vertices_num, vertices_num))
+    indptr, indices = adj.indptr, adj.indices.tolist()
+    degree = np.diff(indptr)
+    contours, clusters = {}, defaultdict(list)
+    for sign in [1, -1]:
+        for threshold, roots, active_mask, active_nei in _sweep_thresholds_clusters(
+                sign * data, indptr, indices, thresholds):
+            clusters_sizes = np.bincount(roots[active_mask], minlength=vertices_num)
+            clusters_mask = active_mask & (clusters_sizes[roots] >= min_cluster_size)
+            clusters_names = {}
+            if vertices_labels is not None:
+                labels_mask, clusters_names = _calc_clusters_labels_mask(
+                    roots, clusters_mask, vertices_labels, labels_names, clusters_label)
+                clusters_mask &= labels_mask
+            if not np.any(clusters_mask):
+                continue
+            contours_verts = np.where(clusters_mask & (active_nei < degree))[0]
+            contours[threshold] = np.union1d(contours[threshold], contours_verts) if threshold in contours \
+                else contours_verts
+            if return_clusters:
+                clusters_verts = np.where(clusters_mask)[0]
+                clusters_verts = clusters_verts[np.argsort(roots[clusters_verts], kind='mergesort')]
+                clusters_roots, splits = np.unique(roots[clusters_verts], return_index=True)
+                for root, cluster in zip(clusters_roots, np.split(clusters_verts, splits[1:])):
+                    max_vert = cluster[np.argmax(sign * data[cluster])]
+                    clusters[threshold].append(dict(
+                        vertices=cluster, name=clusters_names.get(root, '{}{}'.format(hemi, root)),
+                        max=data[max_vert], max_vert=max_vert, size=len(cluster)))
+    # The same format as np.where
+    contours = {threshold: (contours_verts,) for threshold, contours_verts in contours.items()}
+    return (contours, clusters) if return_clusters else contours
+
+
+def _sweep_thresholds_clusters(data, indptr, indices, thresholds):
+    # Yields the clusters roots, the active vertices (data > threshold) and their active neighbors num for every
+    # threshold, from the highest threshold down
+    vertices_num = len(data)
+    order = np.argsort(-data, kind='mergesort')
+    parent = list(range(vertices_num))
+    active = [False] * vertices_num
+    active_nei = [0] * vertices_num
+
+    def find(v):
+        root = v
+        while parent[root] != root:
+            root = parent[root]
+        while parent[v] != root:
+            parent[v], v = root, parent[v]
+        return root
+
+    pos = 0
+    for threshold in sorted(thresholds, reverse=True):
+        while pos < vertices_num and data[order[pos]] > threshold:
+            v = int(order[pos])
+            active[v] = True
+            for u in indices[indptr[v]:indptr[v + 1]]:
+                active_nei[u] += 1
+                if active[u]:
+                    root_v, root_u = find(v), find(u)
+                    if root_v != root_u:
+                        parent[root_u] = root_v
+            pos += 1
+        if pos == 0:
+            continue
+        roots = np.array(parent)
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                break
+            roots = next_roots
+        yield threshold, roots, np.array(active), np.array(active_nei)
+
+
+def _calc_clusters_labels_mask(roots, clusters_mask, vertices_labels, labels_names, clusters_label=''):
+    # Like lu.find_clusters_overlapped_labeles: A cluster is kept if it overlaps a label, and the label with the
+    # biggest overlap contains clusters_label. Returns also the kept clusters names (their top labels)
+    clusters_verts = np.where(clusters_mask & (vertices_labels >= 0))[0]
+    labels_mask = np.zeros(len(roots), dtype=bool)
+    if len(clusters_verts) == 0:
+        return labels_mask, {}
+    pairs, counts = np.unique(
+        np.vstack((roots[clusters_verts], vertices_labels[clusters_verts])), axis=1, return_counts=True)
+    kept_roots = {}
+    for root in np.unique(pairs[0]):
+        root_inds = np.where(pairs[0] == root)[0]
+        _, top_label = max([(counts[ind], labels_names[pairs[1, ind]]) for ind in root_inds])
+        if clusters_label == '' or clusters_label in top_label:
+            kept_roots[root] = top_label
+    labels_mask[clusters_mask] = np.isin(roots[clusters_mask], list(kept_roots.keys()))
+    return labels_mask, kept_roots
+
+
 def find_clusters_over_time(
         subject, stc_name, threshold, times=None, min_cluster_size=10, atlas='', clusters_label='',
         find_clusters_overlapped_labeles=False, mri_subject='', modality='meg', n_jobs=4):
@@ -5994,8 +6192,7 @@ def find_clusters_over_time(
     if times is None:
         times = range(stc.shape[1])
 
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{}.pkl')
-    verts_neighbors_dict = {hemi: utils.load(verts_neighbors_fname.format(hemi)) for hemi in utils.HEMIS}
+    verts_neighbors_dict = anat.load_verts_neighbors(subject)
 
     all_contours = {}
     indices = np.array_split(np.arange(len(times)), n_jobs)
@@ -6070,6 +6267,7 @@ def main(tup, remote_subject_dir, org_args, flags=None):
     stcs_conds, stcs_conds_smooth = None, None
     if flags is None:
         flags = {}
+    epochs_store.set_enabled(args.use_epochs_store)
     fname_format, fname_format_cond, conditions = init(subject, args, mri_subject, remote_subject_dir)
     if len(conditions) == 1:
         args.cond_name = list(conditions)[0]
@@ -6327,6 +6525,8 @@ def read_cmd_args(argv=None):
     parser.add_argument('--max_epochs_num', help='', required=False, default=0, type=int)
     parser.add_argument('--overwrite', help='general overwrite', required=False, default=0, type=au.is_true)
     parser.add_argument('--overwrite_epochs', help='overwrite_epochs', required=False, default=0, type=au.is_true)
+    parser.add_argument('--use_epochs_store', help='read the epochs from a memory-mapped cache', required=False,
+                        default=1, type=au.is_true)
     parser.add_argument('--overwrite_evoked', help='overwrite_evoked', required=False, default=0, type=au.is_true)
     parser.add_argument('--overwrite_sensors', help='overwrite_sensors', required=False, default=0, type=au.is_true)
     parser.add_argument('--overwrite_fwd', help='overwrite_fwd', required=False, default=0, type=au.is_true)
@@ -0,0 +1,190 @@
+import os
+import os.path as op
+import glob
+import json
+import shutil
+import inspect
+import numpy as np
+import mne
+
+from src.utils import utils
+
+# A memory-mapped cache of the epochs files.
+# Every epochs fif file (per projection flag) is converted once into STORE_FOL_NAME/{name}[_proj] next to it:
+# data.npy (epochs x channels x times), meta.pkl (info, events, event_id, tmin, baseline, selection, drop_log,
+# metadata) and manifest.json, which holds the fif (and its split files) sizes and mtimes, and is written last.
+# read_epochs returns an EpochsArray over a copy-on-write memory map of data.npy, so nothing is read until it's
+# used, and in place changes (apply_proj, set_eeg_reference) don't touch the cache. The store is recreated when the
+# fif file changes.
+
+STORE_FOL_NAME = 'epochs_store'
+DATA_NAME = 'data.npy'
+META_NAME = 'meta.pkl'
+MANIFEST_NAME = 'manifest.json'
+CONVERT_CHUNK_SIZE = 50
+
+_enabled = os.environ.get('MMVT_EPOCHS_STORE', '1') not in ('0', 'false', 'False')
+# {store_fol: (fingerprint, meta)}. The data is mapped again for every read, as the copy-on-write pages are
+# shared by all the users of the same map
+_loaded_stores = {}
+
+
+def set_enabled(val=True):
+    global _enabled
+    _enabled = bool(val)
+
+
+def is_enabled():
+    return _enabled
+
+
+def get_store_fol(epo_fname, proj=True):
+    return op.join(op.dirname(op.abspath(epo_fname)), STORE_FOL_NAME, '{}{}'.format(
+        utils.namebase(epo_fname), '_proj' if proj else ''))
+
+
+def get_source_fnames(epo_fname):
+    # The fif file with its split parts (name-epo-1.fif, name-epo-2.fif...)
+    return [epo_fname] + sorted(glob.glob('{}-[0-9]*.fif'.format(op.splitext(epo_fname)[0])))
+
+
+def calc_fingerprint(epo_fname):
+    fingerprint = []
+    for fname in get_source_fnames(epo_fname):
+        st = os.stat(fname)
+        fingerprint.append([op.basename(fname), st.st_size, st.st_mtime_ns])
+    return fingerprint
+
+
+def read_manifest(store_fol):
+    manifest_fname = op.join(store_fol, MANIFEST_NAME)
+    if not op.isfile(manifest_fname):
+        return None
+    try:
+        with open(manifest_fname, 'r') as f:
+            return json.load(f)
+    except:
+        return None
+
+
+def is_store_valid(store_fol, fingerprint):
+    manifest = read_manifest(store_fol)
+    return manifest is not None and manifest.get('fingerprint') == fingerprint and \
+        all(op.isfile(op.join(store_fol, fname)) for fname in [DATA_NAME, META_NAME])
+
+
+def convert(epo_fname, proj=True, overwrite=False, chunk_size=CONVERT_CHUNK_SIZE):
+    # Reads the epochs lazily and writes their data chunk by chunk, so the epochs are never all in memory
+    store_fol = get_store_fol(epo_fname, proj)
+    fingerprint = calc_fingerprint(epo_fname)
+    if is_store_valid(store_fol, fingerprint) and not overwrite:
+        return store_fol
+    print('Converting {} into the epochs store'.format(epo_fname))
+    tmp_fol = '{}.tmp'.format(store_fol)
+    shutil.rmtree(tmp_fol, ignore_errors=True)
+    utils.make_dir(tmp_fol)
+    epochs = mne.read_epochs(epo_fname, proj=proj, preload=False)
+    # The bad epochs are dropped by get_data, chunk by chunk, so the fif isn't read again for drop_bad.
+    # data.npy is allocated for all the candidate epochs, and truncated if some of them were dropped
+    candidates_num = len(epochs)
+    data, kept, drop_log, epochs_num = None, [], list(epochs.drop_log), 0
+    for from_ind in range(0, candidates_num, chunk_size):
+        chunk = epochs[from_ind:from_ind + chunk_size]
+        chunk_data = chunk.get_data()
+        if data is None:
+            data = np.lib.format.open_memmap(op.join(tmp_fol, DATA_NAME), mode='w+', dtype=chunk_data.dtype,
+                                             shape=(candidates_num,) + chunk_data.shape[1:])
+        data[epochs_num:epochs_num + len(chunk_data)] = chunk_data
+        epochs_num += len(chunk_data)
+        chunk_selection = epochs.selection[from_ind:from_ind + chunk_size]
+        kept.extend(from_ind + np.where(np.isin(chunk_selection, chunk.selection))[0])
+        for ind in chunk_selection:
+            drop_log[ind] = chunk.drop_log[ind]
+    if data is None:
+        data = np.lib.format.open_memmap(op.join(tmp_fol, DATA_NAME), mode='w+', dtype=np.float64,
+                                         shape=(0, len(epochs.ch_names), len(epochs.times)))
+    shape = data.shape[1:]
+    data.flush()
+    del data
+    if epochs_num < candidates_num:
+        truncate_data(op.join(tmp_fol, DATA_NAME), epochs_num, chunk_size)
+    kept = np.array(kept, dtype=int)
+    metadata = getattr(epochs, 'metadata', None)
+    meta = dict(info=epochs.info, events=epochs.events[kept], event_id=epochs.event_id, tmin=epochs.tmin,
+                baseline=epochs.baseline, selection=epochs.selection[kept],
+                drop_log=tuple(drop_log) if isinstance(epochs.drop_log, tuple) else drop_log,
+                metadata=metadata.iloc[kept] if metadata is not None else None, proj=proj)
+    utils.save(meta, op.join(tmp_fol, META_NAME))
+    with open(op.join(tmp_fol, MANIFEST_NAME), 'w') as f:
+        json.dump(dict(epo_fname=op.abspath(epo_fname), fingerprint=fingerprint, proj=proj, mne=mne.__version__,
+                       shape=list(shape), epochs_num=epochs_num), f)
+    _loaded_stores.pop(store_fol, None)
+    shutil.rmtree(store_fol, ignore_errors=True)
+    os.replace(tmp_fol, store_fol)
+    return store_fol
+
+
+def truncate_data(data_fname, epochs_num, chunk_size=CONVERT_CHUNK_SIZE):
+    # Keeps only the first epochs_num epochs of data_fname
+    data = np.load(data_fname, mmap_mode='r')
+    tmp_fname = '{}.tmp.npy'.format(op.splitext(data_fname)[0])
+    truncated = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=data.dtype, shape=(epochs_num,) + data.shape[1:])
+    for from_ind in range(0, epochs_num, chunk_size):
+        truncated[from_ind:from_ind + chunk_size] = data[from_ind:min(from_ind + chunk_size, epochs_num)]
+    truncated.flush()
+    del data, truncated
+    os.replace(tmp_fname, data_fname)
+
+
+def load_store(epo_fname, proj=True):
+    # Returns the (memory-mapped) data and the meta of the epochs, converting them first if needed
+    store_fol = get_store_fol(epo_fname, proj)
+    fingerprint = calc_fingerprint(epo_fname)
+    if store_fol in _loaded_stores and _loaded_stores[store_fol][0] == fingerprint:
+        meta = _loaded_stores[store_fol][1]
+    else:
+        if not is_store_valid(store_fol, fingerprint):
+            convert(epo_fname, proj)
+        meta = utils.load(op.join(store_fol, META_NAME))
+        _loaded_stores[store_fol] = (fingerprint, meta)
+    return np.load(op.join(store_fol, DATA_NAME), mmap_mode='c'), meta
+
+
+def read_epochs_data(epo_fname, proj=True):
+    # A (epochs x channels x times) copy-on-write memory map, for code which needs only the data
+    data, _ = load_store(epo_fname, proj)
+    return data
+
+
+def create_epochs(data, meta):
+    kwargs = dict(metadata=meta.get('metadata'), selection=meta.get('selection'), drop_log=meta.get('drop_log'))
+    params = inspect.signature(mne.EpochsArray).parameters
+    kwargs = {k: v for k, v in kwargs.items() if k in params and v is not None}
+    # The data was already baseline corrected (and projected if proj) when it was converted
+    epochs = mne.EpochsArray(data, meta['info'].copy(), meta['events'].copy(), meta['tmin'], dict(meta['event_id']),
+                             baseline=None, proj=False, verbose=False, **kwargs)
+    if 'selection' not in kwargs and meta.get('selection') is not None:
+        epochs.selection = meta['selection']
+    # Only the baseline's value is restored, the data isn't corrected again
+    epochs.baseline = meta.get('baseline')
+    return epochs
+
+
+def read_epochs(epo_fname, proj=True, add_eeg_ref=None):
+    # Can replace mne.read_epochs(epo_fname, proj, add_eeg_ref), falls back to it if the store can't be used
+    if _enabled:
+        try:
+            return create_epochs(*load_store(epo_fname, proj))
+        except:
+            print('Can\'t use the epochs store for {}, reading the fif file'.format(epo_fname))
+            utils.print_last_error_line()
+    if add_eeg_ref is None:
+        return mne.read_epochs(epo_fname, proj)
+    return mne.read_epochs(epo_fname, proj, add_eeg_ref)
+
+
+def clear(epo_fname):
+    for proj in [True, False]:
+        store_fol = get_store_fol(epo_fname, proj)
+        _loaded_stores.pop(store_fol, None)
+        shutil.rmtree(store_fol, ignore_errors=True)
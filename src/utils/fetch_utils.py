@@ -0,0 +1,239 @@
+import os
+import os.path as op
+import fnmatch
+import glob
+import hashlib
+import json
+import shutil
+import stat
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+MANIFEST_NAME = 'fetch_manifest.json'
+PART_POSTFIX = '.part'
+CHUNK_SIZE = 2 ** 20
+
+
+class LocalRemote(object):
+    # A remote subject folder that is accessible as a local (or mounted network) directory
+    sep = os.sep
+
+    def listdir_attr(self, fol):
+        # {file name: (size, mtime)} of all the files in the folder, with one directory listing
+        if not op.isdir(fol):
+            return {}
+        return {entry.name: (entry.stat().st_size, entry.stat().st_mtime) for entry in os.scandir(fol)
+                if entry.is_file()}
+
+    def join(self, *paths):
+        return op.join(*paths)
+
+    def open(self, fname):
+        return open(fname, 'rb')
+
+    def close(self):
+        pass
+
+
+class SftpRemote(object):
+    # A remote subject folder over sftp. The connection isn't thread safe, so every worker thread opens its own
+    # connection with connection_func (which returns a pysftp.Connection like object).
+    sep = '/'
+
+    def __init__(self, connection_func):
+        self.connection_func = connection_func
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    @property
+    def con(self):
+        if getattr(self._local, 'con', None) is None:
+            self._local.con = self.connection_func()
+            with self._lock:
+                self._connections.append(self._local.con)
+        return self._local.con
+
+    def listdir_attr(self, fol):
+        try:
+            return {attr.filename: (attr.st_size, attr.st_mtime) for attr in self.con.listdir_attr(fol)
+                    if not stat.S_ISDIR(attr.st_mode)}
+        except (IOError, OSError):
+            return {}
+
+    def join(self, *paths):
+        return '/'.join([p.rstrip('/') for p in paths if p != ''])
+
+    def open(self, fname):
+        return self.con.open(fname, 'rb')
+
+    def close(self):
+        with self._lock:
+            for con in self._connections:
+                try:
+                    con.close()
+                except:
+                    pass
+            self._connections = []
+        self._local = threading.local()
+
+
+def calc_md5(fname, chunk_size=CHUNK_SIZE):
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_manifest_fname(local_subject_dir):
+    return op.join(local_subject_dir, MANIFEST_NAME)
+
+
+def load_manifest(local_subject_dir):
+    manifest_fname = get_manifest_fname(local_subject_dir)
+    if not op.isfile(manifest_fname):
+        return {}
+    try:
+        with open(manifest_fname, 'r') as f:
+            return json.load(f)
+    except:
+        print('Can\'t read {}!'.format(manifest_fname))
+        return {}
+
+
+def save_manifest(local_subject_dir, manifest):
+    manifest_fname = get_manifest_fname(local_subject_dir)
+    tmp_fname = manifest_fname + PART_POSTFIX
+    with open(tmp_fname, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_fname, manifest_fname)
+
+
+def resolve_manifest(necessary_files, subject, remote_subject_dir, local_subject_dir, remote,
+                     select_one_file=None, print_missing_files=True):
+    # Resolves all the necessary files (with their wildcards) against the remote folder up front. Every remote
+    # folder is listed once. Returns a list of dicts with the remote and local file names, the remote size and mtime.
+    entries, listings = [], {}
+    for fol, files in necessary_files.items():
+        fol = fol.replace(':', op.sep)
+        remote_fol = remote.join(remote_subject_dir, *fol.split(op.sep)) if fol not in ('', '.') else \
+            remote_subject_dir
+        if remote_fol not in listings:
+            listings[remote_fol] = remote.listdir_attr(remote_fol)
+        listing = listings[remote_fol]
+        for file_name in files:
+            file_name = file_name.replace('{subject}', subject)
+            remote_names = sorted(fnmatch.filter(listing.keys(), file_name))
+            # fs53 DKT atlas backward compatibility fix
+            if len(remote_names) == 0 and 'DKTatlas' in file_name:
+                remote_names = sorted(fnmatch.filter(listing.keys(), file_name.replace('DKTatlas', 'DKTatlas40')))
+            if len(remote_names) == 0:
+                if print_missing_files:
+                    print("Remote file can't be found! {}".format(remote.join(remote_fol, file_name)))
+                continue
+            if len(remote_names) > 1 and select_one_file is not None:
+                remote_name = select_one_file(remote_names, files_desc=file_name)
+                if remote_name == '':
+                    continue
+            else:
+                remote_name = remote_names[0]
+            local_name = file_name if '*' not in file_name and '?' not in file_name else remote_name
+            remote_lower = remote_name.lower()
+            if subject.lower() in remote_lower and subject not in remote_name:
+                ind = remote_lower.index(subject.lower())
+                local_name = remote_name[:ind] + subject + remote_name[ind + len(subject):]
+            size, mtime = listing[remote_name]
+            entries.append(dict(
+                remote_fname=remote.join(remote_fol, remote_name), local_fname=op.join(local_subject_dir, fol, local_name),
+                rel_fname=op.join(fol, local_name), local_pattern=op.join(local_subject_dir, fol, file_name),
+                size=size, mtime=mtime))
+    return entries
+
+
+def file_is_up_to_date(entry, manifest, overwrite=False, checksum=False):
+    # A fetched local file is skipped if the remote file wasn't changed since, and the local file has the remote
+    # size and mtime (the mtime is kept when fetching), or, if checksum is set, the md5 recorded when it was fetched.
+    # Local files that weren't fetched (no manifest record) are kept as they are.
+    local_fname = entry['local_fname']
+    record = manifest.get(entry['rel_fname'], None)
+    if overwrite:
+        return False
+    if record is None:
+        return any([op.getsize(fname) > 0 for fname in glob.glob(entry['local_pattern'])])
+    if not op.isfile(local_fname) or op.getsize(local_fname) != entry['size'] or \
+            record.get('mtime', None) != entry['mtime']:
+        return False
+    if checksum:
+        return record.get('md5', '') == calc_md5(local_fname)
+    return abs(op.getmtime(local_fname) - entry['mtime']) < 1
+
+
+def fetch_file(entry, remote, chunk_size=CHUNK_SIZE, checksum=False):
+    # Copies the remote file into a .part file, which is resumed if a former fetch of the same remote file
+    # (same size and mtime, recorded in a .part.json file) was interrupted, and then moved to its place
+    local_fname = entry['local_fname']
+    part_fname, part_info_fname = local_fname + PART_POSTFIX, local_fname + PART_POSTFIX + '.json'
+    os.makedirs(op.dirname(local_fname), exist_ok=True)
+    offset = 0
+    if op.isfile(part_fname) and op.isfile(part_info_fname):
+        try:
+            with open(part_info_fname, 'r') as f:
+                part_info = json.load(f)
+            if part_info['size'] == entry['size'] and part_info['mtime'] == entry['mtime']:
+                offset = min(op.getsize(part_fname), entry['size'])
+        except:
+            offset = 0
+    if offset == 0:
+        with open(part_info_fname, 'w') as f:
+            json.dump(dict(size=entry['size'], mtime=entry['mtime'], remote_fname=entry['remote_fname']), f)
+    with remote.open(entry['remote_fname']) as remote_file, open(part_fname, 'ab' if offset > 0 else 'wb') as f:
+        if offset > 0:
+            remote_file.seek(offset)
+        shutil.copyfileobj(remote_file, f, chunk_size)
+    if op.getsize(part_fname) != entry['size']:
+        raise Exception('{}: got {} bytes instead of {}!'.format(
+            entry['remote_fname'], op.getsize(part_fname), entry['size']))
+    os.utime(part_fname, (entry['mtime'], entry['mtime']))
+    os.replace(part_fname, local_fname)
+    os.remove(part_info_fname)
+    return dict(remote_fname=entry['remote_fname'], size=entry['size'], mtime=entry['mtime'],
+                md5=calc_md5(local_fname) if checksum else '', resumed_from=offset)
+
+
+def fetch_subject_files(necessary_files, subject, remote_subject_dir, local_subject_dir, remote=None,
+                        overwrite_files=False, workers_num=8, checksum=False, select_one_file=None,
+                        print_missing_files=True, print_traceback=True):
+    # Resolves the subject's necessary files manifest and fetches the missing or changed files concurrently.
+    # The per subject manifest (local_subject_dir/fetch_manifest.json) records every fetched file.
+    if remote is None:
+        remote = LocalRemote()
+    try:
+        entries = resolve_manifest(necessary_files, subject, remote_subject_dir, local_subject_dir, remote,
+                                   select_one_file, print_missing_files)
+        manifest = load_manifest(local_subject_dir)
+        to_fetch = [e for e in entries if not file_is_up_to_date(e, manifest, overwrite_files, checksum)]
+        print('{}: {} files in the manifest, fetching {}'.format(subject, len(entries), len(to_fetch)))
+        fetched, failed = 0, 0
+        if len(to_fetch) > 0:
+            with ThreadPoolExecutor(max_workers=max(1, min(workers_num, len(to_fetch)))) as executor:
+                futures = {executor.submit(fetch_file, entry, remote, CHUNK_SIZE, checksum): entry
+                           for entry in to_fetch}
+                for future in as_completed(futures):
+                    entry = futures[future]
+                    try:
+                        manifest[entry['rel_fname']] = future.result()
+                        fetched += 1
+                        print('fetched {} to {}'.format(entry['remote_fname'], entry['local_fname']))
+                    except:
+                        failed += 1
+                        print('Can\'t fetch {}!'.format(entry['remote_fname']))
+                        if print_traceback:
+                            print(traceback.format_exc())
+            os.makedirs(local_subject_dir, exist_ok=True)
+            save_manifest(local_subject_dir, manifest)
+    finally:
+        # The remote connections are closed also when nothing was fetched, or the resolving failed
+        remote.close()
+    return fetched, failed
@@ -742,8 +742,7 @@ def read_labels(subject, subjects_dir, atlas, try_first_from_annotation=True, on
             atlas = 'aparc.DKTatlas40'
         if try_first_from_annotation:
             try:
-                labels = mne.read_labels_from_annot(
-                    subject, atlas, subjects_dir=subjects_dir, surf_name=surf_name, hemi=hemi)
+                labels = read_labels_from_annot_cached(subject, atlas, subjects_dir, surf_name, hemi)
             except:
                 # print(traceback.format_exc())
                 print("read_labels_from_annot failed! subject {} atlas {} surf name {} hemi {}.".format(
@@ -767,8 +766,7 @@ def read_labels(subject, subjects_dir, atlas, try_first_from_annotation=True, on
             else:
                 print('Can\'t find any labels for {} {}!'.format(hemi, atlas))
                 return []
-            labels = mne.read_labels_from_annot(
-                subject, atlas, subjects_dir=subjects_dir, surf_name=surf_name, hemi=hemi)
+            labels = read_labels_from_annot_cached(subject, atlas, subjects_dir, surf_name, hemi)
             if len(labels) == 0:
                 if not annotations_exist:
                     raise Exception("Can't read the {} labels!".format(atlas))
@@ -812,6 +810,10 @@ def read_labels_parallel(subject, subjects_dir, atlas, hemi='', labels_fol='', n
             labels_files.extend(glob.glob(op.join(labels_fol, '{}.*label'.format(hemi))))
         else:
             labels_files = glob.glob(op.join(labels_fol, '*.label'))
+        cache_fname = get_labels_cache_fname(subject, atlas, 'files', hemi, labels_files)
+        labels = load_labels_cache(cache_fname, subject)
+        if labels is not None:
+            return labels
         files_chunks = utils.chunks(labels_files, len(labels_files) / n_jobs)
         results = utils.run_parallel(_read_labels_parallel, files_chunks, njobs=n_jobs)
         labels = []
@@ -819,12 +821,74 @@ def read_labels_parallel(subject, subjects_dir, atlas, hemi='', labels_fol='', n
             labels.extend(labels_chunk)
         for l in labels:
             l.subject = subject
+        save_labels_cache(cache_fname, labels)
         return labels
     except:
         print(traceback.format_exc())
         return []
 
 
+def read_labels_from_annot_cached(subject, atlas, subjects_dir, surf_name='pial', hemi='both'):
+    annot_fnames = get_annot_fnames(subject, subjects_dir, atlas, hemi)
+    surf_fnames = [op.join(subjects_dir, subject, 'surf', '{}.{}'.format(
+        utils.namebase(annot_fname)[:2], surf_name)) for annot_fname in annot_fnames]
+    cache_fname = get_labels_cache_fname(subject, atlas, surf_name, hemi, annot_fnames + surf_fnames)
+    labels = load_labels_cache(cache_fname, subject)
+    if labels is None:
+        labels = mne.read_labels_from_annot(subject, atlas, subjects_dir=subjects_dir, surf_name=surf_name, hemi=hemi)
+        save_labels_cache(cache_fname, labels)
+    return labels
+
+
+def get_labels_cache_fname(subject, atlas, source, hemi, source_fnames):
+    # The cache is keyed by the source files (annot and surface files, or the label files) names, sizes and mtimes
+    import hashlib
+    md5 = hashlib.md5()
+    for fname in sorted(source_fnames):
+        stat = os.stat(fname) if op.isfile(fname) else None
+        md5.update('{}:{}:{}'.format(fname, stat.st_size if stat else -1, stat.st_mtime if stat else -1).encode())
+    return op.join(MMVT_DIR, subject, 'labels', 'cache', '{}_{}_{}_{}.npz'.format(
+        atlas, source, hemi, md5.hexdigest()[:12]))
+
+
+def save_labels_cache(cache_fname, labels):
+    if len(labels) == 0:
+        return False
+    try:
+        utils.make_dir(utils.get_parent_fol(cache_fname))
+        colors = np.array([l.color if l.color is not None else [np.nan] * 4 for l in labels], dtype=np.float64)
+        np.savez(
+            cache_fname, names=np.array([l.name for l in labels]), hemis=np.array([l.hemi for l in labels]),
+            comments=np.array([l.comment if l.comment is not None else '' for l in labels]), colors=colors,
+            indptr=np.concatenate(([0], np.cumsum([len(l.vertices) for l in labels]))).astype(np.int64),
+            vertices=np.concatenate([l.vertices for l in labels]).astype(np.int32),
+            pos=np.concatenate([l.pos for l in labels]), values=np.concatenate([l.values for l in labels]))
+    except:
+        print('Error in saving the labels cache {}'.format(cache_fname))
+        utils.print_last_error_line()
+    return op.isfile(cache_fname)
+
+
+def load_labels_cache(cache_fname, subject):
+    if not op.isfile(cache_fname):
+        return None
+    try:
+        d = np.load(cache_fname)
+        names, hemis, comments, colors, indptr, vertices, pos, values = (
+            d['names'], d['hemis'], d['comments'], d['colors'], d['indptr'], d['vertices'], d['pos'], d['values'])
+    except:
+        print('Error in loading the labels cache {}'.format(cache_fname))
+        utils.print_last_error_line()
+        return None
+    labels = []
+    for ind, (name, hemi, comment, color) in enumerate(zip(names, hemis, comments, colors)):
+        from_ind, to_ind = indptr[ind], indptr[ind + 1]
+        labels.append(mne.Label(
+            vertices[from_ind:to_ind].astype(np.int64), pos[from_ind:to_ind], values[from_ind:to_ind], str(hemi),
+            str(comment), str(name), subject=subject, color=None if np.isnan(color[0]) else tuple(color)))
+    return labels
+
+
 def _read_labels_parallel(files_chunk):
     labels = []
     for label_fname in files_chunk:
@@ -1128,6 +1192,101 @@ def find_clusters_overlapped_labeles(subject, clusters, data, atlas, hemi, verts
     return cluster_labels
 
 
+LABELS_PROJECTION_MODES = ('mean', 'mean_flip', 'max')
+
+
+def calc_source_space_hash(src):
+    import hashlib
+    md5 = hashlib.md5()
+    for s in src:
+        md5.update(np.ascontiguousarray(s['vertno'], dtype=np.int64).tobytes())
+        md5.update(np.ascontiguousarray(s['nn'][s['vertno']], dtype=np.float32).tobytes())
+    return md5.hexdigest()[:12]
+
+
+def calc_labels_hash(labels):
+    import hashlib
+    md5 = hashlib.md5()
+    for label in labels:
+        md5.update('{}{}'.format(label.name, label.hemi).encode())
+        md5.update(np.ascontiguousarray(label.vertices, dtype=np.int64).tobytes())
+    return md5.hexdigest()[:12]
+
+
+def get_labels_sources_indices(labels, src):
+    # The same indexing as mne's extract_label_time_course: lh sources first, then the rh ones
+    vertno = [s['vertno'] for s in src]
+    nvert = [len(vn) for vn in vertno]
+    labels_indices = []
+    for label in labels:
+        sub_labels = [label.lh, label.rh] if label.hemi == 'both' else [label]
+        label_indices = []
+        for slabel in sub_labels:
+            if slabel.hemi == 'lh':
+                label_indices.append(np.searchsorted(vertno[0], np.intersect1d(vertno[0], slabel.vertices)))
+            elif slabel.hemi == 'rh':
+                label_indices.append(nvert[0] + np.searchsorted(vertno[1], np.intersect1d(vertno[1], slabel.vertices)))
+            else:
+                raise ValueError('label {} has invalid hemi'.format(label.name))
+        labels_indices.append(np.concatenate(label_indices).astype(np.int64))
+    return labels_indices
+
+
+def calc_labels_projection(subject, atlas, labels, src, overwrite=False):
+    # A (labels x sources) projection in a CSR layout (indptr, indices, flips), cached per subject, atlas and
+    # source space. The flips are mne's label_sign_flip, so mean_flip gives the same results as
+    # stc.extract_label_time_course(label, src, mode='mean_flip').
+    output_fname = op.join(MMVT_DIR, subject, 'labels', 'projections', '{}_{}_{}.npz'.format(
+        atlas, calc_source_space_hash(src), calc_labels_hash(labels)))
+    if op.isfile(output_fname) and not overwrite:
+        return utils.Bag(np.load(output_fname))
+    labels_indices = get_labels_sources_indices(labels, src)
+    flips = [mne.label_sign_flip(label, src) if len(label_indices) > 0 else np.array([])
+             for label, label_indices in zip(labels, labels_indices)]
+    projection = dict(
+        labels_names=np.array([label.name for label in labels]),
+        indptr=np.concatenate(([0], np.cumsum([len(inds) for inds in labels_indices]))).astype(np.int64),
+        indices=np.concatenate(labels_indices).astype(np.int64),
+        flips=np.concatenate(flips).astype(np.float64),
+        sources_num=sum([len(s['vertno']) for s in src]))
+    utils.make_dir(utils.get_parent_fol(output_fname))
+    np.savez(output_fname, **projection)
+    return utils.Bag(projection)
+
+
+def apply_labels_projection(projection, data, mode='mean_flip', chunk_size=10000):
+    # data: sources x time -> labels x time, empty labels are set to zero. The time is processed in chunks, so
+    # data can also be a memmap.
+    import scipy.sparse
+    if mode not in LABELS_PROJECTION_MODES:
+        raise Exception('apply_labels_projection: mode should be one of {}'.format(LABELS_PROJECTION_MODES))
+    indptr, indices = projection.indptr, projection.indices
+    labels_num, T = len(indptr) - 1, data.shape[1]
+    lengths = np.diff(indptr)
+    labels_data = np.zeros((labels_num, T), dtype=np.float64)
+    if mode == 'max':
+        non_empty = lengths > 0
+        starts = indptr[:-1][non_empty]
+        for t_from in range(0, T, chunk_size):
+            x = np.abs(data[indices, t_from:t_from + chunk_size])
+            if len(starts) > 0:
+                labels_data[non_empty, t_from:t_from + chunk_size] = np.maximum.reduceat(x, starts, axis=0)
+    else:
+        weights = 1.0 / np.repeat(lengths, lengths)
+        if mode == 'mean_flip':
+            weights *= projection.flips
+        projection_mat = scipy.sparse.csr_matrix(
+            (weights, indices, indptr), shape=(labels_num, int(projection.sources_num)))
+        for t_from in range(0, T, chunk_size):
+            labels_data[:, t_from:t_from + chunk_size] = projection_mat.dot(data[:, t_from:t_from + chunk_size])
+    return labels_data
+
+
+def stc_fits_source_space(stc, src):
+    return len(stc.vertices) == len(src) and \
+           all([np.array_equal(v, s['vertno']) for v, s in zip(stc.vertices, src)])
+
+
 if __name__ == '__main__':
     pass
     # subject = 'DC'
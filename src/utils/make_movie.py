@@ -4,6 +4,7 @@ import matplotlib.animation as animation
 import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
 from matplotlib import gridspec
+from matplotlib import colors as mpl_colors
 import os.path as op
 import glob
 from PIL import Image
@@ -21,11 +22,9 @@ LINKS_DIR = utils.get_links_dir()
 BLENDER_ROOT_FOLDER = op.join(LINKS_DIR, 'mmvt')
 
 # plt.rcParams['animation.ffmpeg_path'] = '/home/npeled/code/links/ffmpeg/ffmpeg'
-def ani_frame(time_range, xticks, images, dpi, fps, video_fname, cb_data_type,
-        data_to_show_in_graph, fol, fol2, cb_title='', cb_min_max_eq=True, cb_norm_percs=None, color_map='jet',
-        cb2_data_type='', cb2_title='', cb2_min_max_eq=True, color_map2='jet', bitrate=5000, images2=(),
-        ylim=(), ylabels=(), xticklabels=(), xlabel='Time (ms)', show_first_pic=False,
-        show_animation=False, overwrite=True):
+def init_movie_figure(time_range, xticks, images, dpi, cb_data_type, data_to_show_in_graph, fol, fol2,
+        cb_title='', cb_min_max_eq=True, cb_norm_percs=None, color_map='jet', cb2_data_type='', cb2_title='',
+        cb2_min_max_eq=True, color_map2='jet', images2=(), ylim=(), ylabels=(), xticklabels=(), xlabel='Time (ms)'):
 
     def two_brains_two_graphs():
         if cb2_data_type == '':
@@ -132,6 +131,19 @@ def ani_frame(time_range, xticks, images, dpi, fps, video_fname, cb_data_type,
         plot_color_bar(ax_cb2, graph_data2, cb2_title, cb2_data_type, cb2_min_max_eq, cb_norm_percs, color_map2)
     else:
         plot_color_bar(ax_cb, graph_data, cb_title, cb_data_type, cb_min_max_eq, cb_norm_percs, color_map)
+    return fig, im, im2, t_line, ymin, ymax, graph1_ax
+
+
+def ani_frame(time_range, xticks, images, dpi, fps, video_fname, cb_data_type,
+        data_to_show_in_graph, fol, fol2, cb_title='', cb_min_max_eq=True, cb_norm_percs=None, color_map='jet',
+        cb2_data_type='', cb2_title='', cb2_min_max_eq=True, color_map2='jet', bitrate=5000, images2=(),
+        ylim=(), ylabels=(), xticklabels=(), xlabel='Time (ms)', show_first_pic=False,
+        show_animation=False, overwrite=True):
+
+    fig, im, im2, t_line, ymin, ymax, _ = init_movie_figure(
+        time_range, xticks, images, dpi, cb_data_type, data_to_show_in_graph, fol, fol2, cb_title, cb_min_max_eq,
+        cb_norm_percs, color_map, cb2_data_type, cb2_title, cb2_min_max_eq, color_map2, images2, ylim, ylabels,
+        xticklabels, xlabel)
 
     now = time.time()
     if show_first_pic:
@@ -334,8 +346,13 @@ def create_movie(time_range, xticks, fol, dpi, fps, video_fname, cb_data_type,
                  data_to_show_in_graph, cb_title='', cb_min_max_eq=True, cb_norm_percs=None, color_map='jet',
                  bitrate=5000, fol2='', cb2_data_type='', cb2_title='', cb2_min_max_eq=True, color_map2='jet',
                  ylim=(), ylabels=(), xticklabels=(), xlabel='Time (ms)', pics_type='png', show_first_pic=False,
-                 show_animation=False, overwrite=True, n_jobs=1):
+                 show_animation=False, overwrite=True, n_jobs=1, stream=True, ffmpeg_cmd=''):
 
+    if stream and not show_animation:
+        return create_movie_stream(
+            time_range, xticks, fol, dpi, fps, video_fname, cb_data_type, data_to_show_in_graph, cb_title,
+            cb_min_max_eq, cb_norm_percs, color_map, bitrate, fol2, cb2_data_type, cb2_title, cb2_min_max_eq,
+            color_map2, ylim, ylabels, xticklabels, xlabel, pics_type, show_first_pic, ffmpeg_cmd, n_jobs)
     images1 = get_pics(fol, pics_type)[:len(time_range)]
     images1_chunks = utils.chunks(images1, len(images1) / n_jobs)
     if fol2 != '':
@@ -372,6 +389,105 @@ def _create_movie_parallel(params):
               images2, ylim, ylabels, xticklabels, xlabel, show_first_pic, show_animation, overwrite)
 
 
+def create_movie_stream(time_range, xticks, fol, dpi, fps, video_fname, cb_data_type, data_to_show_in_graph,
+                        cb_title='', cb_min_max_eq=True, cb_norm_percs=None, color_map='jet', bitrate=5000, fol2='',
+                        cb2_data_type='', cb2_title='', cb2_min_max_eq=True, color_map2='jet', ylim=(), ylabels=(),
+                        xticklabels=(), xlabel='Time (ms)', pics_type='png', show_first_pic=False, ffmpeg_cmd='',
+                        n_jobs=1):
+    # The figure (graph, colorbars) is rendered only once. Each frame is composed on a preallocated numpy canvas
+    # by pasting the brain image(s) and drawing the time line, and piped in order into a single ffmpeg process.
+    images1 = get_pics(fol, pics_type)[:len(time_range)]
+    images2 = get_pics(fol2, pics_type)[:len(images1)] if fol2 != '' else []
+    if fol2 != '' and len(images2) != len(images1):
+        raise Exception('fol and fol2 have different number of pictures!')
+    fig, im, im2, t_line, ymin, ymax, graph1_ax = init_movie_figure(
+        time_range, xticks, images1, dpi, cb_data_type, data_to_show_in_graph, fol, fol2, cb_title, cb_min_max_eq,
+        cb_norm_percs, color_map, cb2_data_type, cb2_title, cb2_min_max_eq, color_map2, images2, ylim, ylabels,
+        xticklabels, xlabel)
+    if show_first_pic:
+        plt.show()
+    background, brain_boxes, line_rows, line_color = calc_movie_background(fig, im, im2, t_line, graph1_ax)
+    height, width = background.shape[:2]
+
+    frames_params = []
+    for image_index in range(len(images1)):
+        current_t = get_t(images1, image_index, time_range)
+        if current_t is None:
+            continue
+        line_x = int(round(graph1_ax.transData.transform((current_t, ymin))[0]))
+        frames_params.append((images1[image_index], images2[image_index] if fol2 != '' else '', line_x))
+    plt.close(fig)
+
+    movie_fname = op.join(fol, video_fname)
+    n_jobs = utils.get_n_jobs(n_jobs)
+    init_params = (background, brain_boxes, line_rows, line_color)
+    print('Writing {} frames ({}x{}) into {}'.format(len(frames_params), width, height, movie_fname))
+    now = time.time()
+    with mu.FramesWriter(movie_fname, width, height, fps, bitrate, ffmpeg_cmd=ffmpeg_cmd,
+                         images_fol=op.join(fol, 'movie_images')) as writer:
+        if n_jobs > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(n_jobs, _init_movie_frames_composer, init_params)
+            # imap keeps the frames order
+            frames = pool.imap(_compose_movie_frame, frames_params, chunksize=4)
+        else:
+            _init_movie_frames_composer(*init_params)
+            frames = map(_compose_movie_frame, frames_params)
+        for frame_ind, frame in enumerate(frames):
+            utils.time_to_go(now, frame_ind, len(frames_params), runs_num_to_print=50)
+            writer.write(frame)
+        if n_jobs > 1:
+            pool.close()
+            pool.join()
+        return writer.close()
+
+
+def calc_movie_background(fig, im, im2, t_line, graph1_ax):
+    # Renders the figure without the brain images and the time line, and returns the rendered canvas with the
+    # pixels boxes (top, bottom, left, right) of the brain images and the rows of the time line
+    for obj in [im, im2, t_line]:
+        if obj is not None:
+            obj.set_visible(False)
+    fig.canvas.draw()
+    background = np.array(fig.canvas.buffer_rgba())[:, :, :3]
+    height = background.shape[0]
+
+    def ax_box(ax):
+        x0, y0, x1, y1 = np.round(ax.get_window_extent().extents).astype(int)
+        return max(0, height - y1), min(height, height - y0), max(0, x0), min(background.shape[1], x1)
+
+    brain_boxes = [ax_box(obj.axes) for obj in [im, im2] if obj is not None]
+    graph_top, graph_bottom, _, _ = ax_box(graph1_ax)
+    line_color = np.array(mpl_colors.to_rgb(t_line.get_color())) * 255 if t_line is not None else None
+    line_rows = (graph_top, graph_bottom) if t_line is not None else None
+    return background, brain_boxes, line_rows, line_color
+
+
+def _init_movie_frames_composer(background, brain_boxes, line_rows, line_color):
+    global _frames_composer
+    _frames_composer = utils.Bag(dict(
+        background=background, canvas=np.empty_like(background), brain_boxes=brain_boxes, line_rows=line_rows,
+        line_color=np.array(line_color, dtype=np.uint8) if line_color is not None else None))
+
+
+def _compose_movie_frame(params):
+    image1_fname, image2_fname, line_x = params
+    fc = _frames_composer
+    canvas = fc.canvas
+    canvas[:] = fc.background
+    for image_fname, (top, bottom, left, right) in zip([image1_fname, image2_fname], fc.brain_boxes):
+        image = Image.open(image_fname)
+        if image.mode != 'RGB':
+            # Put transparent images on a white background, like the figure's face color
+            image = image.convert('RGBA')
+            white_image = Image.new('RGBA', image.size, (255, 255, 255, 255))
+            image = Image.alpha_composite(white_image, image).convert('RGB')
+        canvas[top:bottom, left:right] = np.asarray(image.resize((right - left, bottom - top), Image.BILINEAR))
+    if fc.line_rows is not None and 0 <= line_x < canvas.shape[1]:
+        canvas[fc.line_rows[0]:fc.line_rows[1], max(0, line_x - 1):line_x + 1] = fc.line_color
+    return canvas.tobytes()
+
+
 def sort_pics_key(pic_fname):
     pic_name = utils.namebase(pic_fname)
     if '_t' in pic_name:
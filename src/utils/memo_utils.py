@@ -0,0 +1,346 @@
+import os
+import os.path as op
+import glob
+import json
+import time
+import shutil
+import hashlib
+import inspect
+import functools
+import traceback
+
+from src.utils import utils
+
+# Content-addressed memoization of the preprocessing steps.
+# A step's key is the hash of its name, its relevant arguments, and the fingerprints (size and mtime, or md5) of its
+# input files. After a successful run, the step's outputs are copied into MMVT_DIR/subject/memo/store/{key} with a
+# small manifest, and the key is marked as the step's current key in MMVT_DIR/subject/memo/index.json. The index is
+# keyed by the step and its outputs, so a step's runs with different outputs (another atlas, task or bipolar flag)
+# don't replace each other's current key.
+# The step is skipped if its current key wasn't changed and its outputs weren't touched, its outputs are restored
+# from the store if the key was already calculated, and it's recalculated (with its overwrite flags set) otherwise.
+
+LINKS_DIR = utils.get_links_dir()
+MMVT_DIR = op.join(LINKS_DIR, 'mmvt')
+MEMO_FOL_NAME = 'memo'
+INDEX_NAME = 'index.json'
+MANIFEST_NAME = 'manifest.json'
+IGNORE_ARGS = ('n_jobs', 'print_traceback', 'do_plot', 'verbose')
+
+_enabled = os.environ.get('MMVT_MEMO', '1') not in ('0', 'false', 'False')
+
+
+def set_enabled(val=True):
+    global _enabled
+    _enabled = bool(val)
+
+
+def is_enabled():
+    return _enabled
+
+
+def get_memo_fol(subject, mmvt_dir=''):
+    return op.join(MMVT_DIR if mmvt_dir == '' else mmvt_dir, subject, MEMO_FOL_NAME)
+
+
+def expand_fnames(fnames):
+    # Expands the {hemi} templates and the wildcards. Missing files are kept, so they are part of the fingerprint
+    ret = []
+    for fname in fnames if not isinstance(fnames, str) else [fnames]:
+        if fname is None or fname == '':
+            continue
+        hemis_fnames = [fname.format(hemi=hemi) for hemi in utils.HEMIS] if '{hemi}' in fname else [fname]
+        for hemi_fname in hemis_fnames:
+            if '*' in hemi_fname or '?' in hemi_fname:
+                ret.extend(sorted(glob.glob(hemi_fname)))
+            else:
+                ret.append(hemi_fname)
+    return sorted(set(ret))
+
+
+def calc_md5(fname, chunk_size=2 ** 20):
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def fingerprint(fname, content_hash=False):
+    if op.isdir(fname):
+        return [fingerprint(op.join(fname, f), content_hash) for f in sorted(os.listdir(fname))]
+    if not op.isfile(fname):
+        return None
+    if content_hash:
+        return calc_md5(fname)
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def files_fingerprints(fnames, content_hash=False):
+    return {fname: fingerprint(fname, content_hash) for fname in expand_fnames(fnames)}
+
+
+def calc_index_key(func_id, outputs_fnames):
+    # The step and its resolved outputs (the templates, before expanding the wildcards, which depend on the disk)
+    outputs_fnames = [outputs_fnames] if isinstance(outputs_fnames, str) else outputs_fnames
+    outputs_desc = json.dumps(sorted([fname for fname in outputs_fnames if fname]))
+    return '{}:{}'.format(func_id, hashlib.sha1(outputs_desc.encode('utf-8')).hexdigest()[:12])
+
+
+def calc_key(func_id, args, inputs_fingerprints, version=1):
+    desc = json.dumps(dict(func=func_id, args=args, inputs=inputs_fingerprints, version=version),
+                      sort_keys=True, default=repr)
+    return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+
+def load_json(fname, default=None):
+    if not op.isfile(fname):
+        return default
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except:
+        print('Can\'t read {}!'.format(fname))
+        return default
+
+
+def save_json(obj, fname):
+    utils.make_dir(op.dirname(fname))
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(obj, f, indent=1, sort_keys=True, default=repr)
+    os.replace(tmp_fname, fname)
+
+
+def load_index(memo_fol):
+    return load_json(op.join(memo_fol, INDEX_NAME), {})
+
+
+def save_index(memo_fol, index):
+    save_json(index, op.join(memo_fol, INDEX_NAME))
+
+
+def get_entry_fol(memo_fol, key):
+    return op.join(memo_fol, 'store', key)
+
+
+def load_entry(memo_fol, key):
+    return load_json(op.join(get_entry_fol(memo_fol, key), MANIFEST_NAME), None)
+
+
+def outputs_are_intact(entry):
+    return entry is not None and len(entry['outputs']) > 0 and all(
+        [fingerprint(fname) == fp for fname, fp in entry['outputs'].items()])
+
+
+def inputs_are_unchanged(entry):
+    return all([fingerprint(fname, entry.get('content_hash', False)) == fp for fname, fp in entry['inputs'].items()])
+
+
+def store_entry(memo_fol, key, entry, store_outputs=True):
+    entry_fol = get_entry_fol(memo_fol, key)
+    if op.isdir(entry_fol):
+        shutil.rmtree(entry_fol)
+    utils.make_dir(entry_fol)
+    entry['stored_files'] = {}
+    if store_outputs:
+        files_fol = utils.make_dir(op.join(entry_fol, 'files'))
+        for ind, fname in enumerate(sorted(entry['outputs'].keys())):
+            if not op.isfile(fname):
+                continue
+            stored_fname = op.join(files_fol, '{}_{}'.format(ind, op.basename(fname)))
+            shutil.copy2(fname, stored_fname)
+            entry['stored_files'][fname] = stored_fname
+    save_json(entry, op.join(entry_fol, MANIFEST_NAME))
+
+
+def restore_entry(entry):
+    # Copies the stored outputs back to their places. Returns False if the entry's outputs weren't stored
+    if entry is None or set(entry.get('stored_files', {}).keys()) != set(entry['outputs'].keys()):
+        return False
+    for fname, stored_fname in entry['stored_files'].items():
+        if not op.isfile(stored_fname):
+            return False
+    for fname, stored_fname in entry['stored_files'].items():
+        utils.make_dir(op.dirname(fname))
+        shutil.copy2(stored_fname, fname)
+    return True
+
+
+def decode_ret(entry):
+    ret = entry.get('ret', True)
+    return tuple(ret) if entry.get('ret_is_tuple', False) else ret
+
+
+def ret_is_ok(ret):
+    if isinstance(ret, tuple):
+        return len(ret) > 0 and bool(ret[0])
+    try:
+        return bool(ret)
+    except:
+        return False
+
+
+def is_json_serializable(obj):
+    try:
+        json.dumps(obj)
+        return True
+    except:
+        return False
+
+
+def memoize(inputs=None, outputs=None, ignore_args=(), subject_arg='subject', content_hash=False,
+            store_outputs=True, version=1):
+    '''
+    :param inputs: func(**arguments) -> the step's input files (templates with {hemi} and wildcards are allowed)
+    :param outputs: func(**arguments) -> the step's output files
+    :param ignore_args: arguments that don't change the outputs (the overwrite flags and n_jobs are always ignored)
+    :param subject_arg: the argument with the subject name (the memo folder is MMVT_DIR/subject/memo)
+    :param content_hash: fingerprint the inputs by their md5 instead of their size and mtime
+    :param store_outputs: keep a copy of the outputs per key, so going back to former inputs/arguments is free
+    :param version: bump it when the step's code changes its outputs
+    '''
+    def real_memoize(func):
+        sig = inspect.signature(func)
+        func_id = '{}.{}'.format(utils.namebase(inspect.getfile(func)), func.__name__)
+        overwrite_args = [name for name in sig.parameters.keys() if name.startswith('overwrite')]
+        ignore = set(IGNORE_ARGS) | set(ignore_args) | set(overwrite_args)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            try:
+                bound = sig.bind(*args, **kwargs)
+                bound.apply_defaults()
+                arguments = dict(bound.arguments)
+                subject = arguments.get(subject_arg, '')
+                if not isinstance(subject, str) or subject == '':
+                    return func(*args, **kwargs)
+                memo_fol = get_memo_fol(subject)
+                inputs_fingerprints = files_fingerprints(inputs(**arguments) if inputs else [], content_hash)
+                relevant_args = {k: v for k, v in arguments.items() if k not in ignore}
+                key = calc_key(func_id, relevant_args, inputs_fingerprints, version)
+                outputs_templates = outputs(**arguments) if outputs else []
+                index_key = calc_index_key(func_id, outputs_templates)
+                overwrite = any([bool(arguments[name]) for name in overwrite_args])
+                index = load_index(memo_fol)
+                if not overwrite:
+                    entry = load_entry(memo_fol, key)
+                    if index.get(index_key, '') == key and outputs_are_intact(entry):
+                        print('{}: up to date ({})'.format(func_id, key[:8]))
+                        return decode_ret(entry)
+                    if entry is not None and restore_entry(entry):
+                        entry['outputs'] = {fname: fingerprint(fname) for fname in entry['outputs'].keys()}
+                        save_json(entry, op.join(get_entry_fol(memo_fol, key), MANIFEST_NAME))
+                        index[index_key] = key
+                        save_index(memo_fol, index)
+                        print('{}: restored the outputs from the memo store ({})'.format(func_id, key[:8]))
+                        return decode_ret(entry)
+                    if index_key in index:
+                        # Something upstream of the same outputs was changed, the outputs are recalculated
+                        print('{}: the inputs or the arguments were changed, recalculating'.format(func_id))
+                        bound.arguments.update({name: True for name in overwrite_args})
+                        if len(overwrite_args) == 0:
+                            remove_outputs(outputs_templates)
+            except:
+                print('memoize: Can\'t calculate the {} key, running without memoization'.format(func.__name__))
+                print(traceback.format_exc())
+                return func(*args, **kwargs)
+
+            ret = func(*bound.args, **bound.kwargs)
+            if ret_is_ok(ret):
+                try:
+                    outputs_fnames = expand_fnames(outputs_templates)
+                    entry = dict(
+                        func=func_id, key=key, index_key=index_key, args=relevant_args, inputs=inputs_fingerprints,
+                        outputs={fname: fingerprint(fname) for fname in outputs_fnames if op.isfile(fname)},
+                        content_hash=content_hash, time=time.time(),
+                        ret=ret if is_json_serializable(ret) else True, ret_is_tuple=isinstance(ret, tuple))
+                    store_entry(memo_fol, key, entry, store_outputs)
+                    index = load_index(memo_fol)
+                    index[index_key] = key
+                    save_index(memo_fol, index)
+                except:
+                    print('memoize: Can\'t save the {} entry'.format(func.__name__))
+                    print(traceback.format_exc())
+            return ret
+        return wrapper
+    return real_memoize
+
+
+def remove_outputs(outputs):
+    for fname in expand_fnames(outputs):
+        if op.isfile(fname):
+            os.remove(fname)
+
+
+def list_entries(subject, print_entries=True):
+    # Returns all the stored entries, each with a "current" flag (the step's outputs current key) and a "stale" flag
+    # (not current, or its inputs or outputs were changed since it was calculated)
+    memo_fol = get_memo_fol(subject)
+    index = load_index(memo_fol)
+    entries = []
+    for entry_fol in glob.glob(op.join(memo_fol, 'store', '*')):
+        entry = load_entry(memo_fol, op.basename(entry_fol))
+        if entry is None:
+            entry = dict(func='', key=op.basename(entry_fol), time=0, inputs={}, outputs={})
+        entry['current'] = index.get(entry.get('index_key', entry['func']), '') == entry['key']
+        entry['stale'] = not entry['current'] or not inputs_are_unchanged(entry) or not outputs_are_intact(entry)
+        entry['size'] = sum([op.getsize(f) for f in glob.glob(op.join(entry_fol, 'files', '*'))])
+        entries.append(entry)
+    entries = sorted(entries, key=lambda e: (e['func'], -e['time']))
+    if print_entries:
+        for entry in entries:
+            print('{} {} {} {:.1f}MB {}{}'.format(
+                entry['func'], entry['key'][:8], time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['time'])),
+                entry['size'] / 2 ** 20, 'current' if entry['current'] else '', ' stale' if entry['stale'] else ''))
+    return entries
+
+
+def prune(subject, only_stale=True, older_than_days=0, funcs=()):
+    # Removes the stored entries (never the outputs themselves). The current entries are removed only if they are
+    # stale and only_stale is False
+    memo_fol = get_memo_fol(subject)
+    index = load_index(memo_fol)
+    removed_num, freed = 0, 0
+    for entry in list_entries(subject, False):
+        if len(funcs) > 0 and entry['func'] not in funcs:
+            continue
+        if (only_stale and not entry['stale']) or (not only_stale and entry['current'] and not entry['stale']):
+            continue
+        if older_than_days > 0 and time.time() - entry['time'] < older_than_days * 24 * 60 * 60:
+            continue
+        shutil.rmtree(get_entry_fol(memo_fol, entry['key']), ignore_errors=True)
+        if entry['current']:
+            index.pop(entry.get('index_key', entry['func']), None)
+        removed_num += 1
+        freed += entry['size']
+    save_index(memo_fol, index)
+    print('{}: {} memo entries were removed ({:.1f}MB)'.format(subject, removed_num, freed / 2 ** 20))
+    return removed_num
+
+
+def main(args):
+    for subject in args.subject:
+        if 'list' in args.function:
+            list_entries(subject)
+        if 'prune' in args.function:
+            prune(subject, args.only_stale, args.older_than, args.funcs)
+
+
+def read_cmd_args(argv=None):
+    import argparse
+    from src.utils import args_utils as au
+    parser = argparse.ArgumentParser(description='MMVT preprocessing memoization')
+    parser.add_argument('-s', '--subject', help='subject name', required=True, type=au.str_arr_type)
+    parser.add_argument('-f', '--function', help='list/prune', required=False, default='list', type=au.str_arr_type)
+    parser.add_argument('--only_stale', required=False, default=1, type=au.is_true)
+    parser.add_argument('--older_than', help='days', required=False, default=0, type=float)
+    parser.add_argument('--funcs', help='steps to prune', required=False, default='', type=au.str_arr_type)
+    return utils.Bag(au.parse_parser(parser, argv))
+
+
+if __name__ == '__main__':
+    main(read_cmd_args())
@@ -226,6 +226,81 @@ def combine_images(fol, movie_name, frame_rate=10, start_number=-1, images_prefi
     return '{}.mp4'.format(movie_name)
 
 
+def get_ffmpeg_cmd(ffmpeg_cmd=''):
+    return FFMPEG_CMD if ffmpeg_cmd == '' else ffmpeg_cmd
+
+
+def ffmpeg_exists(ffmpeg_cmd=''):
+    import shutil
+    ffmpeg_cmd = get_ffmpeg_cmd(ffmpeg_cmd)
+    return op.isfile(ffmpeg_cmd) or shutil.which(ffmpeg_cmd) is not None
+
+
+class FramesWriter(object):
+    # Pipes raw rgb24 frames into a single ffmpeg process over stdin, so no intermediate images or movie parts are
+    # written. If ffmpeg can't be found, the frames are saved as an images sequence (mv_00000.png, ...) instead.
+    def __init__(self, movie_fname, width, height, fps=10, bitrate=5000, codec='libx264', ffmpeg_cmd='',
+                 images_fol='', debug=False):
+        self.movie_fname = movie_fname
+        self.width, self.height = width, height
+        self.frames_num = 0
+        self.proc = None
+        ffmpeg_cmd = get_ffmpeg_cmd(ffmpeg_cmd)
+        if ffmpeg_exists(ffmpeg_cmd):
+            import subprocess
+            cmd = [ffmpeg_cmd, '-y', '-f', 'rawvideo', '-vcodec', 'rawvideo', '-pix_fmt', 'rgb24',
+                   '-s', '{}x{}'.format(width, height), '-r', str(fps), '-i', '-', '-an',
+                   # http://stackoverflow.com/questions/20847674/ffmpeg-libx264-height-not-divisible-by-2
+                   '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', '-c:v', codec, '-b:v', '{}k'.format(bitrate),
+                   '-pix_fmt', 'yuv420p', movie_fname]
+            if debug:
+                cmd += ['-loglevel', 'debug']
+            print(' '.join(cmd))
+            self.proc = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=None if debug else subprocess.DEVNULL)
+            self.images_fol = ''
+        else:
+            self.images_fol = images_fol if images_fol != '' else op.splitext(movie_fname)[0]
+            utils.make_dir(self.images_fol)
+            print("Can't find ffmpeg ({}), saving the frames in {}".format(ffmpeg_cmd, self.images_fol))
+
+    def write(self, frame):
+        # frame: a (height x width x 3) uint8 array, or its raw bytes
+        if self.proc is not None:
+            self.proc.stdin.write(frame if isinstance(frame, bytes) else frame.tobytes())
+        else:
+            import numpy as np
+            from PIL import Image
+            if isinstance(frame, bytes):
+                frame = np.frombuffer(frame, dtype=np.uint8).reshape((self.height, self.width, 3))
+            Image.fromarray(frame).save(op.join(self.images_fol, 'mv_{:0>5}.png'.format(self.frames_num)))
+        self.frames_num += 1
+
+    def close(self):
+        if self.proc is None:
+            return self.images_fol
+        self.proc.stdin.close()
+        ret_code = self.proc.wait()
+        self.proc = None
+        if ret_code != 0:
+            print('ffmpeg failed with return code {}! Call again with debug=True'.format(ret_code))
+        return self.movie_fname
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def write_frames_to_movie(frames, movie_fname, width, height, fps=10, bitrate=5000, codec='libx264', ffmpeg_cmd='',
+                          images_fol='', debug=False):
+    with FramesWriter(movie_fname, width, height, fps, bitrate, codec, ffmpeg_cmd, images_fol, debug) as writer:
+        for frame in frames:
+            writer.write(frame)
+        return writer.close()
+
+
 def add_reverse_frames_fol(fol, images_prefix, images_type):
     images = sorted(glob.glob(op.join(fol, '*.{}'.format(images_type))), key=utils.natural_keys)
     last_frame = int(utils.find_num_in_str(utils.namebase(images[-1]))[0])
@@ -11,6 +11,8 @@ import warnings
 
 from src.utils import utils
 from src.utils import args_utils as au
+from src.utils import memo_utils as memo
+from src.utils import telemetry_utils as telemetry
 
 
 LINKS_DIR = utils.get_links_dir()
@@ -49,6 +51,11 @@ def init_args(args):
             if args.sftp else ''
     set_default_args(args)
     args.atlas = utils.get_real_atlas_name(args.atlas)
+    memo.set_enabled(args.memoize if 'memoize' in args else True)
+    telemetry.set_enabled(args.telemetry if 'telemetry' in args else True)
+    utils.read_storage_precision_policy(MMVT_DIR)
+    if 'storage_precision' in args and args.storage_precision != '':
+        utils.set_storage_precision_policy(args.storage_precision)
     os.environ['SUBJECTS_DIR'] = SUBJECTS_DIR
     return args
 
@@ -72,6 +79,8 @@ def run_on_subjects(args, main_func, subjects_itr=None, subject_func=None):
         print('****************************************************************')
         os.environ['SUBJECT'] = subject
         flags = dict()
+        telemetry.start_run(subject, telemetry.get_module_name(main_func), telemetry.get_log_fname(subject, MMVT_DIR),
+                            args.function)
         try:
             args.atlas = utils.fix_atlas_name(subject, args.atlas, SUBJECTS_DIR)
             print('Setting the atlas to: {}'.format(args.atlas))
@@ -79,19 +88,24 @@ def run_on_subjects(args, main_func, subjects_itr=None, subject_func=None):
             # I think we always want to run this
             # *) Prepare the local subject's folder
             if not 'recon_all' in args.function:
+                telemetry.start_stage('prepare_subject_folder')
                 flags['prepare_subject_folder'], password = prepare_subject_folder(
                     subject, remote_subject_dir, args)
+                telemetry.end_stage()
                 if not flags['prepare_subject_folder'] and not args.ignore_missing:
                     ans = input('Do you wish to continue (y/n)? ')
                     if not au.is_true(ans):
+                        telemetry.end_run(flags)
                         continue
             flags['prepare_subject_folder'] = True
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
                 flags = main_func(tup, remote_subject_dir, args, flags)
                 subjects_flags[subject] = flags
+            telemetry.end_run(flags)
         except:
             subjects_errors[subject] = traceback.format_exc()
+            telemetry.end_run(flags, subjects_errors[subject])
             print('Error in subject {}'.format(subject))
             print(traceback.format_exc())
 
@@ -198,6 +212,12 @@ def add_common_args(parser):
     parser.add_argument('--sftp_port', help='sftp port', required=False, default=22, type=int)
     parser.add_argument('--sftp_password', help='sftp port', required=False, default='')
     parser.add_argument('--print_traceback', help='print_traceback', required=False, default=1, type=au.is_true)
+    parser.add_argument('--storage_precision', help='modality=dtype,... (float64/float32/float16/int16)',
+                        required=False, default='')
+    parser.add_argument('--memoize', help='skip the steps whose inputs and arguments were not changed',
+                        required=False, default=1, type=au.is_true)
+    parser.add_argument('--telemetry', help='log the steps times and resources to MMVT_DIR/subject/logs',
+                        required=False, default=1, type=au.is_true)
 
     # global folders
     parser.add_argument('--meg_dir', required=False, default='')
@@ -0,0 +1,129 @@
+import os.path as op
+import glob
+import numpy as np
+
+from src.utils import utils
+from src.mmvt_addon import mmvt_utils as mu
+
+# The storage precision validation tool:
+# report - the max errors that were recorded when the reduced precision outputs were saved
+# simulate - the max errors each storage dtype would introduce for the existing (float64/float32) outputs
+
+LINKS_DIR = utils.get_links_dir()
+MMVT_DIR = op.join(LINKS_DIR, 'mmvt')
+SIMULATE_PATTERNS = [
+    op.join('**', '*_store', 'frames.npy'), op.join('connectivity', '*.npy'), op.join('meg', 'labels_data_*.npz'),
+    op.join('fmri', 'labels_data_*.npz'), op.join('connectivity', '*.npz')]
+
+
+def find_precision_infos(subject):
+    subject_fol = op.join(MMVT_DIR, subject)
+    return sorted(set(glob.glob(op.join(subject_fol, '**', '*{}'.format(mu.PRECISION_INFO_NAME)), recursive=True)))
+
+
+def get_output_fname(info_fname):
+    # store_fol/precision.json -> store_fol, fname.npy.precision.json -> fname.npy
+    if op.basename(info_fname) == mu.PRECISION_INFO_NAME:
+        return op.dirname(info_fname)
+    return info_fname[:-len(mu.PRECISION_INFO_NAME) - 1]
+
+
+def report(subject, max_rel_err=1e-2, print_report=True):
+    rows, bad = [], []
+    subject_fol = op.join(MMVT_DIR, subject)
+    for info_fname in find_precision_infos(subject):
+        info = mu.load_precision_info(info_fname)
+        if info is None:
+            continue
+        row = dict(fname=op.relpath(get_output_fname(info_fname), subject_fol), **info)
+        rows.append(row)
+        if row['max_rel_err'] > max_rel_err:
+            bad.append(row)
+    if print_report:
+        print_rows(rows, 'Reduced precision outputs of {}'.format(subject))
+        if len(bad) > 0:
+            print('{} outputs have a relative error above {}!'.format(len(bad), max_rel_err))
+    return rows, bad
+
+
+def calc_dtype_error(data, dtype, chunk_size=mu.ACTIVITY_STORE_CHUNK_SIZE):
+    errors = mu.PrecisionErrors()
+    quant = None
+    if dtype in mu.QUANTIZED_DTYPES:
+        data_min, data_max = np.inf, -np.inf
+        for from_ind in range(0, len(data), chunk_size):
+            chunk = np.asarray(data[from_ind:from_ind + chunk_size], dtype=np.float64)
+            if np.any(np.isfinite(chunk)):
+                data_min, data_max = min(data_min, np.nanmin(chunk)), max(data_max, np.nanmax(chunk))
+        quant = mu.calc_quantization(data_min, data_max)
+    for from_ind in range(0, len(data), chunk_size):
+        chunk = np.asarray(data[from_ind:from_ind + chunk_size])
+        errors.update(chunk, mu.encode_storage_data(chunk, dtype, quant), quant)
+    return errors
+
+
+def load_float_arrays(fname):
+    if fname.endswith('.npy'):
+        arr = np.load(fname, mmap_mode='r')
+        return {'': arr} if np.issubdtype(arr.dtype, np.floating) and arr.ndim > 0 else {}
+    with np.load(fname) as d:
+        return {key: d[key] for key in d.files if np.issubdtype(d[key].dtype, np.floating) and d[key].size > 1}
+
+
+def simulate(subject, dtypes=('float32', 'float16', 'int16'), patterns=None, print_report=True):
+    subject_fol = op.join(MMVT_DIR, subject)
+    patterns = SIMULATE_PATTERNS if patterns is None else patterns
+    fnames = sorted(set(sum([glob.glob(op.join(subject_fol, p), recursive=True) for p in patterns], [])))
+    rows = []
+    for fname in fnames:
+        try:
+            arrays = load_float_arrays(fname)
+        except:
+            print('Can\'t read {}'.format(fname))
+            continue
+        for key, arr in arrays.items():
+            if arr.dtype.itemsize <= 2:
+                continue
+            for dtype in dtypes:
+                if np.dtype(dtype).itemsize >= arr.dtype.itemsize:
+                    continue
+                errors = calc_dtype_error(arr, dtype)
+                rows.append(dict(
+                    fname='{}{}'.format(op.relpath(fname, subject_fol), ':{}'.format(key) if key != '' else ''),
+                    dtype=dtype, source_dtype=str(arr.dtype), max_abs_err=errors.max_abs_err,
+                    max_rel_err=errors.max_rel_err, saved_mb=arr.nbytes * (1 - np.dtype(dtype).itemsize /
+                                                                           arr.dtype.itemsize) / 2 ** 20))
+    if print_report:
+        print_rows(rows, 'Simulated storage precision errors of {}'.format(subject))
+    return rows
+
+
+def print_rows(rows, title):
+    print(title)
+    for row in rows:
+        print('{fname}: {source_dtype} -> {dtype}, max abs err {max_abs_err:.3g}, max rel err {max_rel_err:.3g}{saved}'.
+              format(saved=', saves {:.1f}MB'.format(row['saved_mb']) if 'saved_mb' in row else '', **row))
+
+
+def main(args):
+    for subject in args.subject:
+        if 'report' in args.function:
+            report(subject, args.max_rel_err)
+        if 'simulate' in args.function:
+            simulate(subject, args.dtypes)
+
+
+def read_cmd_args(argv=None):
+    import argparse
+    from src.utils import args_utils as au
+    parser = argparse.ArgumentParser(description='MMVT storage precision validation')
+    parser.add_argument('-s', '--subject', help='subject name', required=True, type=au.str_arr_type)
+    parser.add_argument('-f', '--function', help='report/simulate', required=False, default='report',
+                        type=au.str_arr_type)
+    parser.add_argument('--dtypes', required=False, default='float32,float16,int16', type=au.str_arr_type)
+    parser.add_argument('--max_rel_err', required=False, default=1e-2, type=float)
+    return utils.Bag(au.parse_parser(parser, argv))
+
+
+if __name__ == '__main__':
+    main(read_cmd_args())
@@ -0,0 +1,299 @@
+import os
+import os.path as op
+import sys
+import time
+import json
+import uuid
+import socket
+import contextlib
+import statistics
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Per stage telemetry of the preprocessing runs.
+# run_on_subjects starts a run for every subject, and every utils.should_run call ends the current stage and,
+# if the step should run, starts a new one (a step's code runs between its should_run and the next should_run).
+# For every stage, the wall and cpu (including child processes) times, the peak RSS, the process's read and written
+# bytes and the exception (if any) are appended as a json line to MMVT_DIR/subject/logs/telemetry.jsonl.
+# This module doesn't import utils, which calls it from should_run.
+
+LOG_NAME = 'telemetry.jsonl'
+
+_enabled = os.environ.get('MMVT_TELEMETRY', '1') not in ('0', 'false', 'False')
+_runs = []
+
+
+def set_enabled(val=True):
+    global _enabled
+    _enabled = bool(val)
+
+
+def is_enabled():
+    return _enabled
+
+
+def get_log_fname(subject, mmvt_dir):
+    return op.join(mmvt_dir, subject, 'logs', LOG_NAME)
+
+
+def get_module_name(func):
+    return getattr(func, '__module__', '').split('.')[-1]
+
+
+def read_io_bytes():
+    # The process's storage layer read and written bytes (linux only)
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(':') for line in f.read().splitlines() if ':' in line)
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except:
+        return None, None
+
+
+def read_peak_rss_mb():
+    # The process's peak RSS so far (ru_maxrss is in KB on linux and in bytes on mac)
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+def take_snapshot():
+    times = os.times()
+    read_bytes, write_bytes = read_io_bytes()
+    return dict(wall=time.time(), perf=time.perf_counter(), cpu=times[0] + times[1],
+                children_cpu=times[2] + times[3], peak_rss_mb=read_peak_rss_mb(), read_bytes=read_bytes,
+                write_bytes=write_bytes)
+
+
+def diff_or_none(end, start):
+    return end - start if end is not None and start is not None else None
+
+
+def write_event(run, event):
+    event.update(dict(run_id=run['run_id'], subject=run['subject'], module=run['module'], host=run['host'],
+                      pid=os.getpid()))
+    try:
+        os.makedirs(op.dirname(run['log_fname']), exist_ok=True)
+        with open(run['log_fname'], 'a') as f:
+            f.write(json.dumps(event, default=str) + '\n')
+    except:
+        print('telemetry: Can\'t write to {}'.format(run['log_fname']))
+
+
+def start_run(subject, module, log_fname, functions=None):
+    if not _enabled:
+        return
+    run = dict(subject=subject, module=module, log_fname=log_fname, run_id=uuid.uuid4().hex[:12],
+               host=socket.gethostname(), stage=None, start=take_snapshot())
+    _runs.append(run)
+    write_event(run, dict(event='run_start', start=run['start']['wall'], functions=functions))
+
+
+def end_run(flags=None, error=None):
+    if not _enabled or len(_runs) == 0:
+        return
+    end_stage(error)
+    run = _runs.pop()
+    end = take_snapshot()
+    write_event(run, dict(
+        event='run_end', start=run['start']['wall'], end=end['wall'], wall_time=end['perf'] - run['start']['perf'],
+        cpu_time=end['cpu'] + end['children_cpu'] - run['start']['cpu'] - run['start']['children_cpu'],
+        peak_rss_mb=end['peak_rss_mb'], error=error,
+        flags={k: bool(v) if isinstance(v, (bool, int)) or v is None else str(v)
+               for k, v in (flags.items() if isinstance(flags, dict) else [])}))
+
+
+def start_stage(stage_name):
+    if not _enabled or len(_runs) == 0:
+        return
+    # Re-checks of the current step (like should_run(args, 'calc_epochs') and not flags['calc_epochs']) continue it
+    if _runs[-1]['stage'] is not None and _runs[-1]['stage']['name'] == stage_name:
+        return
+    end_stage()
+    _runs[-1]['stage'] = dict(name=stage_name, start=take_snapshot())
+
+
+def end_stage(error=None):
+    if not _enabled or len(_runs) == 0 or _runs[-1]['stage'] is None:
+        return
+    run = _runs[-1]
+    stage, run['stage'] = run['stage'], None
+    start, end = stage['start'], take_snapshot()
+    write_event(run, dict(
+        event='stage', stage=stage['name'], start=start['wall'], end=end['wall'], wall_time=end['perf'] - start['perf'],
+        cpu_time=end['cpu'] - start['cpu'], children_cpu_time=end['children_cpu'] - start['children_cpu'],
+        peak_rss_mb=end['peak_rss_mb'], peak_rss_growth_mb=diff_or_none(end['peak_rss_mb'], start['peak_rss_mb']),
+        read_bytes=diff_or_none(end['read_bytes'], start['read_bytes']),
+        write_bytes=diff_or_none(end['write_bytes'], start['write_bytes']), error=error))
+
+
+def on_should_run(func_name, should_run):
+    # Called by utils.should_run
+    if not _enabled or len(_runs) == 0:
+        return
+    if should_run:
+        start_stage(func_name)
+    else:
+        end_stage()
+
+
+@contextlib.contextmanager
+def stage(stage_name):
+    # For steps which aren't called through should_run
+    start_stage(stage_name)
+    try:
+        yield
+    except:
+        import traceback
+        end_stage(traceback.format_exc())
+        raise
+    end_stage()
+
+
+def read_events(log_fname):
+    events = []
+    if not op.isfile(log_fname):
+        return events
+    with open(log_fname, 'r') as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # A partial line of a killed run
+                continue
+    return events
+
+
+def merge_stage_events(event, other):
+    # A stage which ran a few times in the same run (its should_run was called again after other steps)
+    merged = dict(event)
+    for field in ['wall_time', 'cpu_time', 'children_cpu_time', 'read_bytes', 'write_bytes', 'peak_rss_growth_mb']:
+        vals = [e.get(field) for e in [event, other] if e.get(field) is not None]
+        merged[field] = sum(vals) if len(vals) > 0 else None
+    peaks = [e.get('peak_rss_mb') for e in [event, other] if e.get('peak_rss_mb') is not None]
+    merged['peak_rss_mb'] = max(peaks) if len(peaks) > 0 else None
+    merged['start'], merged['end'] = min(event['start'], other['start']), max(event['end'], other['end'])
+    merged['error'] = event.get('error') or other.get('error')
+    merged['calls_num'] = event.get('calls_num', 1) + other.get('calls_num', 1)
+    return merged
+
+
+def collect_stages(log_fnames, last_only=True):
+    # {(module, stage): {subject (or (subject, run_id)): stage event}}. The same stage's events of a run are merged,
+    # and if last_only, only the last run of every subject's stage is kept
+    runs_stages = defaultdict(dict)
+    for log_fname in log_fnames:
+        for event in read_events(log_fname):
+            if event.get('event') != 'stage':
+                continue
+            key, run_key = (event['module'], event['stage']), (event['subject'], event['run_id'])
+            runs_stages[key][run_key] = merge_stage_events(runs_stages[key][run_key], event) \
+                if run_key in runs_stages[key] else event
+    if not last_only:
+        return runs_stages
+    stages = defaultdict(dict)
+    for key, runs_events in runs_stages.items():
+        for (subject, _), event in runs_events.items():
+            if subject not in stages[key] or stages[key][subject]['start'] <= event['start']:
+                stages[key][subject] = event
+    return stages
+
+
+def calc_outliers(events, min_wall_time=1, z_threshold=3.5):
+    # The events which are slow according to the robust z-score (median and MAD) of their stage's wall times
+    wall_times = [e['wall_time'] for e in events]
+    if len(wall_times) < 3:
+        return []
+    median = statistics.median(wall_times)
+    mad = statistics.median([abs(t - median) for t in wall_times])
+    outliers = []
+    for event in events:
+        if event['wall_time'] < min_wall_time:
+            continue
+        z = 0.6745 * (event['wall_time'] - median) / mad if mad > 0 else \
+            (float('inf') if event['wall_time'] > median else 0)
+        if z > z_threshold:
+            outliers.append(dict(event, z=z, median_wall_time=median))
+    return outliers
+
+
+def summarize(log_fnames, last_only=True, z_threshold=3.5, min_wall_time=1):
+    rows, outliers, failures = [], [], []
+    for (module, stage_name), subjects_events in collect_stages(log_fnames, last_only).items():
+        events = list(subjects_events.values())
+        wall_times = [e['wall_time'] for e in events]
+        peak_rss = [e['peak_rss_mb'] for e in events if e.get('peak_rss_mb') is not None]
+        rows.append(dict(
+            module=module, stage=stage_name, runs_num=len(events), total_wall_time=sum(wall_times),
+            median_wall_time=statistics.median(wall_times), max_wall_time=max(wall_times),
+            slowest_subject=max(events, key=lambda e: e['wall_time'])['subject'],
+            total_cpu_time=sum(e['cpu_time'] + e.get('children_cpu_time', 0) for e in events),
+            max_peak_rss_mb=max(peak_rss) if len(peak_rss) > 0 else None,
+            read_mb=sum(e['read_bytes'] or 0 for e in events) / 2 ** 20,
+            write_mb=sum(e['write_bytes'] or 0 for e in events) / 2 ** 20,
+            failures_num=sum(e.get('error') is not None for e in events)))
+        outliers.extend(calc_outliers(events, min_wall_time, z_threshold))
+        failures.extend([e for e in events if e.get('error') is not None])
+    rows = sorted(rows, key=lambda r: r['total_wall_time'], reverse=True)
+    outliers = sorted(outliers, key=lambda e: e['z'], reverse=True)
+    return rows, outliers, failures
+
+
+def print_summary(rows, outliers, failures, top=20):
+    print('Slowest stages:')
+    for row in rows[:top]:
+        print('{module}.{stage}: {runs_num} runs, total {total_wall_time:.1f}s, median {median_wall_time:.1f}s, '
+              'max {max_wall_time:.1f}s ({slowest_subject}), cpu {total_cpu_time:.1f}s, peak rss {rss}, '
+              'read {read_mb:.1f}MB, written {write_mb:.1f}MB{failed}'.format(
+                rss='{:.0f}MB'.format(row['max_peak_rss_mb']) if row['max_peak_rss_mb'] is not None else '-',
+                failed=', {} failed'.format(row['failures_num']) if row['failures_num'] > 0 else '', **row))
+    if len(outliers) > 0:
+        print('Outliers:')
+        for e in outliers[:top]:
+            print('{subject} {module}.{stage}: {wall_time:.1f}s (median {median_wall_time:.1f}s, z={z:.1f})'.format(
+                **e))
+    if len(failures) > 0:
+        print('Failures:')
+        for e in failures:
+            print('{} {}.{}: {}'.format(e['subject'], e['module'], e['stage'], e['error'].strip().split('\n')[-1]))
+
+
+def main(args):
+    import glob
+    from src.utils import utils
+    mmvt_dir = op.join(utils.get_links_dir(), 'mmvt')
+    subjects = args.subject if 'all' not in args.subject else [
+        utils.namebase(utils.get_parent_fol(fname, 2)) for fname in glob.glob(op.join(mmvt_dir, '*', 'logs', LOG_NAME))]
+    rows, outliers, failures = summarize(
+        [get_log_fname(subject, mmvt_dir) for subject in subjects], args.last_only, args.z_threshold,
+        args.min_wall_time)
+    print_summary(rows, outliers, failures, args.top)
+    if args.output_fname != '':
+        with open(args.output_fname, 'w') as f:
+            json.dump(dict(stages=rows, outliers=outliers, failures=failures), f, indent=2, default=str)
+    return rows, outliers, failures
+
+
+def read_cmd_args(argv=None):
+    import argparse
+    from src.utils import utils
+    from src.utils import args_utils as au
+    parser = argparse.ArgumentParser(description='MMVT preprocessing telemetry summary')
+    parser.add_argument('-s', '--subject', help='subjects names (all for all the subjects with telemetry)',
+                        required=False, default='all', type=au.str_arr_type)
+    parser.add_argument('--last_only', help='only the last run of every subject\'s stage', required=False,
+                        default=1, type=au.is_true)
+    parser.add_argument('--z_threshold', required=False, default=3.5, type=float)
+    parser.add_argument('--min_wall_time', help='seconds', required=False, default=1, type=float)
+    parser.add_argument('--top', required=False, default=20, type=int)
+    parser.add_argument('--output_fname', required=False, default='')
+    return utils.Bag(au.parse_parser(parser, argv))
+
+
+if __name__ == '__main__':
+    main(read_cmd_args())
@@ -0,0 +1,156 @@
+import os
+import os.path as op
+import json
+import stat
+import threading
+
+import pytest
+
+from src.utils import fetch_utils as fu
+
+NECESSARY_FILES = {'mri': ['T1.mgz', 'orig.mgz'], 'surf': ['{hemi}.pial'.format(hemi=hemi) for hemi in ['rh', 'lh']],
+                   'label': ['*.aparc.annot']}
+
+
+class SftpAttr(object):
+    def __init__(self, fname):
+        st = os.stat(fname)
+        self.filename, self.st_size, self.st_mtime, self.st_mode = \
+            op.basename(fname), st.st_size, st.st_mtime, st.st_mode
+
+
+class SftpConnectionStandIn(object):
+    # The pysftp.Connection methods the SftpRemote uses, over a local directory
+    def __init__(self, connections):
+        self.closed = False
+        self.thread = threading.current_thread().name
+        connections.append(self)
+
+    def listdir_attr(self, fol):
+        assert not self.closed
+        return [SftpAttr(op.join(fol, fname)) for fname in os.listdir(fol)]
+
+    def open(self, fname, mode='rb'):
+        assert not self.closed and mode == 'rb'
+        return open(fname, mode)
+
+    def close(self):
+        self.closed = True
+
+
+def create_remote_subject(remote_subject_dir, size=1000):
+    for fol, files in [('mri', ['T1.mgz', 'orig.mgz']), ('surf', ['rh.pial', 'lh.pial']),
+                       ('label', ['rh.aparc.annot', 'lh.aparc.annot']), ('mri', ['brain.mgz'])]:
+        os.makedirs(op.join(remote_subject_dir, fol), exist_ok=True)
+        for fname in files:
+            with open(op.join(remote_subject_dir, fol, fname), 'wb') as f:
+                f.write(os.urandom(size))
+    os.makedirs(op.join(remote_subject_dir, 'surf', 'rh.pial.dir'), exist_ok=True)
+
+
+def read(fname):
+    with open(fname, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def subject_dirs(tmpdir):
+    remote_subject_dir, local_subject_dir = str(tmpdir.join('remote', 'subject')), str(tmpdir.join('local', 'subject'))
+    create_remote_subject(remote_subject_dir)
+    return remote_subject_dir, local_subject_dir
+
+
+def test_local_remote_fetch(subject_dirs):
+    remote_subject_dir, local_subject_dir = subject_dirs
+    fetched, failed = fu.fetch_subject_files(NECESSARY_FILES, 'subject', remote_subject_dir, local_subject_dir)
+    assert (fetched, failed) == (5, 0)
+    for rel_fname in ['mri/T1.mgz', 'mri/orig.mgz', 'surf/rh.pial', 'surf/lh.pial', 'label/lh.aparc.annot']:
+        assert read(op.join(local_subject_dir, rel_fname)) == read(op.join(remote_subject_dir, rel_fname))
+    # Only the first of the files that match a wildcard is fetched (without select_one_file)
+    assert not op.isfile(op.join(local_subject_dir, 'mri', 'brain.mgz'))
+    assert not op.isfile(op.join(local_subject_dir, 'label', 'rh.aparc.annot'))
+    manifest = fu.load_manifest(local_subject_dir)
+    assert len(manifest) == 5
+    assert not any([fname.endswith(fu.PART_POSTFIX) for _, _, files in os.walk(local_subject_dir) for fname in files])
+
+    # Nothing was changed, nothing is fetched
+    assert fu.fetch_subject_files(NECESSARY_FILES, 'subject', remote_subject_dir, local_subject_dir) == (0, 0)
+
+    # Only the changed remote file is fetched again
+    with open(op.join(remote_subject_dir, 'mri', 'T1.mgz'), 'wb') as f:
+        f.write(os.urandom(500))
+    os.utime(op.join(remote_subject_dir, 'mri', 'T1.mgz'), (1, 1))
+    assert fu.fetch_subject_files(NECESSARY_FILES, 'subject', remote_subject_dir, local_subject_dir) == (1, 0)
+    assert read(op.join(local_subject_dir, 'mri', 'T1.mgz')) == read(op.join(remote_subject_dir, 'mri', 'T1.mgz'))
+
+
+def test_local_files_are_kept(subject_dirs):
+    remote_subject_dir, local_subject_dir = subject_dirs
+    os.makedirs(op.join(local_subject_dir, 'mri'))
+    with open(op.join(local_subject_dir, 'mri', 'T1.mgz'), 'wb') as f:
+        f.write(b'local')
+    assert fu.fetch_subject_files(NECESSARY_FILES, 'subject', remote_subject_dir, local_subject_dir) == (4, 0)
+    assert read(op.join(local_subject_dir, 'mri', 'T1.mgz')) == b'local'
+    assert fu.fetch_subject_files(
+        NECESSARY_FILES, 'subject', remote_subject_dir, local_subject_dir, overwrite_files=True) == (5, 0)
+    assert read(op.join(local_subject_dir, 'mri', 'T1.mgz')) == read(op.join(remote_subject_dir, 'mri', 'T1.mgz'))
+
+
+def test_resume_part_file(subject_dirs):
+    remote_subject_dir, local_subject_dir = subject_dirs
+    remote = fu.LocalRemote()
+    entries = fu.resolve_manifest({'mri': ['T1.mgz']}, 'subject', remote_subject_dir, local_subject_dir, remote)
+    entry = entries[0]
+    os.makedirs(op.dirname(entry['local_fname']))
+    with open(entry['local_fname'] + fu.PART_POSTFIX, 'wb') as f:
+        f.write(read(entry['remote_fname'])[:300])
+    with open(entry['local_fname'] + fu.PART_POSTFIX + '.json', 'w') as f:
+        json.dump(dict(size=entry['size'], mtime=entry['mtime']), f)
+    record = fu.fetch_file(entry, remote, checksum=True)
+    assert record['resumed_from'] == 300
+    assert read(entry['local_fname']) == read(entry['remote_fname'])
+    assert record['md5'] == fu.calc_md5(entry['remote_fname'])
+
+
+def test_sftp_remote_fetch(subject_dirs):
+    remote_subject_dir, local_subject_dir = subject_dirs
+    connections = []
+    remote = fu.SftpRemote(lambda: SftpConnectionStandIn(connections))
+    fetched, failed = fu.fetch_subject_files(
+        NECESSARY_FILES, 'subject', remote_subject_dir, local_subject_dir, remote, workers_num=3)
+    assert (fetched, failed) == (5, 0)
+    assert read(op.join(local_subject_dir, 'surf', 'lh.pial')) == read(op.join(remote_subject_dir, 'surf', 'lh.pial'))
+    # One connection per thread (the listing's and the workers'), all closed at the end
+    assert len(set([con.thread for con in connections])) == len(connections) <= 4
+    assert all([con.closed for con in connections])
+    # The directories aren't listed as files
+    assert not any([entry['remote_fname'].endswith('.dir') for entry in fu.resolve_manifest(
+        {'surf': ['rh.pial*']}, 'subject', remote_subject_dir, local_subject_dir, fu.SftpRemote(
+            lambda: SftpConnectionStandIn([])))])
+
+
+def test_sftp_remote_is_closed(subject_dirs):
+    remote_subject_dir, local_subject_dir = subject_dirs
+    connections = []
+    remote = fu.SftpRemote(lambda: SftpConnectionStandIn(connections))
+    fu.fetch_subject_files(NECESSARY_FILES, 'subject', remote_subject_dir, local_subject_dir, remote)
+    # Nothing to fetch, the listing connection is closed too
+    connections.clear()
+    assert fu.fetch_subject_files(NECESSARY_FILES, 'subject', remote_subject_dir, local_subject_dir, remote) == (0, 0)
+    assert len(connections) == 1 and connections[0].closed
+
+    # The resolving failed
+    connections.clear()
+    with pytest.raises(ZeroDivisionError):
+        fu.fetch_subject_files(NECESSARY_FILES, 'subject', remote_subject_dir, local_subject_dir, remote,
+                               select_one_file=lambda names, files_desc: 1 / 0)
+    assert len(connections) == 1 and connections[0].closed
+
+
+def test_sftp_stand_in_listing_skips_dirs(subject_dirs):
+    remote_subject_dir, _ = subject_dirs
+    remote = fu.SftpRemote(lambda: SftpConnectionStandIn([]))
+    listing = remote.listdir_attr(remote.join(remote_subject_dir, 'surf'))
+    assert sorted(listing.keys()) == ['lh.pial', 'rh.pial']
+    assert stat.S_ISREG(os.stat(op.join(remote_subject_dir, 'surf', 'lh.pial')).st_mode)
+    assert remote.listdir_attr(remote.join(remote_subject_dir, 'no_such_fol')) == {}
@@ -2,7 +2,7 @@ import os
 import sys
 import shutil
 import numpy as np
-from collections import defaultdict, OrderedDict, Counter
+from collections import defaultdict, OrderedDict
 import itertools
 import time
 import re
@@ -34,6 +34,7 @@ except:
     pass
 
 from src.mmvt_addon import mmvt_utils as mu
+from src.utils import telemetry_utils as telemetry
 # links to mmvt_utils
 Bag = mu.Bag
 copy_file = mu.copy_file
@@ -89,6 +90,31 @@ get_label_for_full_fname = mu.get_label_for_full_fname
 to_str = mu.to_str
 argmax2d = mu.argmax2d
 file_modification_time = mu.file_modification_time
+get_activity_store_fol = mu.get_activity_store_fol
+activity_store_exists = mu.activity_store_exists
+save_activity_store = mu.save_activity_store
+load_activity_store = mu.load_activity_store
+read_activity_frame = mu.read_activity_frame
+read_vertex_time_course = mu.read_vertex_time_course
+read_vertices_time_courses = mu.read_vertices_time_courses
+activity_frame_exists = mu.activity_frame_exists
+activity_files_exist = mu.activity_files_exist
+save_activity_frame = mu.save_activity_frame
+get_storage_dtype = mu.get_storage_dtype
+set_storage_precision_policy = mu.set_storage_precision_policy
+read_storage_precision_policy = mu.read_storage_precision_policy
+encode_storage_data = mu.encode_storage_data
+decode_storage_data = mu.decode_storage_data
+upcast = mu.upcast
+save_storage_npy = mu.save_storage_npy
+load_storage_npy = mu.load_storage_npy
+savez_storage = mu.savez_storage
+load_precision_info = mu.load_precision_info
+calc_verts_faces_csr = mu.calc_verts_faces_csr
+verts_faces_csr_to_lookup = mu.verts_faces_csr_to_lookup
+save_verts_faces_csr = mu.save_verts_faces_csr
+load_verts_faces_csr = mu.load_verts_faces_csr
+VertsFacesLookup = mu.VertsFacesLookup
 
 atlas_exist = mu.atlas_exist
 get_atlas_template = mu.get_atlas_template
@@ -392,18 +418,10 @@ def calc_ply_faces_verts(verts, faces, out_file, overwrite=False, ply_name='', e
         if verbose:
             print('{}: verts: {}, faces: {}, faces ravel: {}'.format(
                 ply_name, verts.shape[0], faces.shape[0], len(_faces)))
-        faces_arg_sort = np.argsort(_faces)
-        faces_sort = np.sort(_faces)
-        faces_count = Counter(faces_sort)
-        max_len = max([v for v in faces_count.values()])
-        print(ply_name, verts.shape[0], max_len)
-        lookup = np.ones((verts.shape[0], max_len)) * -1
-        diff = np.diff(faces_sort)
-        n = 0
-        for ind, (k, v) in enumerate(zip(faces_sort, faces_arg_sort)):
-            lookup[k, n] = v
-            n = 0 if ind < len(diff) and diff[ind] > 0 else n+1
-        np.save(out_file, lookup.astype(np.int))
+        indptr, indices = calc_verts_faces_csr(faces, verts.shape[0])
+        lookup = verts_faces_csr_to_lookup(indptr, indices)
+        print(ply_name, verts.shape[0], lookup.shape[1])
+        np.save(out_file, lookup)
         if verbose:
             print('{} max lookup val: {}'.format(ply_name, int(np.max(lookup))))
         if len(_faces) != int(np.max(lookup)) + 1:
@@ -934,7 +952,8 @@ def build_remote_subject_dir(remote_subject_dir_template, subject):
 
 def prepare_subject_folder(necessary_files, subject, remote_subject_dir, local_subjects_dir,
         sftp=False, sftp_username='', sftp_domain='', sftp_password='',
-        overwrite_files=False, print_traceback=True, sftp_port=22, local_subject_dir='', print_missing_files=True):
+        overwrite_files=False, print_traceback=True, sftp_port=22, local_subject_dir='', print_missing_files=True,
+        fetch_workers=8, checksum=False):
     if local_subject_dir == '':
         local_subject_dir = op.join(local_subjects_dir, subject)
     mmvt_dir = get_link_dir(get_links_dir(), 'mmvt')
@@ -952,58 +971,13 @@ def prepare_subject_folder(necessary_files, subject, remote_subject_dir, local_s
     if sftp:
         password = sftp_copy_subject_files(
             subject, necessary_files, sftp_username, sftp_domain, local_subjects_dir, remote_subject_dir,
-            sftp_password, overwrite_files, print_traceback, sftp_port)
+            sftp_password, overwrite_files, print_traceback, sftp_port, fetch_workers, checksum)
     else:
-        for fol, files in necessary_files.items():
-            fol = fol.replace(':', op.sep)
-            # if not op.isdir(op.join(local_subject_dir, fol)):
-            #     os.makedirs(op.join(local_subject_dir, fol))
-            make_dir(op.join(local_subject_dir, fol))
-            for file_name in files:
-                try:
-                    file_name = file_name.replace('{subject}', subject)
-                    local_fname = op.join(local_subject_dir, fol, file_name)
-                    remote_fname = op.join(remote_subject_dir, fol, file_name)
-                    local_files = glob.glob(local_fname)
-                    # fs53 DKT atlas backward compatibility fix
-                    if 'DKTatlas' in file_name and not op.isfile(remote_fname):
-                        fs53_fname = file_name.replace('DKTatlas', 'DKTatlas40')
-                        fs53_remote_fname = op.join(remote_subject_dir, fol, fs53_fname)
-                        if op.isfile(fs53_remote_fname):
-                            copy_file(fs53_remote_fname, remote_fname)
-                    if len(local_files) == 0 or overwrite_files:
-                        remote_files = glob.glob(remote_fname)
-                        if len(remote_files) > 0:
-                            remote_fname = select_one_file(remote_files, files_desc=file_name)
-                            remote_lower = namebase_with_ext(remote_fname).lower()
-                            if subject in remote_lower and subject not in namebase(remote_fname):
-                                ind = remote_lower.index(subject)
-                                new_file_name = remote_lower[:ind] + subject + remote_lower[len(subject):]
-                                local_fname = op.join(local_subject_dir, fol, new_file_name)
-                            else:
-                                local_fname = op.join(local_subject_dir, fol, namebase_with_ext(remote_fname))
-                            make_dir(op.join(local_subject_dir, fol))
-                            if remote_fname != local_fname:
-                                if not op.isfile(remote_fname) and not op.isfile(local_fname):
-                                    print('Can\'t find {} nor {}!'.format(remote_fname, local_fname))
-                                if overwrite_files and op.isfile(local_fname):
-                                    os.remove(local_fname)
-                                elif op.isfile(local_fname) and op.getsize(remote_fname) != op.getsize(remote_fname):
-                                    print('Local file and remote file have different sizes!')
-                                    os.remove(local_fname)
-                                if not op.isfile(local_fname):
-                                    print('coping {} to {}'.format(remote_fname, local_fname))
-                                    make_dir(get_parent_fol(local_fname))
-                                    copy_file(remote_fname, local_fname)
-                                if op.isfile(local_fname) and op.getsize(remote_fname) != op.getsize(remote_fname):
-                                    os.remove(local_fname)
-                                    print('Local file and remote file have different sizes!')
-                        else:
-                            if print_missing_files:
-                                print("Remote file can't be found! {}".format(remote_fname))
-                except:
-                    if print_traceback:
-                        print(traceback.format_exc())
+        from src.utils import fetch_utils
+        # The whole manifest is resolved up front, and the files are copied concurrently
+        fetch_utils.fetch_subject_files(
+            necessary_files, subject, remote_subject_dir, local_subject_dir, fetch_utils.LocalRemote(),
+            overwrite_files, fetch_workers, checksum, select_one_file, print_missing_files, print_traceback)
     all_files_exists = check_if_all_necessary_files_exist(subject, necessary_files, local_subject_dir, True)
     if sftp:
         return all_files_exists, password
@@ -1033,49 +1007,34 @@ def check_if_all_necessary_files_exist(subject, necessary_files, local_subject_d
 
 
 def sftp_copy_subject_files(subject, necessary_files, username, domain, local_subjects_dir, remote_subject_dir,
-                            password='', overwrite_files=False, print_traceback=True, port=22):
+                            password='', overwrite_files=False, print_traceback=True, port=22, fetch_workers=8,
+                            checksum=False):
     import pysftp
+    from src.utils import fetch_utils
     local_subject_dir = op.join(local_subjects_dir, subject)
+    remote_subject_dir = remote_subject_dir.replace('{subject}', subject)
     if password == '':
         password = ask_for_sftp_password(username)
-    try:
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None
-        sftp_con = pysftp.Connection(domain, username=username, password=password, cnopts=cnopts, port=port)
-    except:
+
+    def connect():
         try:
-            sftp_con = pysftp.Connection(domain, username=username, password=password, port=port)
+            cnopts = pysftp.CnOpts()
+            cnopts.hostkeys = None
+            return pysftp.Connection(domain, username=username, password=password, cnopts=cnopts, port=port)
         except:
-            print("Can't connect via sftp!")
-            if print_traceback:
-                print(traceback.format_exc())
-            return False
-    with sftp_con as sftp:
-        for fol, files in necessary_files.items():
-            fol = fol.replace(':', op.sep)
-            if not op.isdir(op.join(local_subject_dir, fol)):
-                os.makedirs(op.join(local_subject_dir, fol))
-            os.chdir(op.join(local_subject_dir, fol))
-            for file_name in files:
-                try:
-                    file_name = file_name.replace('{subject}', subject)
-                    remote_subject_dir = remote_subject_dir.replace('{subject}', subject)
-                    local_fname = op.join(local_subject_dir, fol, file_name)
-                    if not op.isfile(local_fname) or overwrite_files:
-                        # with sftp.cd(op.join(remote_subject_dir, fol)):
-                        try:
-                            with sftp.cd(remote_subject_dir + '/' + fol):
-                                print('sftp: getting {}'.format(file_name))
-                                sftp.get(file_name)
-                        except FileNotFoundError:
-                            print('The file {} does not exist on the remote server! ({})'.format(
-                                file_name, remote_subject_dir + '/' + fol))
-
-                    if op.isfile(local_fname) and op.getsize(local_fname) == 0:
-                        os.remove(local_fname)
-                except:
-                    if print_traceback:
-                        print(traceback.format_exc())
+            return pysftp.Connection(domain, username=username, password=password, port=port)
+
+    # Checks the connection once, the fetch workers open their own connections
+    try:
+        connect().close()
+    except:
+        print("Can't connect via sftp!")
+        if print_traceback:
+            print(traceback.format_exc())
+        return False
+    fetch_utils.fetch_subject_files(
+        necessary_files, subject, remote_subject_dir, local_subject_dir, fetch_utils.SftpRemote(connect),
+        overwrite_files, fetch_workers, checksum, print_traceback=print_traceback)
     return password
 
 
@@ -1795,7 +1754,9 @@ def should_run(args, func_name):
     if 'exclude' not in args:
         args.exclude = []
     func_name = func_name.strip()
-    return ('all' in args.function or func_name in args.function) and func_name not in args.exclude
+    ret = ('all' in args.function or func_name in args.function) and func_name not in args.exclude
+    telemetry.on_should_run(func_name, ret)
+    return ret
 
 
 def trim_to_same_size(x1, x2):